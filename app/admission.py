@@ -0,0 +1,250 @@
+"""Admission control and token-bucket rate limiting.
+
+Two layers protect the proxy and platform-api from a single noisy user:
+
+- ``RateLimiter``: token buckets checked before any work is done. Each
+  ``RateLimit`` rule matches routes by regex and keys its buckets either per
+  ``X-User-ID`` or globally for the route. A request must pass every rule
+  that matches it, or it gets 429 with ``Retry-After``. The defaults give
+  every user a general allowance, and ``chat/async`` tighter per-user and
+  global limits. Buckets live in an LRU capped at ``RATE_LIMIT_MAX_BUCKETS``.
+  Buckets idle longer than ``RATE_LIMIT_IDLE_SECONDS`` are dropped as new
+  traffic arrives, since an idle bucket is simply full.
+- ``AdmissionController``: a global cap on requests in flight. Extra requests
+  wait in a bounded FIFO queue for up to ``ADMISSION_QUEUE_TIMEOUT`` seconds.
+  When the queue is full, or the wait times out, they are shed with 503 at
+  once rather than piling up.
+"""
+
+import asyncio
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Callable
+
+from app.config import env_bool, env_float, env_int
+
+
+ADMISSION_MAX_IN_FLIGHT = env_int("ADMISSION_MAX_IN_FLIGHT", 512)
+ADMISSION_MAX_QUEUE = env_int("ADMISSION_MAX_QUEUE", 1024)
+ADMISSION_QUEUE_TIMEOUT = env_float("ADMISSION_QUEUE_TIMEOUT", 5.0)
+
+RATE_LIMIT_ENABLED = env_bool("RATE_LIMIT_ENABLED", True)
+RATE_LIMIT_MAX_BUCKETS = env_int("RATE_LIMIT_MAX_BUCKETS", 100000)
+RATE_LIMIT_IDLE_SECONDS = env_float("RATE_LIMIT_IDLE_SECONDS", 300.0)
+# Requests per second and burst size; a rate of 0 disables the rule
+RATE_LIMIT_USER_RPS = env_float("RATE_LIMIT_USER_RPS", 50.0)
+RATE_LIMIT_USER_BURST = env_int("RATE_LIMIT_USER_BURST", 100)
+RATE_LIMIT_CHAT_RPS = env_float("RATE_LIMIT_CHAT_RPS", 1.0)
+RATE_LIMIT_CHAT_BURST = env_int("RATE_LIMIT_CHAT_BURST", 5)
+RATE_LIMIT_CHAT_GLOBAL_RPS = env_float("RATE_LIMIT_CHAT_GLOBAL_RPS", 50.0)
+RATE_LIMIT_CHAT_GLOBAL_BURST = env_int("RATE_LIMIT_CHAT_GLOBAL_BURST", 100)
+
+# Stale buckets examined per request, so eviction cost stays constant
+EVICT_PER_CALL = 8
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    name: str
+    pattern: str            # regex, full-matched against the path (after the v1/ strip)
+    rate: float             # tokens per second
+    burst: int              # bucket size
+    per_user: bool = True   # False: one bucket shared by every user of the route
+    methods: frozenset = frozenset()  # empty: all methods
+
+
+def default_rate_limits() -> list[RateLimit]:
+    chat = r"(?:.+/)?chat/async"
+    return [
+        RateLimit("user", r".*", RATE_LIMIT_USER_RPS, RATE_LIMIT_USER_BURST),
+        RateLimit("chat", chat, RATE_LIMIT_CHAT_RPS, RATE_LIMIT_CHAT_BURST, methods=frozenset({"POST"})),
+        RateLimit(
+            "chat-global", chat, RATE_LIMIT_CHAT_GLOBAL_RPS, RATE_LIMIT_CHAT_GLOBAL_BURST,
+            per_user=False, methods=frozenset({"POST"}),
+        ),
+    ]
+
+
+class RateLimited(Exception):
+    def __init__(self, rule: str, retry_after: float):
+        super().__init__(f"Rate limit {rule!r} exceeded")
+        self.rule = rule
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets for a list of rules, in one bounded LRU."""
+
+    def __init__(
+        self,
+        rules: list[RateLimit],
+        enabled: bool = RATE_LIMIT_ENABLED,
+        max_buckets: int = RATE_LIMIT_MAX_BUCKETS,
+        idle_seconds: float = RATE_LIMIT_IDLE_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rules = [rule for rule in rules if rule.rate > 0]
+        self.enabled = enabled
+        self.max_buckets = max_buckets
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self._patterns = [re.compile(rule.pattern) for rule in self.rules]
+        # (rule index, user or "") -> [tokens, last update]
+        self._buckets: OrderedDict[tuple[int, str], list[float]] = OrderedDict()
+        self.limited = 0
+        self.evictions = 0
+
+    def check(self, method: str, path: str, user_id: str):
+        """Take one token from every matching bucket, or raise ``RateLimited``.
+
+        Tokens are only taken when all matching buckets have one, so a request
+        rejected by one rule does not use up another rule's allowance.
+        """
+        if not self.enabled:
+            return
+        now = self.clock()
+        self._evict_idle(now)
+        matched = []
+        for i, rule in enumerate(self.rules):
+            if rule.methods and method not in rule.methods:
+                continue
+            if self._patterns[i].fullmatch(path) is None:
+                continue
+            bucket = self._bucket((i, user_id if rule.per_user else ""), rule, now)
+            if bucket[0] < 1:
+                self.limited += 1
+                raise RateLimited(rule.name, (1 - bucket[0]) / rule.rate)
+            matched.append(bucket)
+        for bucket in matched:
+            bucket[0] -= 1
+
+    def _bucket(self, key: tuple[int, str], rule: RateLimit, now: float) -> list[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(rule.burst), now]
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+            return bucket
+        self._buckets.move_to_end(key)
+        bucket[0] = min(float(rule.burst), bucket[0] + (now - bucket[1]) * rule.rate)
+        bucket[1] = now
+        return bucket
+
+    def _evict_idle(self, now: float):
+        for _ in range(EVICT_PER_CALL):
+            if not self._buckets:
+                return
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self.idle_seconds:
+                return
+            del self._buckets[key]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "rules": [
+                {"name": r.name, "pattern": r.pattern, "rate": r.rate, "burst": r.burst, "per_user": r.per_user}
+                for r in self.rules
+            ],
+            "buckets": len(self._buckets),
+            "limited": self.limited,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class Overloaded(Exception):
+    """The in-flight limit is reached and the wait queue is full or timed out."""
+
+
+class AdmissionController:
+    """Global in-flight limit with a bounded FIFO wait queue."""
+
+    def __init__(
+        self,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    async def acquire(self):
+        """Take a slot, waiting in line if needed; raises ``Overloaded`` when shed."""
+        if self.max_in_flight <= 0:
+            return
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded("admission queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just as we gave up
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise Overloaded("timed out waiting for admission") from None
+            raise
+        self.admitted += 1
+
+    def release(self):
+        """Free a slot, handing it straight to the next waiter if there is one."""
+        if self.max_in_flight <= 0:
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # in_flight unchanged: the slot moves over
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued_now": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+        }
+
+
+# Global limits used by the proxy routes
+rate_limiter = RateLimiter(default_rate_limits())
+admission = AdmissionController()
@@ -0,0 +1,216 @@
+"""Load balancing across several platform-api instances.
+
+``API_URLS`` (comma-separated) lists the upstream base URLs; without it the
+single ``API_URL`` is used. Each request picks an instance with one of:
+
+  p2c                 power of two choices: sample two, take the less loaded (default)
+  least_outstanding   the least loaded of all
+
+Load is in-flight requests divided by the instance's weight. Instances that
+fail to connect are ejected at once, and so are instances returning
+``UPSTREAM_EJECT_AFTER`` consecutive 5xx responses. An ejected instance is
+skipped for ``UPSTREAM_EJECT_SECONDS``, doubling on each repeated ejection.
+When it comes back, its weight ramps from 10% to 100% over
+``UPSTREAM_SLOW_START_SECONDS``, so it is not flooded while it warms up.
+With several instances, a background task also probes
+``UPSTREAM_HEALTH_PATH`` on each one. A failed probe ejects the instance; a
+passing probe ends an ejection early.
+
+If every instance is ejected, requests still go to the one whose ejection
+ends first, rather than failing outright.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Callable
+
+import httpx
+
+from app.config import env_float, env_int
+
+
+UPSTREAM_BALANCING = os.getenv("UPSTREAM_BALANCING", "p2c")
+# Consecutive 5xx responses before an instance is ejected
+UPSTREAM_EJECT_AFTER = env_int("UPSTREAM_EJECT_AFTER", 3)
+UPSTREAM_EJECT_SECONDS = env_float("UPSTREAM_EJECT_SECONDS", 30.0)
+UPSTREAM_MAX_EJECT_SECONDS = env_float("UPSTREAM_MAX_EJECT_SECONDS", 300.0)
+UPSTREAM_SLOW_START_SECONDS = env_float("UPSTREAM_SLOW_START_SECONDS", 30.0)
+# Active health checks (only run when there is more than one instance)
+UPSTREAM_HEALTH_PATH = os.getenv("UPSTREAM_HEALTH_PATH", "/health")
+UPSTREAM_HEALTH_INTERVAL = env_float("UPSTREAM_HEALTH_INTERVAL", 10.0)
+UPSTREAM_HEALTH_TIMEOUT = env_float("UPSTREAM_HEALTH_TIMEOUT", 2.0)
+
+BALANCING_POLICIES = ("p2c", "least_outstanding")
+MIN_WEIGHT = 0.1
+
+
+def upstream_urls(default: str) -> list[str]:
+    """Base URLs from ``API_URLS``, or ``[default]`` when it is unset."""
+    urls = [url.strip().rstrip("/") for url in os.getenv("API_URLS", "").split(",") if url.strip()]
+    return urls or [default.rstrip("/")]
+
+
+class Upstream:
+    """One platform-api instance and its load/health state."""
+
+    __slots__ = (
+        "url", "outstanding", "requests", "failures", "consecutive_failures",
+        "ejections", "ejected_until", "healthy",
+    )
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.healthy = True  # result of the last active check
+
+    def weight(self, now: float, slow_start: float) -> float:
+        """1.0 normally; ramps up from MIN_WEIGHT after an ejection ends."""
+        if not self.ejections or slow_start <= 0:
+            return 1.0
+        elapsed = now - self.ejected_until
+        if elapsed >= slow_start:
+            return 1.0
+        return MIN_WEIGHT + (1 - MIN_WEIGHT) * max(elapsed, 0.0) / slow_start
+
+    def load(self, now: float, slow_start: float) -> float:
+        return (self.outstanding + 1) / self.weight(now, slow_start)
+
+
+class UpstreamPool:
+    """Picks an instance per request and tracks passive/active health."""
+
+    def __init__(
+        self,
+        urls: list[str],
+        policy: str | None = None,
+        eject_after: int = UPSTREAM_EJECT_AFTER,
+        eject_seconds: float = UPSTREAM_EJECT_SECONDS,
+        max_eject_seconds: float = UPSTREAM_MAX_EJECT_SECONDS,
+        slow_start: float = UPSTREAM_SLOW_START_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        policy = policy or UPSTREAM_BALANCING
+        if policy not in BALANCING_POLICIES:
+            logging.warning(f"Unknown UPSTREAM_BALANCING {policy!r}, using p2c")
+            policy = "p2c"
+        self.policy = policy
+        self.upstreams = [Upstream(url) for url in urls]
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.slow_start = slow_start
+        self.clock = clock
+        self._rotation = 0
+
+    def __len__(self) -> int:
+        return len(self.upstreams)
+
+    # Selection ---------------------------------------------------------------
+
+    def pick(self, exclude: tuple | list = ()) -> Upstream | None:
+        """Choose an instance; None only if ``exclude`` rules out every one."""
+        if len(self.upstreams) == 1 and not exclude:
+            return self.upstreams[0]
+        allowed = [u for u in self.upstreams if u not in exclude] if exclude else self.upstreams
+        if not allowed:
+            return None
+        now = self.clock()
+        candidates = [u for u in allowed if u.ejected_until <= now]
+        if not candidates:
+            # Everything is ejected: degrade to the instance returning soonest
+            return min(allowed, key=lambda u: u.ejected_until)
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.policy == "p2c":
+            candidates = random.sample(candidates, 2)
+        else:
+            # Rotate the starting point so ties are shared round-robin
+            self._rotation = (self._rotation + 1) % len(candidates)
+            candidates = candidates[self._rotation:] + candidates[:self._rotation]
+        return min(candidates, key=lambda u: u.load(now, self.slow_start))
+
+    # Request accounting ------------------------------------------------------
+
+    def begin(self, upstream: Upstream):
+        upstream.outstanding += 1
+        upstream.requests += 1
+
+    def end(self, upstream: Upstream, status_code: int | None = None, error: BaseException | None = None):
+        """Finish a request started with ``begin``; 5xx and connect errors count as failures."""
+        upstream.outstanding -= 1
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+            upstream.failures += 1
+            self.eject(upstream, f"connect failed: {error!r}")
+        elif status_code is not None and status_code >= 500:
+            upstream.failures += 1
+            upstream.consecutive_failures += 1
+            if upstream.consecutive_failures >= self.eject_after:
+                self.eject(upstream, f"{upstream.consecutive_failures} consecutive {status_code} responses")
+        elif status_code is not None:
+            upstream.consecutive_failures = 0
+
+    def eject(self, upstream: Upstream, reason: str):
+        now = self.clock()
+        if len(self.upstreams) == 1 or upstream.ejected_until > now:
+            return
+        upstream.ejections += 1
+        duration = min(self.eject_seconds * 2 ** (upstream.ejections - 1), self.max_eject_seconds)
+        upstream.ejected_until = now + duration
+        upstream.consecutive_failures = 0
+        logging.warning(f"Ejecting upstream {upstream.url} for {duration:g}s: {reason}")
+
+    def readmit(self, upstream: Upstream):
+        """End an ejection early (e.g. after a passing health check); slow start applies."""
+        now = self.clock()
+        if upstream.ejected_until > now:
+            upstream.ejected_until = now
+            logging.info(f"Re-admitting upstream {upstream.url}")
+
+    # Active health checks ----------------------------------------------------
+
+    async def check(self, client: httpx.AsyncClient, upstream: Upstream):
+        try:
+            response = await client.get(f"{upstream.url}{UPSTREAM_HEALTH_PATH}", timeout=UPSTREAM_HEALTH_TIMEOUT)
+            healthy = response.status_code < 500
+        except httpx.HTTPError:
+            healthy = False
+        upstream.healthy = healthy
+        if healthy:
+            self.readmit(upstream)
+        else:
+            self.eject(upstream, "health check failed")
+
+    async def run_health_checks(self, client: httpx.AsyncClient, interval: float | None = None):
+        """Probe every instance each ``interval`` seconds until cancelled."""
+        interval = UPSTREAM_HEALTH_INTERVAL if interval is None else interval
+        while True:
+            await asyncio.gather(*(self.check(client, u) for u in self.upstreams))
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        now = self.clock()
+        return {
+            "policy": self.policy,
+            "upstreams": [
+                {
+                    "url": u.url,
+                    "available": u.ejected_until <= now,
+                    "healthy": u.healthy,
+                    "weight": round(u.weight(now, self.slow_start), 3),
+                    "outstanding": u.outstanding,
+                    "requests": u.requests,
+                    "failures": u.failures,
+                    "ejections": u.ejections,
+                    "ejected_for": round(max(u.ejected_until - now, 0.0), 1),
+                }
+                for u in self.upstreams
+            ],
+        }
@@ -0,0 +1,134 @@
+"""``POST /api/batch``: many proxied calls in one client round trip.
+
+A front end that needs current-user, membership, prompts, storyplan-config
+and project/list at startup can send them as one batch. Each sub-request is
+dispatched in-process through the app's own ``/api/{path}`` route (an httpx
+``ASGITransport``, no socket), so it gets exactly what a direct call gets:
+header injection, rate limits, admission, the response cache, coalescing and
+the resilience policy. At most ``BATCH_CONCURRENCY`` sub-requests of a batch
+run at a time.
+
+Sub-requests inherit the batch request's headers (``X-User-ID``,
+``X-Org-ID``, ...). An item's own headers override them. Results are returned
+together in request order, or as NDJSON lines in completion order when the
+client asks for a stream.
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Literal
+
+import httpx
+from pydantic import BaseModel, field_validator
+
+from app import codec
+from app.config import env_int
+
+
+BATCH_MAX_REQUESTS = env_int("BATCH_MAX_REQUESTS", 20)
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", 6)
+
+# Batch request headers that describe the batch body itself, not the sub-requests
+NOT_INHERITED = frozenset({
+    "content-length", "content-type", "transfer-encoding", "connection", "expect",
+    "accept", "accept-encoding", "x-request-id",
+})
+# Sub-response headers included in each result
+RESULT_HEADERS = ("content-type", "etag", "cache-control", "retry-after", "x-cache", "x-request-id")
+
+
+class BatchItem(BaseModel):
+    id: str | None = None    # echoed in the result; defaults to the item's index
+    method: Literal["GET", "POST", "PUT", "DELETE", "PATCH"] = "GET"
+    path: str                # as after /api/, e.g. "user/current-user?x=1"
+    headers: dict[str, str] = {}
+    body: Any = None         # JSON body
+
+    @field_validator("path")
+    @classmethod
+    def relative_path(cls, path: str) -> str:
+        path = path.lstrip("/")
+        if path.startswith("api/"):
+            path = path[4:]
+        if path.split("?")[0] in ("batch", "v1/batch"):
+            raise ValueError("batches cannot be nested")
+        return path
+
+
+class BatchRequest(BaseModel):
+    requests: list[BatchItem]
+    stream: bool = False     # NDJSON in completion order instead of one JSON document
+
+
+def inherited_headers(headers: httpx.Headers | dict) -> dict[str, str]:
+    return {name: value for name, value in headers.items() if name.lower() not in NOT_INHERITED}
+
+
+class BatchRun:
+    """One batch: dispatches its items through ``app`` with bounded concurrency."""
+
+    def __init__(
+        self,
+        app,
+        items: list[BatchItem],
+        headers: dict[str, str],
+        batch_id: str,
+        client: tuple[str, int] = ("127.0.0.1", 0),
+        concurrency: int = BATCH_CONCURRENCY,
+    ):
+        self.items = items
+        self.headers = headers
+        self.batch_id = batch_id
+        self._transport = httpx.ASGITransport(app=app, client=client)
+        self._semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    def _request(self, index: int, item: BatchItem) -> httpx.Request:
+        headers = {
+            **self.headers,
+            # Results are embedded as JSON, so compressing them upstream would only cost CPU
+            "accept-encoding": "identity",
+            "x-request-id": f"{self.batch_id}.{index}",
+        }
+        content = None
+        if item.body is not None:
+            content = codec.dumps(item.body)
+            headers["content-type"] = "application/json"
+        headers.update({name.lower(): value for name, value in item.headers.items()})
+        return httpx.Request(item.method, f"http://batch/api/{item.path}", headers=headers, content=content)
+
+    async def run_one(self, index: int) -> dict:
+        item = self.items[index]
+        result: dict[str, Any] = {"id": item.id if item.id is not None else str(index)}
+        async with self._semaphore:
+            try:
+                response = await self._transport.handle_async_request(self._request(index, item))
+                content = await response.aread()
+            except Exception as e:
+                result.update(status=502, error=repr(e))
+                return result
+        result["status"] = response.status_code
+        result["headers"] = {name: response.headers[name] for name in RESULT_HEADERS if name in response.headers}
+        if not content:
+            result["body"] = None
+        elif "json" in response.headers.get("content-type", ""):
+            try:
+                result["body"] = codec.loads(content)
+            except ValueError:
+                result["body"] = content.decode("utf-8", errors="replace")
+        else:
+            result["body"] = content.decode("utf-8", errors="replace")
+        return result
+
+    async def results(self) -> list[dict]:
+        """Every result, in request order."""
+        return list(await asyncio.gather(*(self.run_one(i) for i in range(len(self.items)))))
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """One NDJSON line per result, as each completes."""
+        tasks = [asyncio.ensure_future(self.run_one(i)) for i in range(len(self.items))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield codec.dumps(await next_done) + b"\n"
+        finally:
+            # Client went away mid-stream: stop the sub-requests still running
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,76 @@
+"""Request body handling for the proxy: size limits, streaming and buffering.
+
+Bodies the proxy does not need to inspect are streamed straight to the
+upstream request. Routes that must see the whole body (e.g. ``chat/async``
+source injection) parse it as JSON, so they buffer it in memory, up to
+``MAX_REQUEST_BODY_BYTES``.
+"""
+
+from typing import AsyncIterator
+from fastapi import Request
+
+from app.config import env_int
+
+
+# Largest request body the proxy accepts (bytes). Default 100 MB.
+MAX_REQUEST_BODY_BYTES = env_int("MAX_REQUEST_BODY_BYTES", 100 * 1024 * 1024)
+
+
+class RequestBodyTooLarge(Exception):
+    """Raised when a request body exceeds ``MAX_REQUEST_BODY_BYTES``."""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Request body exceeds the {limit} byte limit")
+        self.limit = limit
+
+
+def declared_length(request: Request) -> int | None:
+    """Return the Content-Length of the request, if the client sent a valid one."""
+    value = request.headers.get("content-length")
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def has_body(request: Request) -> bool:
+    """Whether the client is sending a body at all (sized or chunked)."""
+    length = declared_length(request)
+    if length is not None:
+        return length > 0
+    return "transfer-encoding" in request.headers
+
+
+def check_declared_length(request: Request, max_bytes: int | None = None):
+    """Reject oversized bodies up front, before reading a single byte."""
+    if max_bytes is None:
+        max_bytes = MAX_REQUEST_BODY_BYTES
+    length = declared_length(request)
+    if length is not None and length > max_bytes:
+        raise RequestBodyTooLarge(max_bytes)
+
+
+async def stream_request_body(
+    request: Request, max_bytes: int | None = None
+) -> AsyncIterator[bytes]:
+    """Yield the request body chunk by chunk, enforcing the size limit as it goes."""
+    if max_bytes is None:
+        max_bytes = MAX_REQUEST_BODY_BYTES
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise RequestBodyTooLarge(max_bytes)
+        if chunk:
+            yield chunk
+
+
+async def read_request_body(request: Request, max_bytes: int | None = None) -> bytes:
+    """Buffer the whole request body for routes that need to parse it.
+
+    Every caller parses the result, so the body has to be in memory in full;
+    the chunks are joined once, at the end.
+    """
+    return b"".join([chunk async for chunk in stream_request_body(request, max_bytes)])
@@ -0,0 +1,228 @@
+"""Opt-in traffic capture, replayed by ``bench/replay.py``.
+
+With ``CAPTURE_ENABLED``, a sampled fraction (``CAPTURE_SAMPLE_RATE``) of
+catch-all requests is recorded as one JSON object per line::
+
+    {"ts": 1760000000.123, "method": "POST", "path": "/api/v1/chat/async",
+     "query": "", "headers": {...}, "body": "{...}", "status": 202,
+     "duration_ms": 41.2, "request_id": "..."}
+
+The record is what the client sent, before any transformer. Sensitive
+headers (``LOG_REDACTED_HEADERS``) are replaced by ``[REDACTED]``. In JSON
+bodies, the values of ``CAPTURE_REDACTED_FIELDS`` keys are replaced at any
+depth. Only the first ``CAPTURE_MAX_BODY_BYTES`` of a body are kept; longer
+ones are marked ``body_truncated`` with their full ``body_bytes``. A JSON
+body that cannot be parsed, e.g. because it was cut, cannot be redacted, so
+only its size is kept. Bodies that are not UTF-8 are stored base64-encoded
+in ``body_b64``.
+
+The request path only appends to a bounded queue and drops records when it
+is full. A background task hands each batch to a thread, which redacts,
+encodes and appends it to ``CAPTURE_DIR/capture.jsonl``. The files form a
+ring buffer. Past ``CAPTURE_FILE_BYTES`` the file is rotated to
+``capture.jsonl.1`` and so on, and the oldest of ``CAPTURE_FILES`` is
+deleted. Workers share the ring under a file lock.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import random
+import time
+from collections import deque
+from pathlib import Path
+
+from app import codec
+from app.config import env_bool, env_float, env_int
+from app.request_log import redact_headers
+from app.workers import FileLock
+
+
+CAPTURE_ENABLED = env_bool("CAPTURE_ENABLED", False)
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "captures")
+CAPTURE_SAMPLE_RATE = env_float("CAPTURE_SAMPLE_RATE", 1.0)
+CAPTURE_MAX_BODY_BYTES = env_int("CAPTURE_MAX_BODY_BYTES", 64 * 1024)
+# Ring buffer: files of about this size (bytes), this many kept
+CAPTURE_FILE_BYTES = env_int("CAPTURE_FILE_BYTES", 16 * 1024 * 1024)
+CAPTURE_FILES = env_int("CAPTURE_FILES", 8)
+# Records waiting for the writer before new ones are dropped
+CAPTURE_QUEUE_SIZE = env_int("CAPTURE_QUEUE_SIZE", 10000)
+CAPTURE_FLUSH_INTERVAL = env_float("CAPTURE_FLUSH_INTERVAL", 1.0)
+CAPTURE_REDACTED_FIELDS = frozenset(
+    name.strip().lower()
+    for name in os.getenv(
+        "CAPTURE_REDACTED_FIELDS", "password,token,access_token,refresh_token,api_key,secret"
+    ).split(",")
+    if name.strip()
+)
+
+CAPTURE_FILE = "capture.jsonl"
+REDACTED = "[REDACTED]"
+# Request headers that describe the connection or body framing, not the request
+SKIPPED_HEADERS = frozenset({"host", "content-length", "transfer-encoding", "connection", "keep-alive", "expect"})
+
+
+def redact_fields(value, fields: frozenset = CAPTURE_REDACTED_FIELDS):
+    """``value`` with the values of sensitive keys replaced, at any depth."""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key.lower() in fields else redact_fields(item, fields)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact_fields(item, fields) for item in value]
+    return value
+
+
+def encode_record(record: dict, fields: frozenset = CAPTURE_REDACTED_FIELDS) -> bytes:
+    """One JSONL line for a captured request; runs on the writer thread."""
+    body: bytes = record.pop("body")
+    headers = record["headers"]
+    if body and "json" in headers.get("content-type", ""):
+        try:
+            body = codec.dumps(redact_fields(codec.loads(body), fields))
+        except ValueError:
+            # Cut off (or malformed), so it cannot be redacted: keep only its size
+            record["body_truncated"] = True
+            record.setdefault("body_bytes", len(body))
+            body = b""
+    if body:
+        try:
+            record["body"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            record["body_b64"] = base64.b64encode(body).decode("ascii")
+    return codec.dumps(record) + b"\n"
+
+
+class TrafficCapture:
+    """Bounded queue of sampled requests, written to a rotating JSONL ring in the background."""
+
+    def __init__(
+        self,
+        directory: str = CAPTURE_DIR,
+        enabled: bool = CAPTURE_ENABLED,
+        sample_rate: float = CAPTURE_SAMPLE_RATE,
+        max_body_bytes: int = CAPTURE_MAX_BODY_BYTES,
+        file_bytes: int = CAPTURE_FILE_BYTES,
+        files: int = CAPTURE_FILES,
+        max_queue: int = CAPTURE_QUEUE_SIZE,
+        interval: float = CAPTURE_FLUSH_INTERVAL,
+    ):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+        self.file_bytes = file_bytes
+        self.files = max(files, 1)
+        self.max_queue = max_queue
+        self.interval = interval
+        self._queue: deque[dict] = deque()
+        self._lock = FileLock(self.directory / "capture.lock")
+        self.captured = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+
+    @property
+    def path(self) -> Path:
+        return self.directory / CAPTURE_FILE
+
+    def should_capture(self) -> bool:
+        """Decide once per request whether it is recorded."""
+        return self.enabled and random.random() < self.sample_rate
+
+    def submit(
+        self,
+        method: str,
+        path: str,
+        query: str,
+        headers,
+        body: bytes,
+        body_bytes: int,
+        status: int,
+        duration: float,
+        request_id: str,
+    ):
+        """Queue a finished request; never blocks, drops when the queue is full."""
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        record = {
+            "ts": round(time.time() - duration, 6),
+            "method": method,
+            "path": path,
+            "query": query,
+            "headers": {
+                name: value for name, value in redact_headers(headers).items()
+                if name.lower() not in SKIPPED_HEADERS
+            },
+            "body": body[: self.max_body_bytes],
+            "status": status,
+            "duration_ms": round(duration * 1000, 2),
+            "request_id": request_id,
+        }
+        if body_bytes > len(record["body"]):
+            record["body_truncated"] = True
+            record["body_bytes"] = body_bytes
+        self._queue.append(record)
+
+    def _rotate(self):
+        oldest = self.directory / f"{CAPTURE_FILE}.{self.files - 1}"
+        oldest.unlink(missing_ok=True)
+        for n in range(self.files - 2, 0, -1):
+            rotated = self.directory / f"{CAPTURE_FILE}.{n}"
+            if rotated.exists():
+                rotated.rename(self.directory / f"{CAPTURE_FILE}.{n + 1}")
+        if self.files > 1:
+            self.path.rename(self.directory / f"{CAPTURE_FILE}.1")
+        else:
+            self.path.unlink()
+        self.rotations += 1
+
+    def _write(self, records: list[dict]):
+        data = b"".join(encode_record(record) for record in records)
+        self._lock.acquire()
+        try:
+            if self.path.exists() and self.path.stat().st_size + len(data) > self.file_bytes:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+        finally:
+            self._lock.release()
+
+    async def flush(self):
+        """Write everything queued so far."""
+        while self._queue:
+            records = [self._queue.popleft() for _ in range(min(1000, len(self._queue)))]
+            try:
+                await asyncio.to_thread(self._write, records)
+                self.captured += len(records)
+            except Exception as e:
+                self.failed += len(records)
+                logging.warning(f"Traffic capture write failed, {len(records)} requests lost: {e}")
+
+    async def run(self):
+        """Background task: write queued records every ``interval`` seconds."""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "directory": str(self.directory),
+            "sample_rate": self.sample_rate,
+            "queued": len(self._queue),
+            "captured": self.captured,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "rotations": self.rotations,
+        }
+
+
+# Global capture used by the catch-all route
+traffic_capture = TrafficCapture()
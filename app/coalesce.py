@@ -0,0 +1,244 @@
+"""Request coalescing (single-flight) for identical concurrent upstream calls.
+
+When several clients ask for the same idempotent resource at the same time
+(same method, path, query, effective user and Accept-Encoding), only the first
+request goes upstream. Every identical request that arrives while it is in
+flight attaches to the same ``Flight`` and receives the same status, headers
+and body. Bodies are still streamed: each subscriber replays the chunks
+received so far and then follows the live upstream read.
+
+Memory stays bounded by ``COALESCE_MAX_BUFFER_BYTES`` per flight. Up to that
+size the whole body is kept, so late arrivals can replay it from the start.
+Past it the flight takes no new subscribers (they start their own upstream
+call), chunks every subscriber has read are dropped, and the upstream read
+waits for the slowest subscriber whenever the buffer is full.
+
+The upstream call runs in its own task, so one subscriber disconnecting does
+not cut the response short for the others. When the last one leaves, the
+upstream call is cancelled.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Hashable
+
+from app.config import env_bool, env_int
+
+
+COALESCE_ENABLED = env_bool("COALESCE_ENABLED", True)
+# Body bytes a flight keeps for replay and for its slowest subscriber
+COALESCE_MAX_BUFFER_BYTES = env_int("COALESCE_MAX_BUFFER_BYTES", 1024 * 1024)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+
+
+class Subscriber:
+    """One request reading a shared flight."""
+
+    def __init__(self, flight: "Flight"):
+        self.flight = flight
+        self.position = 0  # index of the next chunk to read
+
+    async def head(self) -> tuple[int, dict[str, str]]:
+        return await self.flight.head()
+
+    def iterate(self) -> AsyncIterator[bytes]:
+        return self.flight.iterate(self)
+
+    def leave(self):
+        self.flight.leave(self)
+
+
+class Flight:
+    """One in-progress upstream response shared by every identical request."""
+
+    def __init__(self, max_buffer: int = COALESCE_MAX_BUFFER_BYTES):
+        self.status_code: int | None = None
+        self.headers: dict[str, str] = {}
+        self.max_buffer = max_buffer
+        self.chunks: deque[bytes] = deque()
+        self.first = 0  # index in the body of chunks[0]
+        self.buffered = 0  # bytes held in chunks
+        self.total = 0  # bytes received from upstream
+        self.done = False
+        self.error: BaseException | None = None
+        self.task: asyncio.Task | None = None
+        self.stalls = 0
+        self._subscribers: set[Subscriber] = set()
+        self._head = asyncio.get_running_loop().create_future()
+        self._more = asyncio.Event()
+        self._progress = asyncio.Event()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def joinable(self) -> bool:
+        """Whether a new subscriber can still replay the body from its first byte."""
+        return self.total <= self.max_buffer
+
+    # Producer side -----------------------------------------------------------
+
+    def start(self, status_code: int, headers: dict[str, str]):
+        self.status_code = status_code
+        self.headers = headers
+        if not self._head.done():
+            self._head.set_result(None)
+
+    async def append(self, chunk: bytes):
+        """Add a chunk; past the buffer cap, wait until the slowest subscriber makes room."""
+        if not chunk:
+            return
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+        self.total += len(chunk)
+        self._notify()
+        if self.total <= self.max_buffer:
+            return
+        self._trim()
+        while self.buffered > self.max_buffer and self._subscribers:
+            self.stalls += 1
+            progress = self._progress
+            await progress.wait()
+            self._trim()
+
+    def finish(self, error: BaseException | None = None):
+        self.done = True
+        self.error = error
+        if not self._head.done():
+            if error is not None:
+                self._head.set_exception(error)
+            else:
+                self._head.set_result(None)
+        self._notify()
+
+    def _trim(self):
+        """Drop the chunks every subscriber has read; only once the body is past the cap."""
+        low = min((subscriber.position for subscriber in self._subscribers), default=self.first + len(self.chunks))
+        while self.first < low and self.chunks:
+            self.buffered -= len(self.chunks.popleft())
+            self.first += 1
+
+    def _notify(self):
+        self._more.set()
+        self._more = asyncio.Event()
+
+    def _notify_progress(self):
+        self._progress.set()
+        self._progress = asyncio.Event()
+
+    # Subscriber side ---------------------------------------------------------
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def leave(self, subscriber: Subscriber):
+        """Detach a subscriber; cancels the upstream call when it was the last one."""
+        if subscriber not in self._subscribers:
+            return
+        self._subscribers.discard(subscriber)
+        self._notify_progress()
+        if not self._subscribers and not self.done and self.task is not None:
+            self.task.cancel()
+
+    async def head(self) -> tuple[int, dict[str, str]]:
+        """Wait for the upstream status and headers."""
+        await asyncio.shield(self._head)
+        return self.status_code, dict(self.headers)
+
+    async def iterate(self, subscriber: Subscriber) -> AsyncIterator[bytes]:
+        """Yield the whole body from the first chunk, following the live read."""
+        try:
+            while True:
+                while subscriber.position - self.first < len(self.chunks):
+                    yield self.chunks[subscriber.position - self.first]
+                    subscriber.position += 1
+                    self._notify_progress()
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                more = self._more
+                await more.wait()
+        finally:
+            self.leave(subscriber)
+
+
+class SingleFlight:
+    """Tracks in-flight upstream calls by request key."""
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED, max_buffer: int = COALESCE_MAX_BUFFER_BYTES):
+        self.enabled = enabled
+        self.max_buffer = max_buffer
+        self._flights: dict[Hashable, Flight] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.leaders = 0
+        self.followers = 0
+        self.overflowed = 0
+        self.stalls = 0
+        self.cancelled = 0
+
+    def join(
+        self, key: Hashable, fetch: Callable[[Flight], Awaitable[None]]
+    ) -> tuple[Subscriber, bool]:
+        """Subscribe to the flight for ``key``, starting ``fetch`` if there is none.
+
+        Returns (subscriber, is_leader). Every subscriber must ``leave`` or
+        exhaust ``iterate``. ``fetch`` must call ``flight.start`` and
+        ``flight.append``; ``finish`` is called for it.
+        """
+        flight = self._flights.get(key)
+        if flight is not None and flight.joinable:
+            self.followers += 1
+            return flight.subscribe(), False
+
+        flight = Flight(self.max_buffer)
+        self._flights[key] = flight
+        self.leaders += 1
+
+        async def run():
+            try:
+                await fetch(flight)
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    self.cancelled += 1
+                else:
+                    logging.warning(f"Coalesced upstream call failed: {e!r}")
+                flight.finish(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+            else:
+                flight.finish()
+            finally:
+                if not flight.joinable:
+                    self.overflowed += 1
+                self.stalls += flight.stalls
+                # New requests after this point start a fresh upstream call
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+        subscriber = flight.subscribe()
+        flight.task = asyncio.create_task(run())
+        self._tasks.add(flight.task)
+        flight.task.add_done_callback(self._tasks.discard)
+        return subscriber, True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "max_buffer_bytes": self.max_buffer,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "overflowed": self.overflowed,
+            "backpressure_stalls": self.stalls,
+            "cancelled": self.cancelled,
+        }
+
+
+# Global coalescer used by the catch-all route
+coalescer = SingleFlight()
@@ -0,0 +1,31 @@
+"""JSON codec used wherever the proxy parses or re-encodes bodies.
+
+Uses orjson when it is installed and falls back to the stdlib json module.
+Both ``dumps`` variants return compact UTF-8 bytes.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def loads(data: bytes | str):
+        return orjson.loads(data)
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+else:
+    JSON_BACKEND = "json"
+
+    def loads(data: bytes | str):
+        return json.loads(data)
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
@@ -0,0 +1,277 @@
+"""Content-Encoding negotiation for proxied responses.
+
+The proxy forwards the client's Accept-Encoding, so platform-api only
+compresses with encodings the client can read. Those bodies are relayed byte
+for byte, never decoded and re-encoded. Only a client that cannot read what
+upstream sent anyway gets a decoded copy.
+
+Uncompressed JSON and text responses of at least ``COMPRESSION_MIN_BYTES``
+are compressed here. The encoding is the client's preferred one among zstd
+and br (when the ``zstandard`` / ``brotli`` packages are installed) and gzip.
+Streamed relays are flushed after every chunk, so the client never waits on
+the compressor. Routes with a response transformer ask upstream for an
+uncompressed body. The transformer reads the JSON, and the result is
+compressed once.
+"""
+
+import asyncio
+import gzip
+import zlib
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Mapping
+
+import httpx
+
+from app.config import env_bool, env_int
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+
+COMPRESSION_ENABLED = env_bool("COMPRESSION_ENABLED", True)
+# Smaller responses are sent as they are; compressing them saves no round trips
+COMPRESSION_MIN_BYTES = env_int("COMPRESSION_MIN_BYTES", 1024)
+COMPRESSION_GZIP_LEVEL = env_int("COMPRESSION_GZIP_LEVEL", 6)
+
+# Fast settings: most of the size win for a fraction of the CPU
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+# Buffered bodies larger than this are compressed off the event loop (bytes)
+COMPRESS_OFFLOAD_BYTES = 256 * 1024
+
+# Ours, in order of preference when the client weighs several equally
+ENCODINGS = tuple(
+    name for name, available in (("zstd", zstandard is not None), ("br", brotli is not None), ("gzip", True))
+    if available
+)
+# What httpx can decode for a client that does not accept upstream's encoding
+DECODABLE = frozenset({"gzip", "deflate", *ENCODINGS})
+
+COMPRESSIBLE_TYPES = frozenset({
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "text/plain",
+    "text/html",
+    "text/css",
+    "text/csv",
+    "text/javascript",
+    "text/xml",
+})
+
+
+@lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding: str) -> dict[str, float]:
+    """Parse an Accept-Encoding header into {encoding: q}. Do not mutate the result."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+    return weights
+
+
+def accepts(accept_encoding: str, encoding: str) -> bool:
+    weights = accepted_encodings(accept_encoding)
+    return weights.get(encoding, weights.get("*", 0.0)) > 0
+
+
+@lru_cache(maxsize=256)
+def choose_encoding(accept_encoding: str) -> str | None:
+    """The client's most preferred encoding we can produce, or None."""
+    weights = accepted_encodings(accept_encoding)
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressible(content_type: str) -> bool:
+    media_type = content_type.partition(";")[0].strip().lower()
+    return media_type in COMPRESSIBLE_TYPES or media_type.endswith(("+json", "+xml"))
+
+
+def compress(data: bytes, encoding: str, gzip_level: int = COMPRESSION_GZIP_LEVEL) -> bytes:
+    if encoding == "gzip":
+        # mtime=0: the same body always compresses to the same bytes
+        return gzip.compress(data, gzip_level, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def stream_compressor(
+    encoding: str, gzip_level: int = COMPRESSION_GZIP_LEVEL
+) -> tuple[Callable[[bytes], bytes], Callable[[], bytes]]:
+    """(compress and flush one chunk, finish the stream) for ``encoding``."""
+    if encoding == "gzip":
+        deflate = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # 31: gzip container
+        return lambda chunk: deflate.compress(chunk) + deflate.flush(zlib.Z_SYNC_FLUSH), deflate.flush
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return lambda chunk: compressor.process(chunk) + compressor.flush(), compressor.finish
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return (
+        lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+
+async def _read_ahead(chunks: AsyncIterator[bytes], limit: int) -> tuple[bytes, AsyncIterator[bytes]]:
+    """Read at least ``limit`` bytes (or all of a shorter body); return them and the full stream."""
+    head = []
+    size = 0
+    iterator = aiter(chunks)
+    exhausted = False
+    while size < limit:
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            exhausted = True
+            break
+        head.append(chunk)
+        size += len(chunk)
+
+    async def replay() -> AsyncIterator[bytes]:
+        for chunk in head:
+            yield chunk
+        if not exhausted:
+            async for chunk in iterator:
+                yield chunk
+
+    return b"".join(head), replay()
+
+
+class ResponseCompression:
+    """Chooses, per response, between relaying, decoding and compressing the body."""
+
+    def __init__(
+        self,
+        enabled: bool = COMPRESSION_ENABLED,
+        min_bytes: int = COMPRESSION_MIN_BYTES,
+        gzip_level: int = COMPRESSION_GZIP_LEVEL,
+    ):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.passed_through = 0
+        self.decoded = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def must_decode(self, upstream_headers: Mapping[str, str], accept_encoding: str) -> bool:
+        """Whether upstream used an encoding the client did not ask for (and httpx can undo)."""
+        encoding = upstream_headers.get("content-encoding", "identity").strip().lower()
+        if encoding == "identity" or accepts(accept_encoding, encoding) or encoding not in DECODABLE:
+            return False
+        self.decoded += 1
+        return True
+
+    def _candidate(self, headers: dict[str, str]) -> bool:
+        return self.enabled and "content-encoding" not in headers and compressible(headers.get("content-type", ""))
+
+    def _encoding_for(self, headers: dict[str, str], size: int | None, accept_encoding: str) -> str | None:
+        headers["vary"] = "Accept-Encoding"
+        if "content-encoding" in headers:
+            self.passed_through += 1
+            return None
+        if not self._candidate(headers) or (size is not None and size < self.min_bytes):
+            return None
+        encoding = choose_encoding(accept_encoding)
+        if encoding is not None:
+            headers["content-encoding"] = encoding
+            etag = headers.get("etag")
+            if etag and etag.endswith('"'):
+                # Still strong, but distinct from the uncompressed representation's tag
+                headers["etag"] = f'{etag[:-1]}-{encoding}"'
+            self.compressed += 1
+        return encoding
+
+    async def compress_body(self, headers: dict[str, str], content: bytes, accept_encoding: str) -> bytes:
+        """Compress a buffered body for the client if worthwhile; updates ``headers``."""
+        encoding = self._encoding_for(headers, len(content), accept_encoding)
+        if encoding is None:
+            return content
+        if len(content) > COMPRESS_OFFLOAD_BYTES:
+            compressed = await asyncio.to_thread(compress, content, encoding, self.gzip_level)
+        else:
+            compressed = compress(content, encoding, self.gzip_level)
+        self.bytes_in += len(content)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    async def relay(
+        self, response: httpx.Response, headers: dict[str, str], accept_encoding: str
+    ) -> AsyncIterator[bytes]:
+        """The upstream body as the client should get it; updates ``headers``.
+
+        Await before sending ``headers``. When upstream gave no length, up to
+        ``min_bytes`` of the body is read ahead to decide.
+        """
+        decode = self.must_decode(response.headers, accept_encoding)
+        if decode:
+            headers.pop("content-encoding", None)
+            chunks = response.aiter_bytes()
+        else:
+            chunks = response.aiter_raw()
+        size = None
+        if not decode and "content-length" in response.headers:
+            try:
+                size = int(response.headers["content-length"])
+            except ValueError:
+                pass
+        if size is None and self._candidate(headers) and choose_encoding(accept_encoding):
+            head, chunks = await _read_ahead(chunks, self.min_bytes)
+            if len(head) < self.min_bytes:
+                size = len(head)
+        encoding = self._encoding_for(headers, size, accept_encoding)
+        if encoding is None:
+            return chunks
+        return self._compress_stream(chunks, encoding)
+
+    async def _compress_stream(self, chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+        compress_chunk, finish = stream_compressor(encoding, self.gzip_level)
+        async for chunk in chunks:
+            self.bytes_in += len(chunk)
+            out = compress_chunk(chunk)
+            self.bytes_out += len(out)
+            yield out
+        out = finish()
+        self.bytes_out += len(out)
+        yield out
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "encodings": list(ENCODINGS),
+            "min_bytes": self.min_bytes,
+            "passed_through": self.passed_through,
+            "decoded": self.decoded,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+# Global negotiator used by the catch-all route
+compression = ResponseCompression()
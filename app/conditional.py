@@ -0,0 +1,167 @@
+"""ETags, ``If-None-Match`` and conditional revalidation upstream.
+
+Every buffered 200 JSON response carries a strong ETag. That covers cached
+routes, routes with a response transformer and polled routes. The ETag is
+upstream's own when it sent one, otherwise a hash of the bytes sent to the
+client. Streamed responses carry upstream's ETag when it sent one. A GET
+whose ``If-None-Match`` matches the response's ETag gets a bodyless ``304``.
+For streamed responses the upstream body is never read.
+
+Polling clients hit some routes (``events``, ``stories/story/{id}`` during
+generation) every few seconds and mostly get the same payload back. For the
+routes in ``CONDITIONAL_ROUTES``, the proxy keeps the last 200 response that
+came with an upstream ETag. The next poll asks upstream with
+``If-None-Match``. A ``304`` from upstream is answered from the stored copy,
+so an unchanged payload is never re-sent by upstream, and not re-sent to a
+client that holds its ETag either. Stored copies are keyed like the response
+cache (path, query, ``X-User-ID``, ``Accept-Encoding``). They are bounded by
+entry count and bytes, with LRU eviction. Since every poll is revalidated,
+they never need a TTL.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import Response
+
+from app.config import env_bool, env_int
+
+
+ETAG_ENABLED = env_bool("ETAG_ENABLED", True)
+# Regex of GET routes (after the v1/ strip) revalidated upstream with If-None-Match
+CONDITIONAL_ROUTES = os.getenv("CONDITIONAL_ROUTES", r"events(?:/.*)?|stories/story/[^/]+(?:/.*)?")
+CONDITIONAL_MAX_ENTRIES = env_int("CONDITIONAL_MAX_ENTRIES", 10000)
+CONDITIONAL_MAX_BYTES = env_int("CONDITIONAL_MAX_BYTES", 64 * 1024 * 1024)
+# Larger responses are relayed without keeping a copy (bytes)
+CONDITIONAL_MAX_ENTRY_BYTES = env_int("CONDITIONAL_MAX_ENTRY_BYTES", 1024 * 1024)
+
+# Bodies larger than this are hashed off the event loop (bytes)
+HASH_OFFLOAD_BYTES = 256 * 1024
+# What a 304 repeats from the full response (RFC 9110 15.4.5)
+NOT_MODIFIED_HEADERS = ("etag", "cache-control", "vary", "content-location", "expires")
+
+ValidatorKey = tuple[str, str, str, str]
+
+
+def strong_etag(content: bytes) -> str:
+    return f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of ``etag`` against an If-None-Match list, as the header requires."""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def not_modified(headers: dict[str, str]) -> Response:
+    return Response(
+        status_code=304,
+        headers={name: headers[name] for name in NOT_MODIFIED_HEADERS if name in headers},
+    )
+
+
+@dataclass
+class Validated:
+    etag: str               # upstream's ETag, sent back as If-None-Match
+    headers: dict[str, str]  # as sent to the client
+    body: bytes
+
+
+class ConditionalRequests:
+    """ETag computation, client 304s and the upstream validator store."""
+
+    def __init__(
+        self,
+        routes: str = CONDITIONAL_ROUTES,
+        enabled: bool = ETAG_ENABLED,
+        max_entries: int = CONDITIONAL_MAX_ENTRIES,
+        max_bytes: int = CONDITIONAL_MAX_BYTES,
+        max_entry_bytes: int = CONDITIONAL_MAX_ENTRY_BYTES,
+    ):
+        self.enabled = enabled
+        self.routes = routes
+        self._routes = re.compile(routes) if routes else None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: OrderedDict[ValidatorKey, Validated] = OrderedDict()
+        self._bytes = 0
+        self.computed = 0
+        self.not_modified = 0
+        self.revalidated = 0
+        self.changed = 0
+
+    def revalidates(self, method: str, path: str) -> bool:
+        """Whether ``path`` is a polled route whose last response is kept for revalidation."""
+        return self.enabled and self._routes is not None and method == "GET" and bool(self._routes.fullmatch(path))
+
+    async def tag(self, status_code: int, headers: dict[str, str], content: bytes):
+        """Give a buffered 200 JSON response a strong ETag if it has none; updates ``headers``."""
+        if not self.enabled or status_code != 200 or "etag" in headers:
+            return
+        if "json" not in headers.get("content-type", ""):
+            return
+        if len(content) > HASH_OFFLOAD_BYTES:
+            headers["etag"] = await asyncio.to_thread(strong_etag, content)
+        else:
+            headers["etag"] = strong_etag(content)
+        self.computed += 1
+
+    def is_current(self, if_none_match: str | None, status_code: int, headers: dict[str, str]) -> bool:
+        """Whether the client's If-None-Match already names this response; counts the 304 if so."""
+        if not self.enabled or not if_none_match or status_code != 200:
+            return False
+        etag = headers.get("etag")
+        if etag is None or not etag_matches(if_none_match, etag):
+            return False
+        self.not_modified += 1
+        return True
+
+    def get(self, key: ValidatorKey) -> Validated | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: ValidatorKey, etag: str | None, status_code: int, headers: dict[str, str], body: bytes):
+        """Keep a 200 response with an upstream ETag for the next poll; drop the old copy otherwise."""
+        self._remove(key)
+        if status_code != 200 or not etag or len(body) > self.max_entry_bytes:
+            return
+        if "no-store" in headers.get("cache-control", "").lower():
+            return
+        self._entries[key] = Validated(etag, headers, body)
+        self._bytes += len(body)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: ValidatorKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "routes": self.routes,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "etags_computed": self.computed,
+            "not_modified": self.not_modified,
+            "upstream_revalidated": self.revalidated,
+            "upstream_changed": self.changed,
+        }
+
+
+# Global ETag/validator state used by the catch-all route
+conditional = ConditionalRequests()
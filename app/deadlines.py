@@ -0,0 +1,198 @@
+"""Per-route upstream timeouts, client deadlines and cancellation on disconnect.
+
+Each request gets a ``Deadline`` for its upstream response headers. The
+deadline covers every attempt, retry and hedge. It comes from the first
+``TimeoutPolicy`` matching the route: a few seconds for the small GETs the
+front ends make on startup, minutes for ``chat/async`` and sync source
+uploads, ``UPSTREAM_TIMEOUT_DEFAULT`` for everything else. A client can
+shorten it, never lengthen it, by sending its remaining budget in
+milliseconds in ``X-Request-Timeout-Ms`` (``DEADLINE_HEADER``). Whatever is
+left is forwarded to platform-api in the same header, and httpx's per-request
+timeouts are cut to fit. A request whose deadline passes gets 504 and its
+upstream call is cancelled.
+
+Once the request body has been read, the proxy watches for the client going
+away while it waits on upstream. A disconnect cancels the upstream call at
+once, which closes the connection, frees the pool slot and tells
+platform-api to stop. ``RelayResponse`` closes the upstream response when the
+client disconnects in the middle of a streamed body.
+"""
+
+import asyncio
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Awaitable, TypeVar
+
+import httpx
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from app.config import env_float
+from app.upstream import UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_POOL_TIMEOUT, UPSTREAM_READ_TIMEOUT
+
+
+DEADLINE_HEADER = os.getenv("DEADLINE_HEADER", "X-Request-Timeout-Ms")
+# Seconds until upstream response headers, retries included
+UPSTREAM_TIMEOUT_DEFAULT = env_float("UPSTREAM_TIMEOUT_DEFAULT", UPSTREAM_READ_TIMEOUT)
+UPSTREAM_TIMEOUT_FAST = env_float("UPSTREAM_TIMEOUT_FAST", 5.0)
+UPSTREAM_TIMEOUT_CHAT = env_float("UPSTREAM_TIMEOUT_CHAT", 120.0)
+UPSTREAM_TIMEOUT_UPLOAD = env_float("UPSTREAM_TIMEOUT_UPLOAD", 300.0)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class TimeoutPolicy:
+    pattern: str            # regex, full-matched against the path (after the v1/ strip)
+    timeout: float          # seconds
+    methods: frozenset = frozenset()  # empty: all methods
+
+
+def default_timeout_policies() -> list[TimeoutPolicy]:
+    return [
+        TimeoutPolicy(
+            r"prompts|organizations/me|user/current-(?:user|token)|user/membership/.+|user/storyplan-config/.+",
+            UPSTREAM_TIMEOUT_FAST,
+            frozenset({"GET"}),
+        ),
+        TimeoutPolicy(r"(?:.+/)?chat/async", UPSTREAM_TIMEOUT_CHAT, frozenset({"POST"})),
+        TimeoutPolicy(r"sources/upload-source(?:/.*)?", UPSTREAM_TIMEOUT_UPLOAD, frozenset({"POST"})),
+    ]
+
+
+class Deadline:
+    """When the upstream response headers must have arrived."""
+
+    __slots__ = ("timeout", "expires", "client")
+
+    def __init__(self, timeout: float, client: bool = False):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+        self.client = client  # set by the client's header rather than the route policy
+
+    def remaining(self) -> float:
+        return max(self.expires - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def header_value(self) -> str:
+        return str(int(self.remaining() * 1000))
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        """Per-request httpx timeouts that fit in what is left; reads use the whole remainder."""
+        remaining = max(self.remaining(), 0.001)
+        return httpx.Timeout(
+            connect=min(UPSTREAM_CONNECT_TIMEOUT, remaining),
+            read=remaining,
+            write=remaining,
+            pool=min(UPSTREAM_POOL_TIMEOUT, remaining),
+        )
+
+
+class TimeoutPolicies:
+    """Route timeout table plus timeout and disconnect counters."""
+
+    def __init__(self, policies: list[TimeoutPolicy], default: float = UPSTREAM_TIMEOUT_DEFAULT):
+        self.policies = policies
+        self.default = default
+        self._patterns = [re.compile(policy.pattern) for policy in policies]
+        self.client_deadlines = 0
+        self.timed_out = 0
+        self.disconnected = 0
+
+    def timeout_for(self, method: str, path: str) -> float:
+        for policy, pattern in zip(self.policies, self._patterns):
+            if (not policy.methods or method in policy.methods) and pattern.fullmatch(path):
+                return policy.timeout
+        return self.default
+
+    def deadline(self, method: str, path: str, client_ms: str | None = None) -> Deadline:
+        """The route's deadline, or the client's if that is sooner."""
+        timeout = self.timeout_for(method, path)
+        if client_ms:
+            try:
+                requested = max(float(client_ms), 0.0) / 1000
+            except ValueError:
+                requested = None
+            if requested is not None and requested < timeout:
+                self.client_deadlines += 1
+                return Deadline(requested, client=True)
+        return Deadline(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "default": self.default,
+            "policies": [
+                {"pattern": p.pattern, "timeout": p.timeout, "methods": sorted(p.methods)} for p in self.policies
+            ],
+            "client_deadlines": self.client_deadlines,
+            "timed_out": self.timed_out,
+            "disconnected": self.disconnected,
+        }
+
+
+class ClientDisconnected(Exception):
+    """The client went away while the proxy was waiting on upstream."""
+
+
+async def wait_for_disconnect(receive: Receive):
+    """Return once the client disconnects. Only call after the request body has been read."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def unless_disconnected(awaitable: Awaitable[T], receive: Receive) -> T:
+    """Await ``awaitable``, cancelling it and raising ``ClientDisconnected`` if the client leaves first."""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    raise ClientDisconnected()
+
+
+class RelayResponse(StreamingResponse):
+    """StreamingResponse whose background task runs even when the client disconnects mid-body.
+
+    Starlette skips the background task when a send fails, which would leave
+    the upstream response open and the request never logged.
+    """
+
+    completed = False
+
+    async def stream_response(self, send: Send):
+        await super().stream_response(send)
+        self.completed = True
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        background, self.background = self.background, None
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if background is not None:
+                await background()
+
+    @property
+    def client_disconnected(self) -> bool:
+        return not self.completed
+
+
+# Global timeout table used by the proxy routes
+timeouts = TimeoutPolicies(default_timeout_policies())
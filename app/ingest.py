@@ -0,0 +1,332 @@
+"""Startup ingestion of a directory of source documents.
+
+Every file in ``SOURCES_DIR`` (by default just the bundled sample) is hashed,
+and the source ID is derived from the SHA-256 of its content. A persisted
+manifest maps content hashes to upload results. A file whose hash is already
+in the manifest is registered from it, without being uploaded or embedded
+again, so restarts and extra workers cost nothing. The remaining files are
+uploaded concurrently, at most ``SOURCE_INGEST_CONCURRENCY`` at a time.
+Failed uploads are retried with exponential backoff and full jitter.
+
+Ingestion is ``idle`` until started, ``running`` while files are pending,
+and ``ready`` once every file is registered or has given up. ``chat/async``
+waits briefly for readiness so the first requests after a start still get
+their sources.
+
+With several worker processes, only the worker holding the leader lock
+ingests. The others follow: they report ``running`` until the leader's status
+file says it is done. They are woken by a notification, with a slow poll as
+fallback. If the leader dies first, a follower takes the lock and ingests
+instead.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import httpx
+
+from app.config import env_float, env_int
+from app.source_registry import SHARED, SourceRegistry, record_from_upload
+from app.workers import FileLock, atomic_write
+
+
+SOURCES_DIR = os.getenv("SOURCES_DIR", "")
+SOURCE_MANIFEST_FILE = Path(os.getenv("SOURCE_MANIFEST_FILE", "/app/source_manifest.json"))
+SOURCE_INGEST_CONCURRENCY = env_int("SOURCE_INGEST_CONCURRENCY", 4)
+SOURCE_INGEST_MAX_ATTEMPTS = env_int("SOURCE_INGEST_MAX_ATTEMPTS", 30)
+# Backoff before retry n is uniform in [0, min(max, base * 2**n)) seconds
+SOURCE_INGEST_BACKOFF = env_float("SOURCE_INGEST_BACKOFF", 0.5)
+SOURCE_INGEST_MAX_BACKOFF = env_float("SOURCE_INGEST_MAX_BACKOFF", 30.0)
+# How long chat/async waits for a running ingestion before injecting what is there
+SOURCE_READY_TIMEOUT = env_float("SOURCE_READY_TIMEOUT", 10.0)
+# How often a follower worker re-checks the leader's status without a notification
+SOURCE_FOLLOW_POLL_SECONDS = env_float("SOURCE_FOLLOW_POLL_SECONDS", 2.0)
+
+IDLE, RUNNING, READY = "idle", "running", "ready"
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    path: Path
+    digest: str    # sha256 of the content
+    content: str
+
+    @property
+    def source_id(self) -> str:
+        # Content-addressed: the same bytes always get the same ID
+        return str(uuid.UUID(hex=self.digest[:32]))
+
+    @property
+    def filename(self) -> str:
+        return self.path.name
+
+    @property
+    def title(self) -> str:
+        for line in self.content.splitlines():
+            if line.strip():
+                return line.strip()[:200]
+        return self.path.stem
+
+
+Upload = Callable[[SourceFile], Awaitable[dict]]
+
+
+def source_paths(directory: str, default: Path) -> list[Path]:
+    """Regular, non-hidden files in ``directory``; ``[default]`` when it is unset."""
+    if not directory:
+        return [default]
+    try:
+        return sorted(p for p in Path(directory).iterdir() if p.is_file() and not p.name.startswith("."))
+    except FileNotFoundError:
+        logging.error(f"SOURCES_DIR not found: {directory}")
+        return []
+
+
+def read_source(path: Path) -> SourceFile:
+    """Blocking; call through ``asyncio.to_thread``. Raises UnicodeDecodeError for non-UTF-8 files."""
+    data = path.read_bytes()
+    return SourceFile(path, hashlib.sha256(data).hexdigest(), data.decode("utf-8"))
+
+
+def retryable(error: BaseException) -> bool:
+    """Client errors other than 408/429 will not succeed on retry."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+class SourceIngestor:
+    """Uploads new or changed source files and registers them as shared sources."""
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        upload: Upload,
+        manifest_path: Path = SOURCE_MANIFEST_FILE,
+        status_path: Path | None = None,
+        concurrency: int = SOURCE_INGEST_CONCURRENCY,
+        max_attempts: int = SOURCE_INGEST_MAX_ATTEMPTS,
+        backoff: float = SOURCE_INGEST_BACKOFF,
+        max_backoff: float = SOURCE_INGEST_MAX_BACKOFF,
+    ):
+        self.registry = registry
+        self.upload = upload
+        self.manifest_path = manifest_path
+        # Shared with follower workers: {"state", "token"} of the leader's run
+        self.status_path = status_path
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = IDLE
+        self.role = "leader"
+        self._token = ""
+        self._ready = asyncio.Event()
+        self._poke = asyncio.Event()
+        # Called after the shared status changed, e.g. to notify follower workers
+        self.on_change: Callable[[], None] | None = None
+        self._manifest: dict[str, dict] = {}
+        self._manifest_lock = asyncio.Lock()
+        self.files = 0
+        self.skipped = 0
+        self.not_text = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.attempts = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        """Wait for a running ingestion to finish; returns immediately otherwise."""
+        if self.state != RUNNING:
+            return self.ready
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.ready
+
+    # Manifest ----------------------------------------------------------------
+
+    def load_manifest(self) -> dict[str, dict]:
+        """Blocking; a missing or unreadable manifest just means every file is uploaded again."""
+        try:
+            return json.loads(self.manifest_path.read_bytes())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"Error reading source manifest {self.manifest_path}: {e}")
+            return {}
+
+    async def _record(self, source: SourceFile, upload_response: dict):
+        self._manifest[source.digest] = {
+            "source_id": source.source_id,
+            "filename": source.filename,
+            "upload_response": upload_response,
+            "uploaded_at": time.time(),
+        }
+        data = json.dumps(self._manifest, separators=(",", ":")).encode()
+        async with self._manifest_lock:
+            try:
+                await asyncio.to_thread(atomic_write, self.manifest_path, data)
+            except OSError as e:
+                logging.error(f"Error writing source manifest {self.manifest_path}: {e}")
+
+    # Leader election ---------------------------------------------------------
+
+    async def lead_or_follow(self, paths: list[Path], lock: FileLock, poll: float | None = None):
+        """Ingest if this process wins ``lock``, otherwise follow the worker that did."""
+        self.state = RUNNING
+        self._ready.clear()
+        poll = SOURCE_FOLLOW_POLL_SECONDS if poll is None else poll
+        while True:
+            token = uuid.uuid4().hex
+            if await asyncio.to_thread(self._try_lead, lock, token):
+                self.role = "leader"
+                self._token = token
+                await self.run(paths)
+                return
+            self.role = "follower"
+            if await asyncio.to_thread(self._leader_ready, lock):
+                self._finish()
+                logging.info("Source ingestion done by the leader worker")
+                return
+            self._poke.clear()
+            try:
+                await asyncio.wait_for(self._poke.wait(), poll)
+            except asyncio.TimeoutError:
+                pass
+
+    def poke(self):
+        """The leader's status may have changed; a follower re-checks it at once."""
+        self._poke.set()
+
+    @staticmethod
+    def _try_lead(lock: FileLock, token: str) -> bool:
+        # The token in the lock file ties the status file to this leader's run
+        return lock.acquire(blocking=False, content=f"{os.getpid()} {token}\n")
+
+    def _leader_ready(self, lock: FileLock) -> bool:
+        """Blocking: whether the current leader's status file says it is done."""
+        if self.status_path is None:
+            return False
+        try:
+            token = lock.path.read_text().split()[-1]
+            status = json.loads(self.status_path.read_bytes())
+        except (OSError, ValueError, IndexError):
+            return False
+        return status.get("token") == token and status.get("state") == READY
+
+    async def _publish(self, state: str):
+        if self.status_path is None:
+            return
+        data = json.dumps({"state": state, "token": self._token, "pid": os.getpid()}).encode()
+        try:
+            await asyncio.to_thread(atomic_write, self.status_path, data)
+        except OSError as e:
+            logging.error(f"Error writing ingestion status {self.status_path}: {e}")
+            return
+        if self.on_change is not None:
+            self.on_change()
+
+    def _finish(self):
+        self.state = READY
+        self._ready.set()
+
+    # Ingestion ---------------------------------------------------------------
+
+    async def run(self, paths: list[Path]):
+        """Ingest ``paths`` and mark ingestion ready, whatever the outcome."""
+        self.state = RUNNING
+        self._ready.clear()
+        await self._publish(RUNNING)
+        try:
+            self._manifest = await asyncio.to_thread(self.load_manifest)
+            self.files = len(paths)
+            semaphore = asyncio.Semaphore(max(self.concurrency, 1))
+
+            async def bounded(path: Path):
+                async with semaphore:
+                    await self.ingest(path)
+
+            await asyncio.gather(*(bounded(path) for path in paths))
+            logging.info(
+                f"Source ingestion done: {self.uploaded} uploaded, {self.skipped} unchanged, {self.failed} failed"
+            )
+        finally:
+            self._finish()
+            await self._publish(READY)
+
+    async def ingest(self, path: Path):
+        try:
+            source = await asyncio.to_thread(read_source, path)
+        except OSError as e:
+            logging.error(f"Cannot read source file {path}: {e}")
+            self.failed += 1
+            return
+        except UnicodeDecodeError as e:
+            # Uploaded as text, a binary file would be mangled under the hash of the original bytes
+            logging.warning(f"Skipping source file {path}: not UTF-8 text ({e.reason} at byte {e.start})")
+            self.not_text += 1
+            return
+
+        known = self._manifest.get(source.digest)
+        if known is not None:
+            self.skipped += 1
+            if self.registry.get(known["source_id"]) is None:
+                await self._register(known, known.get("uploaded_at"))
+            return
+
+        upload_response = await self._upload_with_retries(source)
+        if upload_response is None:
+            self.failed += 1
+            return
+        self.uploaded += 1
+        await self._record(source, upload_response)
+        await self._register(self._manifest[source.digest], None)
+        logging.info(f"Source uploaded successfully. ID: {source.source_id} ({source.filename})")
+
+    async def _register(self, entry: dict, registered_at: float | None):
+        record = record_from_upload(entry, SHARED, registered_at)
+        if record is not None:
+            await self.registry.update(lambda: self.registry.register(record))
+
+    async def _upload_with_retries(self, source: SourceFile) -> dict | None:
+        for attempt in range(self.max_attempts):
+            self.attempts += 1
+            try:
+                return await self.upload(source)
+            except Exception as e:
+                if not retryable(e) or attempt + 1 == self.max_attempts:
+                    logging.error(f"Source upload of {source.filename} failed after {attempt + 1} attempts: {e}")
+                    return None
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logging.warning(
+                    f"Source upload of {source.filename} attempt {attempt + 1} failed: {e}; retrying in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "role": self.role,
+            "files": self.files,
+            "skipped": self.skipped,
+            "not_text": self.not_text,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "attempts": self.attempts,
+        }
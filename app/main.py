@@ -1,18 +1,72 @@
 import os
+import hmac
 import logging
 import asyncio
 from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request, Response, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import httpx
-import json
 from datetime import datetime
-import uuid
+import math
+import time
 
+from app import codec
+from app.admission import Overloaded, RateLimited, admission, rate_limiter
+from app.balancer import Upstream, UpstreamPool, upstream_urls
+from app.batch import BATCH_MAX_REQUESTS, BatchRequest, BatchRun, inherited_headers
+from app.bodies import (
+    RequestBodyTooLarge,
+    check_declared_length,
+    has_body,
+    read_request_body,
+    stream_request_body,
+)
+from app.capture import traffic_capture
+from app.coalesce import IDEMPOTENT_METHODS, Flight, coalescer
+from app.compression import compression
+from app.conditional import conditional, not_modified
+from app.deadlines import (
+    DEADLINE_HEADER,
+    ClientDisconnected,
+    Deadline,
+    RelayResponse,
+    timeouts,
+    unless_disconnected,
+)
+from app.ingest import IDLE, RUNNING, SOURCE_READY_TIMEOUT, SOURCES_DIR, SourceFile, SourceIngestor, source_paths
+from app.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, UpstreamTiming, metrics
+from app.request_log import (
+    BodySample,
+    log_request,
+    redact_headers,
+    setup_logging,
+    should_sample,
+)
+from app.resilience import CircuitOpen, resilience
+from app.response_cache import STALE, WRITE_METHODS, response_cache
+from app.source_registry import SOURCE_USER_ORGS, SourceRecord, SourceRegistry, owner_key, parse_user_orgs
+from app.stories import (
+    PipelinedResponse,
+    StoryBulkRun,
+    StoryPayload,
+    is_ndjson,
+    parse_story_array,
+    parse_story_lines,
+    story_items,
+)
+from app.tracing import SERVER_TIMING_ENABLED, RequestTiming, request_id, span_exporter
+from app.transformers import TransformContext, apply_transformers, transformers
+from app.upstream import create_upstream_client, pool_stats, relay_response_headers
+from app.workers import WORKER_STATE_DIR, ChangeNotifier, FileLock
+from app.ws_fanout import WS_FANOUT_ENABLED, fanout, hub as ws_hub
+from app.ws_relay import relay, upstream_ws_url
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+
+# Setup logging (queued, structured JSON; see app/request_log.py)
+setup_logging()
 
 # Get the API URL and other variables from environment variables
 FORWARD_URL = os.getenv(
@@ -25,24 +79,29 @@ X_API_KEY = os.getenv(
     "API_KEY", "your-default-api-key"
 )  # Replace with your API key or environment variable
 USER_ID = "1"  # Hardcoded user ID
+# Required in X-Admin-Key by the /internal/sources routes; unset, they are disabled
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+
+# platform-api instances to balance across: API_URLS (comma-separated), else API_URL
+upstreams = UpstreamPool(upstream_urls(FORWARD_URL))
 
-# Path to persisted source ID
-SOURCE_ID_FILE = Path("/app/source_id.json")
+# Persisted source registry; SOURCE_ID_FILE is the legacy single-source file, imported once
+SOURCE_REGISTRY_FILE = Path(os.getenv("SOURCE_REGISTRY_FILE", "/app/sources.json"))
+SOURCE_ID_FILE = Path(os.getenv("SOURCE_ID_FILE", "/app/source_id.json"))
 SAMPLE_SOURCE_FILE = Path(__file__).parent / "sample_source.txt"
 
+# Sources indexed per user/org in memory; reloaded only when SOURCE_REGISTRY_FILE changes
+source_registry = SourceRegistry(SOURCE_REGISTRY_FILE, legacy_path=SOURCE_ID_FILE)
+# Each user's org, as configured by the operator (clients cannot claim one)
+USER_ORGS = parse_user_orgs(SOURCE_USER_ORGS)
 
-async def upload_sample_source():
-    """Upload the sample source document to platform-api on startup."""
-    source_id = str(uuid.uuid4())
-    filename = "sample_source.txt"
+# Lock files, notification sockets and the ingestion status shared by uvicorn workers
+WORKER_STATE_PATH = Path(WORKER_STATE_DIR) if WORKER_STATE_DIR else SOURCE_REGISTRY_FILE.parent / ".proxy-workers"
 
-    try:
-        content = SAMPLE_SOURCE_FILE.read_text()
-    except FileNotFoundError:
-        logging.error(f"Sample source file not found: {SAMPLE_SOURCE_FILE}")
-        return
 
-    upload_url = f"{FORWARD_URL}/sources/upload-source/sync"
+async def upload_source(source: SourceFile) -> dict:
+    """Upload one source document to platform-api; raises on failure (retried by the ingestor)."""
+    client = app.state.http_client
     headers = {
         "X-API-Key": X_API_KEY,
         "X-User-ID": USER_ID,
@@ -50,95 +109,145 @@ async def upload_sample_source():
         "Content-Type": "application/json",
     }
     payload = {
-        "source-id": source_id,
-        "filename": filename,
+        "source-id": source.source_id,
+        "filename": source.filename,
         "data": {
             "meta": {
-                "title": "Renewable Energy: A Comprehensive Overview",
-                "filename": filename,
+                "title": source.title,
+                "filename": source.filename,
             },
-            "content": content,
+            "content": source.content,
         },
         "generate-embedding": True,
     }
 
-    # Retry with backoff until platform-api is ready
-    for attempt in range(30):
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(upload_url, json=payload, headers=headers)
-
-            if response.status_code == 200:
-                result = response.json()
-                source_data = {
-                    "source_id": source_id,
-                    "filename": filename,
-                    "upload_response": result,
-                }
-                SOURCE_ID_FILE.write_text(json.dumps(source_data, indent=2))
-                logging.info(f"Source uploaded successfully. ID: {source_id}")
-                logging.info(f"Source data written to {SOURCE_ID_FILE}")
-                return
-            else:
-                logging.warning(
-                    f"Source upload attempt {attempt + 1} failed ({response.status_code}): {response.text}"
-                )
-        except Exception as e:
-            logging.warning(f"Source upload attempt {attempt + 1} error: {e}")
+    target = upstreams.pick()
+    upstreams.begin(target)
+    try:
+        # Sync uploads wait for embedding, so they get the upload route's long timeout
+        response = await client.post(
+            f"{target.url}/sources/upload-source/sync",
+            json=payload,
+            headers=headers,
+            timeout=timeouts.deadline("POST", "sources/upload-source/sync").httpx_timeout(),
+        )
+    except Exception as e:
+        upstreams.end(target, error=e)
+        raise
+    upstreams.end(target, response.status_code)
+    response.raise_for_status()
+    return response.json()
 
-        await asyncio.sleep(2)
 
-    logging.error("Failed to upload sample source after 30 attempts")
+# Uploads SOURCES_DIR (or the bundled sample) at startup, skipping unchanged content;
+# with several workers only the one holding the leader lock does
+ingestion = SourceIngestor(source_registry, upload_source, status_path=WORKER_STATE_PATH / "ingestion.json")
+leader_lock = FileLock(WORKER_STATE_PATH / "leader.lock")
 
+# Reloads triggered by worker notifications
+_tasks: set[asyncio.Task] = set()
 
-def get_source_for_injection() -> list[dict] | None:
-    """Read the persisted source ID and return injection payload.
+
+def on_worker_message(topic: str):
+    """Another worker changed shared state."""
+    if topic == "sources":
+        task = asyncio.create_task(source_registry.reload())
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    elif topic == "ingestion":
+        ingestion.poke()
+
+
+notifier = ChangeNotifier(WORKER_STATE_PATH, on_worker_message)
+
+
+def get_source_for_injection(user_id: str | None) -> list[dict] | None:
+    """Return the newest sources of the user, their org and the shared ones, from memory.
 
     Capitol-llm validates that each entry has exactly {"download_url", "filename"}.
     """
-    try:
-        if not SOURCE_ID_FILE.exists():
-            return None
-
-        source_data = json.loads(SOURCE_ID_FILE.read_text())
-        filename = source_data["filename"]
-
-        # Get the embedded parquet URL from the upload response
-        upload_response = source_data.get("upload_response", {})
-        download_url = upload_response.get("download_url") or upload_response.get("embedded_file_url", "")
-
-        if not download_url:
-            logging.warning("No download_url found in source data, skipping injection")
-            return None
-
-        # Capitol-llm expects exactly {download_url, filename} — no extra keys
-        # Use the parquet filename from the URL (matches production pattern)
-        parquet_filename = download_url.split("/")[-1] if "/" in download_url else filename
-        return [{
-            "download_url": download_url,
-            "filename": parquet_filename,
-        }]
-    except Exception as e:
-        logging.error(f"Error reading source ID file: {e}")
+    return source_registry.lookup(user_id, USER_ORGS.get(user_id) if user_id else None)
+
+
+@transformers.request(r"(?:.+/)?chat/async", methods=["POST"])
+def inject_sources(body: dict, ctx: TransformContext) -> dict | None:
+    """Inject the uploaded source documents into chat/async requests."""
+    sources = get_source_for_injection(ctx.user_id)
+    if ingestion.state != IDLE:
+        ctx.notes["sources_ready"] = ingestion.ready
+    if not sources:
+        ctx.notes["sources_injected"] = 0
         return None
 
+    if "user-config-params" not in body:
+        body["user-config-params"] = {}
+
+    body["user-config-params"]["user_pre_processed_sources"] = sources
+    ctx.notes["sources_injected"] = len(sources)
+    return body
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Upload sample source on startup."""
-    logging.info("Starting source upload...")
-    asyncio.create_task(upload_sample_source())
-    yield
+    """Create the shared upstream client and ingest source documents on startup."""
+    client = create_upstream_client()
+    app.state.http_client = client
 
+    # Load the source registry off the event loop, then keep it in sync with the file
+    await asyncio.to_thread(source_registry.refresh)
+    watch_task = asyncio.create_task(source_registry.watch())
 
-app = FastAPI(lifespan=lifespan)
+    # Hear about registry/ingestion changes made by other workers as they happen
+    peers_task = None
+    try:
+        await notifier.start()
+        source_registry.on_change = lambda: notifier.notify("sources")
+        ingestion.on_change = lambda: notifier.notify("ingestion")
+        peers_task = asyncio.create_task(notifier.watch())
+    except OSError as e:
+        logging.warning(f"Worker notifications unavailable, relying on polling: {e}")
+
+    # Probe every platform-api instance so dead ones are skipped before a request fails
+    health_task = None
+    if len(upstreams) > 1:
+        health_task = asyncio.create_task(upstreams.run_health_checks(client))
+
+    # Batch-export sampled request spans, when a trace file or collector is configured
+    export_task = None
+    if span_exporter.enabled:
+        export_task = asyncio.create_task(span_exporter.run())
 
+    # Write captured traffic for replay, when capture is on
+    capture_task = None
+    if traffic_capture.enabled:
+        capture_task = asyncio.create_task(traffic_capture.run())
+
+    logging.info("Starting source ingestion...")
+    upload_task = asyncio.create_task(
+        ingestion.lead_or_follow(source_paths(SOURCES_DIR, SAMPLE_SOURCE_FILE), leader_lock)
+    )
+    try:
+        yield
+    finally:
+        upload_task.cancel()
+        if health_task is not None:
+            health_task.cancel()
+        watch_task.cancel()
+        if peers_task is not None:
+            peers_task.cancel()
+        if export_task is not None:
+            export_task.cancel()
+            await asyncio.gather(export_task, return_exceptions=True)  # final flush
+        if capture_task is not None:
+            capture_task.cancel()
+            await asyncio.gather(capture_task, return_exceptions=True)  # final flush
+        notifier.close()
+        leader_lock.release()
+        await client.aclose()
+        logging.info("Upstream client closed")
 
-# Define the request model for the specific POST request
-class StoryPayload(BaseModel):
-    story_id: str
-    user_config_params: dict
-    story_plan_config_id: str
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Helper function to add required headers
@@ -169,118 +278,820 @@ def add_custom_headers(original_content_type=None, incoming_headers=None):
     return headers
 
 
-# POST endpoint for forwarding the specific payload
-@app.post("/forward-story")
-async def forward_story(payload: StoryPayload):
-    headers = add_custom_headers()  # Add custom headers
+# Hit/miss/reload counters and size of the in-memory source registry
+@app.get("/internal/source-cache")
+async def source_cache_stats():
+    return source_registry.stats()
+
+
+# Startup ingestion progress: state, uploaded/unchanged/failed files
+@app.get("/internal/ingestion")
+async def ingestion_stats():
+    return {**ingestion.stats(), "workers": notifier.stats()}
+
+
+# Readiness probe: 503 while startup source ingestion is still running
+@app.get("/ready")
+async def ready():
+    if ingestion.state == RUNNING:
+        return JSONResponse({"ready": False, **ingestion.stats()}, status_code=503)
+    return {"ready": True}
+
+
+class SourceRegistration(BaseModel):
+    source_id: str
+    download_url: str
+    filename: str | None = None
+    user_id: str | None = None  # neither user nor org: shared by everyone
+    org_id: str | None = None
+
+
+def admin_denied(request: Request) -> JSONResponse | None:
+    """The error response for a request without the admin key, else None."""
+    if not ADMIN_API_KEY:
+        return JSONResponse({"detail": "Source administration is disabled (ADMIN_API_KEY unset)"}, status_code=403)
+    given = request.headers.get("x-admin-key", "")
+    if not hmac.compare_digest(given.encode(), ADMIN_API_KEY.encode()):
+        return JSONResponse({"detail": "Invalid or missing X-Admin-Key"}, status_code=401)
+    return None
+
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+# Sources that would be injected for a user/org (admin only: lists download URLs)
+@app.get("/internal/sources")
+async def list_sources(request: Request, user_id: str | None = None, org_id: str | None = None):
+    if (denied := admin_denied(request)) is not None:
+        return denied
+    return {"sources": source_registry.lookup(user_id, org_id or USER_ORGS.get(user_id or "")) or []}
+
+
+# Register an embedded source for a user, an org or everyone (admin only)
+@app.post("/internal/sources", status_code=201)
+async def register_source(source: SourceRegistration, request: Request):
+    if (denied := admin_denied(request)) is not None:
+        return denied
+    record = SourceRecord(
+        source_id=source.source_id,
+        owner=owner_key(source.user_id, source.org_id),
+        name=source.filename or source.source_id,
+        download_url=source.download_url,
+        registered_at=time.time(),
+    )
+    await source_registry.update(lambda: source_registry.register(record))
+    return {"source_id": record.source_id, "owner": record.owner}
+
+
+# Remove a source from the registry (admin only)
+@app.delete("/internal/sources/{source_id}", status_code=204)
+async def evict_source(source_id: str, request: Request):
+    if (denied := admin_denied(request)) is not None:
+        return denied
+    if not await source_registry.update(lambda: source_registry.evict(source_id)):
+        return JSONResponse({"detail": f"Unknown source {source_id}"}, status_code=404)
+    return Response(status_code=204)
+
+
+# Hit/miss/eviction counters for the per-user response cache
+@app.get("/internal/response-cache")
+async def response_cache_stats():
+    return response_cache.stats()
+
+
+# ETags computed, 304s sent and upstream revalidations of polled routes
+@app.get("/internal/conditional")
+async def conditional_stats():
+    return conditional.stats()
+
+
+# Traffic capture: sample rate, captured/dropped/failed records, ring rotations
+@app.get("/internal/capture")
+async def capture_stats():
+    return traffic_capture.stats()
+
+
+# In-flight/leader/follower counters for request coalescing
+@app.get("/internal/coalescing")
+async def coalescing_stats():
+    return coalescer.stats()
+
+
+# Shared WebSocket channels and their local subscriber counts
+@app.get("/internal/ws-channels")
+async def ws_channel_stats():
+    return ws_hub.stats()
+
+
+# Relayed/decoded/compressed response counts and compression ratio
+@app.get("/internal/compression")
+async def compression_stats():
+    return compression.stats()
+
+
+# Queued/exported/dropped counts of the span exporter
+@app.get("/internal/tracing")
+async def tracing_stats():
+    return span_exporter.stats()
+
+
+# Route timeout table and timeout/client-deadline/disconnect counters
+@app.get("/internal/timeouts")
+async def timeout_stats():
+    return timeouts.stats()
+
+
+# Per-instance load, health and ejection state of the upstream pool
+@app.get("/internal/upstreams")
+async def upstream_stats():
+    return upstreams.stats()
+
+
+# Circuit breaker states, retry budget and hedging counters
+@app.get("/internal/breakers")
+async def breaker_stats():
+    return resilience.stats()
+
+
+# In-flight/queue/shed counters and rate limit buckets
+@app.get("/internal/admission")
+async def admission_stats():
+    return {"admission": admission.stats(), "rate_limits": rate_limiter.stats()}
+
+
+# Prometheus scrape endpoint: per-route counters/histograms, in-flight and pool gauges
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    client = getattr(request.app.state, "http_client", None)
+    pool = pool_stats(client) if client is not None else None
+    return Response(content=metrics.render(pool), media_type=METRICS_CONTENT_TYPE)
+
+
+async def send_story(client: httpx.AsyncClient, payload: StoryPayload) -> httpx.Response:
+    """Forward one story over the shared pool; raises Overloaded when no admission slot is free."""
+    headers = add_custom_headers("application/json")  # Add custom headers
+
+    await admission.acquire()
+    target = upstreams.pick()
+    upstreams.begin(target)
+    try:
         response = await client.post(
-            url=FORWARD_URL,
-            json=payload.dict(),  # Forward the request payload as JSON
+            url=target.url,
+            content=payload.model_dump_json(),  # Forward the request payload as JSON
             headers=headers,  # Include the custom headers
+            timeout=timeouts.deadline("POST", "forward-story").httpx_timeout(),
         )
-        return Response(
-            content=response.text,
-            status_code=response.status_code,
-            headers=dict(response.headers),
+    except Exception as e:
+        upstreams.end(target, error=e)
+        raise
+    except BaseException:
+        upstreams.end(target)  # cancelled: the bulk client went away
+        raise
+    finally:
+        admission.release()
+    upstreams.end(target, response.status_code)
+    return response
+
+
+# POST endpoint for forwarding the specific payload
+@app.post("/forward-story")
+async def forward_story(payload: StoryPayload, request: Request):
+    try:
+        response = await send_story(request.app.state.http_client, payload)
+    except Overloaded as e:
+        return retry_later_response(f"Proxy overloaded: {e}", 503, 1)
+    # httpx has already decoded the body, so upstream's Content-Encoding no longer applies
+    headers = relay_response_headers(response.headers)
+    headers.pop("content-encoding", None)
+    return Response(content=response.content, status_code=response.status_code, headers=headers)
+
+
+# Many stories in one request: JSON array or NDJSON in, NDJSON status lines out
+@app.post("/forward-story/bulk")
+async def forward_story_bulk(request: Request):
+    try:
+        check_declared_length(request)
+        if is_ndjson(request.headers.get("content-type", "")):
+            items = parse_story_lines(stream_request_body(request))
+        else:
+            items = story_items(parse_story_array(await read_request_body(request)))
+    except RequestBodyTooLarge as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+
+    client = request.app.state.http_client
+    run = StoryBulkRun(lambda payload: send_story(client, payload))
+    return PipelinedResponse(run.stream(items), media_type="application/x-ndjson")
+
+
+async def read_upstream_response(
+    response: httpx.Response, response_transformers: list, ctx: TransformContext, accept_encoding: str
+) -> tuple[int, dict[str, str], bytes]:
+    """Buffer an upstream response for routes that cache or rewrite it.
+
+    Bodies are kept exactly as upstream encoded them, unless a response
+    transformer has to read the JSON or the client cannot decode them. The
+    result is encoded for the client, so cached copies are served as they are.
+    """
+    try:
+        headers = relay_response_headers(response.headers)
+        if response_transformers:
+            # Rewriting the body needs all of it, decoded
+            content = await response.aread()
+            headers.pop("content-encoding", None)
+            transformed = apply_transformers(response_transformers, content, ctx)
+            if transformed is not None:
+                content = transformed
+                headers.pop("etag", None)  # validator belonged to the original body
+        elif compression.must_decode(response.headers, accept_encoding):
+            content = await response.aread()
+            headers.pop("content-encoding", None)
+        else:
+            content = b"".join([chunk async for chunk in response.aiter_raw()])
+        content = await compression.compress_body(headers, content, accept_encoding)
+        await conditional.tag(response.status_code, headers, content)
+        return response.status_code, headers, content
+    finally:
+        await response.aclose()
+
+
+def rate_limit_key(request: Request) -> str:
+    """Whose buckets a request draws from: its X-User-ID, else its client address.
+
+    The demo front ends send no X-User-ID, so falling back to the default user
+    would put all their traffic into one user's buckets.
+    """
+    user_id = request.headers.get("x-user-id")
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def retry_later_response(detail: str, status_code: int, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        {"detail": detail},
+        status_code=status_code,
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+def gateway_timeout_response(deadline: Deadline) -> JSONResponse:
+    source = "client deadline" if deadline.client else "route timeout"
+    return JSONResponse({"detail": f"Upstream did not respond within the {deadline.timeout:g}s {source}"}, status_code=504)
+
+
+def bad_gateway_response(e: Exception) -> JSONResponse:
+    return JSONResponse({"detail": f"Upstream response failed: {e!r}"}, status_code=502)
+
+
+def circuit_open_response(e: CircuitOpen) -> JSONResponse:
+    """Fail fast while platform-api is known to be failing for this route."""
+    return retry_later_response(f"Upstream unavailable for {e.route}, circuit open", 503, e.retry_after)
+
+
+async def refresh_cached_response(
+    client: httpx.AsyncClient,
+    cache_key,
+    cache_policy,
+    path: str,
+    query_params: str,
+    route: str,
+    headers: dict[str, str],
+    response_transformers: list,
+    ctx: TransformContext,
+    accept_encoding: str,
+):
+    """Revalidate a stale cache entry in the background (stale-while-revalidate).
+
+    The refresh is an upstream call of its own: it gets a new request ID,
+    transform context and route deadline, and goes through the same
+    balancing, circuit breakers and retry budget as client requests.
+    """
+    refresh_id = request_id(None)
+    headers = {**headers, "X-Request-ID": refresh_id}
+    headers.pop("traceparent", None)
+    ctx = TransformContext(method="GET", path=path, headers=ctx.headers, stack_id=refresh_id, user_id=ctx.user_id)
+    deadline = timeouts.deadline("GET", path)
+
+    def build(upstream: Upstream) -> httpx.Request:
+        headers[DEADLINE_HEADER] = deadline.header_value()
+        return client.build_request(
+            "GET", f"{upstream.url}/{path}?{query_params}", headers=headers, timeout=deadline.httpx_timeout()
+        )
+
+    try:
+        response, target = await asyncio.wait_for(
+            resilience.send(client, upstreams, build, "GET", route, True), deadline.remaining()
+        )
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        timeouts.timed_out += 1
+        raise
+    try:
+        status_code, relayed, content = await read_upstream_response(
+            response, response_transformers, ctx, accept_encoding
+        )
+    except Exception as e:
+        upstreams.end(target, error=e)
+        raise
+    upstreams.end(target, response.status_code)
+    response_cache.put(cache_key, cache_policy, status_code, relayed, content)
+
+
+# Many proxied calls in one round trip; registered before the catch-all, which would match it too
+@app.post("/api/batch")
+async def batch(payload: BatchRequest, request: Request):
+    batch_id = request_id(request.headers.get("x-request-id"))
+    if len(payload.requests) > BATCH_MAX_REQUESTS:
+        return JSONResponse(
+            {"detail": f"Batch exceeds {BATCH_MAX_REQUESTS} requests"},
+            status_code=413,
+            headers={"X-Request-ID": batch_id},
+        )
+    client = (request.client.host, request.client.port) if request.client else ("127.0.0.1", 0)
+    run = BatchRun(request.app, payload.requests, inherited_headers(request.headers), batch_id, client)
+
+    if payload.stream or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            run.stream(), media_type="application/x-ndjson", headers={"X-Request-ID": batch_id}
         )
+    headers = {"content-type": "application/json", "X-Request-ID": batch_id}
+    content = codec.dumps({"responses": await run.results()})
+    content = await compression.compress_body(headers, content, request.headers.get("accept-encoding", "identity"))
+    return Response(content=content, headers=headers)
 
 
 # Catch-all route that forwards any request (with method, params, and body)
 @app.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def catch_all(request: Request, path: str):
 
-    stack_id = str(uuid.uuid4())
+    # Request ID shared with platform-api and the client; phase timings for Server-Timing and spans
+    stack_id = request_id(request.headers.get("x-request-id"))
+    timing = RequestTiming(stack_id, request.headers.get("traceparent"))
+    started = timing.started
 
     # Strip /v1/ prefix if present (React library adds it, but platform-api doesn't use it)
     if path.startswith("v1/"):
         path = path[3:]  # Remove "v1/"
 
-    # Construct the full URL to forward the request
-    forward_url = f"{FORWARD_URL}/{path}"
+    # Per-route metrics, labeled by the normalized route (IDs collapsed)
+    route = metrics.route(path)
+    upstream_timing = UpstreamTiming()
+    # httpx reports connection setup only to a trace hook, so hook it in only when used
+    trace_connections = metrics.enabled or SERVER_TIMING_ENABLED or timing.sampled
+    metrics.in_flight += 1
+
     # Extract query params
     query_params = request.url.query
     client_ip = request.client.host if request.client else "Unknown"
 
-    # Log the incoming request details for debugging
-    timestamp = datetime.now().isoformat()  # ISO 8601 timestamp
-    logging.info(f'Timestamp: {timestamp} Stack ID: {stack_id} Client IP: {client_ip} Forwarded URL: {forward_url}')
-    logging.info(f'Timestamp: {timestamp} Stack ID: {stack_id} Client IP: {client_ip} Incoming request: {request.method} {request.url}')
-    logging.info(f'Timestamp: {timestamp} Stack ID: {stack_id} Client IP: {client_ip} Headers: {dict(request.headers)}')
-    logging.info(f'Timestamp: {timestamp} Stack ID: {stack_id} Client IP: {client_ip} Query params: {query_params}')
+    # One structured log record per request, emitted when the response is done
+    sampled = should_sample()
+    log_fields = {
+        "stack_id": stack_id,
+        "timestamp": datetime.now().isoformat(),  # ISO 8601 timestamp
+        "client_ip": client_ip,
+        "method": request.method,
+        "path": path,
+        "query": query_params,
+    }
+    if sampled:
+        log_fields["headers"] = redact_headers(request.headers)
+    # Sampled requests are also recorded, with the body as the client sent it, for replay
+    capture_sample = BodySample(limit=traffic_capture.max_body_bytes) if traffic_capture.should_capture() else None
+
+    admitted = False
+
+    def stamp(response: Response) -> Response:
+        response.headers["X-Request-ID"] = stack_id
+        if SERVER_TIMING_ENABLED:
+            response.headers["Server-Timing"] = timing.server_timing(upstream_timing)
+        return response
 
+    def finish(status_code: int, request_sample: BodySample | None = None, response_sample: BodySample | None = None):
+        timing.finish(upstream_timing)
+        duration = timing.ended - started
+        metrics.in_flight -= 1
+        if admitted:
+            admission.release()
+        metrics.observe(
+            route,
+            request.method,
+            status_code,
+            duration,
+            request_sample.total if request_sample is not None else None,
+            response_sample.total if response_sample is not None else None,
+            upstream_timing,
+        )
+        log_fields["status"] = status_code
+        log_fields["duration_ms"] = round(duration * 1000, 2)
+        log_fields["timings_ms"] = timing.as_ms()
+        if timing.sampled:
+            span_exporter.submit(
+                timing,
+                f"{request.method} {route}",
+                {
+                    "http.request.method": request.method,
+                    "http.route": route,
+                    "url.path": path,
+                    "http.response.status_code": status_code,
+                    "http.request.id": stack_id,
+                },
+                error=status_code >= 500,
+            )
+        if request_sample is not None:
+            log_fields["request_bytes"] = request_sample.total
+            if sampled:
+                log_fields["request_body"] = request_sample.text()
+        if response_sample is not None:
+            log_fields["response_bytes"] = response_sample.total
+            if sampled:
+                log_fields["response_body"] = response_sample.text()
+        log_request(log_fields)
+        if capture_sample is not None:
+            traffic_capture.submit(
+                request.method,
+                request.url.path,
+                query_params,
+                request.headers,
+                b"".join(capture_sample.chunks),
+                capture_sample.total,
+                status_code,
+                duration,
+                stack_id,
+            )
 
     try:
-        body = await request.body()
-        logging.info(f"Body: {body.decode('utf-8')}")
-    except Exception as e:
-        logging.error(f"Error reading body: {e}")
+        check_declared_length(request)
+    except RequestBodyTooLarge as e:
+        finish(413)
+        return stamp(JSONResponse({"detail": str(e)}, status_code=413))
+
+    # Per-user/per-route token buckets, then the global in-flight limit
+    try:
+        rate_limiter.check(request.method, path, rate_limit_key(request))
+    except RateLimited as e:
+        log_fields["rate_limit"] = e.rule
+        finish(429)
+        return stamp(retry_later_response(str(e), 429, e.retry_after))
+
+    # The route's upstream timeout, or the client's own deadline if that is sooner
+    deadline = timeouts.deadline(request.method, path, request.headers.get(DEADLINE_HEADER))
+    admit_started = time.perf_counter()
+    try:
+        await admission.acquire()
+    except Overloaded as e:
+        finish(503)
+        return stamp(retry_later_response(f"Proxy overloaded: {e}", 503, 1))
+    admitted = True
+    timing.phase("admit", admit_started)
+    if deadline.expired:
+        timeouts.timed_out += 1
+        finish(504)
+        return stamp(gateway_timeout_response(deadline))
 
     # Get the original content type from the request
     original_content_type = request.headers.get("Content-Type")
     custom_headers = add_custom_headers(original_content_type, incoming_headers=request.headers)
+    log_fields["user_id"] = custom_headers["X-User-ID"]
 
     # Add X-Forwarded-Host for WebSocket address generation
     # This allows platform-api to return the correct external WebSocket URL
     custom_headers["X-Forwarded-Host"] = request.headers.get("host", "localhost:8000")
+    custom_headers["X-Request-ID"] = stack_id
+    traceparent = timing.traceparent(request.headers.get("traceparent"))
+    if traceparent is not None:
+        custom_headers["traceparent"] = traceparent
 
-    logging.info(f"****")
-    logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} Custom Headers: {dict(custom_headers)}")
+    # Forward the client's Content-Length so streamed bodies are not re-chunked
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        custom_headers["Content-Length"] = content_length
 
-    # Intercept /chat/async requests to inject source documents
-    modified_body = body
-    if path.endswith("chat/async") and request.method == "POST":
-        try:
-            body_json = json.loads(body.decode('utf-8'))
+    request_transformers, response_transformers = transformers.match(request.method, path)
+    ctx = TransformContext(
+        method=request.method,
+        path=path,
+        headers=request.headers,
+        stack_id=stack_id,
+        user_id=custom_headers["X-User-ID"],
+        notes=log_fields,
+    )
 
-            # Read source from file (uploaded on startup)
-            sources = get_source_for_injection()
+    # Ask upstream only for encodings the client understands, so compressed
+    # bodies can be relayed byte-for-byte without decoding them here. Bodies a
+    # transformer rewrites are fetched uncompressed and compressed once, after.
+    accept_encoding = request.headers.get("accept-encoding", "identity")
+    custom_headers["Accept-Encoding"] = "identity" if response_transformers else accept_encoding
+    client = request.app.state.http_client
 
-            if sources:
-                if "user-config-params" not in body_json:
-                    body_json["user-config-params"] = {}
+    # A client that already holds the current ETag gets a bodyless 304
+    if_none_match = request.headers.get("if-none-match") if request.method == "GET" else None
 
-                body_json["user-config-params"]["user_pre_processed_sources"] = sources
-                logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} Injected {len(sources)} pre-processed sources into chat/async request")
-                logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} Sources: {sources}")
+    def full_or_not_modified(status_code: int, headers: dict[str, str], content: bytes) -> Response:
+        if conditional.is_current(if_none_match, status_code, headers):
+            return not_modified(headers)
+        return Response(content=content, status_code=status_code, headers=headers)
 
-                modified_body = json.dumps(body_json).encode('utf-8')
-            else:
-                logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} No source ID file found, forwarding request without sources")
-        except Exception as e:
-            logging.error(f"Timestamp: {timestamp} Stack ID: {stack_id} Error injecting source documents: {e}")
-            # Continue with original body if there's an error
+    # Serve read-mostly GETs from the per-user response cache when possible
+    cache_policy = response_cache.policy_for(request.method, path)
+    cache_key = None
+    if cache_policy is not None:
+        cache_key = response_cache.key(
+            request.method, path, query_params, custom_headers["X-User-ID"], accept_encoding
+        )
+        entry, state = response_cache.get(cache_key)
+        if entry is not None:
+            if state == STALE:
+                refresh_headers = dict(custom_headers)
+                response_cache.refresh_in_background(
+                    cache_key,
+                    lambda: refresh_cached_response(
+                        client,
+                        cache_key,
+                        cache_policy,
+                        path,
+                        query_params,
+                        route,
+                        refresh_headers,
+                        response_transformers,
+                        ctx,
+                        accept_encoding,
+                    ),
+                )
+            log_fields["cache"] = state
+            cached = full_or_not_modified(entry.status_code, {**entry.headers, "X-Cache": state}, entry.body)
+            finish(cached.status_code)
+            return stamp(cached)
+        log_fields["cache"] = "MISS"
+
+    # Polled routes: ask upstream whether the last response is still current
+    # rather than fetching it again
+    validator_key = validated = None
+    if conditional.revalidates(request.method, path):
+        validator_key = (path, query_params, custom_headers["X-User-ID"], accept_encoding)
+        validated = conditional.get(validator_key)
+        if validated is not None:
+            custom_headers["If-None-Match"] = validated.etag
+    buffered = bool(response_transformers) or cache_key is not None or validator_key is not None
+
+    # Only bodies that get rewritten are buffered and parsed; everything else
+    # (including multipart uploads) is streamed straight to the upstream request
+    request_sample = BodySample(limit=None if sampled else 0)
+    if request_transformers:
+        read_started = time.perf_counter()
+        try:
+            body = await read_request_body(request)
+        except RequestBodyTooLarge as e:
+            finish(413)
+            return stamp(JSONResponse({"detail": str(e)}, status_code=413))
+        transform_started = time.perf_counter()
+        timing.phase("read", read_started, transform_started)
+        custom_headers.pop("Content-Length", None)
+        request_sample.feed(body)
+        if capture_sample is not None:
+            capture_sample.feed(body)
+        if inject_sources in request_transformers and not ingestion.ready:
+            # Just after startup: give ingestion a moment so the request gets its sources
+            await ingestion.wait_ready(SOURCE_READY_TIMEOUT)
+        modified_body = apply_transformers(request_transformers, body, ctx) or body
+        timing.phase("transform", transform_started)
+    elif has_body(request):
+        modified_body = request_sample.tap(stream_request_body(request))
+        if capture_sample is not None:
+            modified_body = capture_sample.tap(modified_body)
+    else:
+        modified_body = None
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.request(
+    def build_upstream_request(upstream: Upstream) -> httpx.Request:
+        upstream_timing.sending()
+        # Each attempt tells upstream, and httpx, how much of the deadline is left
+        custom_headers[DEADLINE_HEADER] = deadline.header_value()
+        return client.build_request(
             method=request.method,
-            url=f"{forward_url}?{query_params}",
+            url=f"{upstream.url}/{path}?{query_params}",
             headers=custom_headers,  # Add custom headers here
             content=modified_body,
+            timeout=deadline.httpx_timeout(),
+            extensions={"trace": upstream_timing.trace} if trace_connections else None,
         )
 
-    # Log the response for debugging
-    logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} Forwarded response status: {response.status_code}")
-    logging.info(f"Timestamp: {timestamp} Stack ID: {stack_id} Response content: {response.text}")
+    # A streamed body is still being read by the upstream send, so disconnects
+    # can only be watched for once the body is buffered (or there is none)
+    watch_disconnect = modified_body is None or isinstance(modified_body, bytes)
 
-    # Return the response from the forwarded request, preserving the status code and headers
-    # Return the response with JSON content and status code
+    async def within_deadline(awaitable):
+        """Wait on upstream until the deadline, or until the client gives up."""
+        if watch_disconnect:
+            awaitable = unless_disconnected(awaitable, request.receive)
+        try:
+            return await asyncio.wait_for(awaitable, deadline.remaining())
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            timeouts.timed_out += 1
+            raise
+        except ClientDisconnected:
+            timeouts.disconnected += 1
+            log_fields["client_disconnected"] = True
+            raise
 
-    try:
-        json_content = response.json()
-        return Response(
-            content=json.dumps(json_content),
-            status_code=response.status_code,
-            headers={"Content-Type": "application/json"},
+    async def send_upstream() -> tuple[httpx.Response, Upstream]:
+        # Instance choice, circuit breaker, budgeted retries and hedging; a streamed body can only be sent once
+        replayable = modified_body is None or isinstance(modified_body, bytes)
+        response, used = await resilience.send(
+            client, upstreams, build_upstream_request, request.method, route, replayable
         )
-    except ValueError:
-        # If the response is not JSON, fallback to returning it as text
-        logging.error("Response content is not valid JSON")
-        return Response(
-            content=response.text,
-            status_code=response.status_code,
-            headers={
-                "Content-Type": response.headers.get("Content-Type", "text/plain")
-            },
+        log_fields["forward_url"] = f"{used.url}/{path}"
+        return response, used
+
+    async def read_buffered(response: httpx.Response) -> tuple[int, dict[str, str], bytes]:
+        if validated is not None and response.status_code == 304:
+            # Unchanged upstream: serve the copy it just validated
+            await response.aclose()
+            conditional.revalidated += 1
+            log_fields["revalidated"] = True
+            return 200, dict(validated.headers), validated.body
+        status_code, headers, content = await read_upstream_response(
+            response, response_transformers, ctx, accept_encoding
+        )
+        if validator_key is not None:
+            if validated is not None:
+                conditional.changed += 1
+            conditional.put(validator_key, response.headers.get("etag"), status_code, dict(headers), content)
+        return status_code, headers, content
+
+    response_sample = BodySample(limit=None if sampled else 0)
+
+    # Identical concurrent idempotent requests share one upstream call
+    if coalescer.enabled and request.method in IDEMPOTENT_METHODS and modified_body is None:
+        coalesce_key = (request.method, path, query_params, custom_headers["X-User-ID"], accept_encoding)
+
+        async def fetch(flight: Flight):
+            response, used = await send_upstream()
+            upstream_timing.first_byte()
+            if buffered:
+                try:
+                    status_code, headers, content = await read_buffered(response)
+                finally:
+                    upstreams.end(used, response.status_code)
+                upstream_timing.done()
+                if cache_key is not None:
+                    response_cache.put(cache_key, cache_policy, status_code, headers, content)
+                flight.start(status_code, headers)
+                await flight.append(content)
+                return
+            try:
+                headers = relay_response_headers(response.headers)
+                chunks = await compression.relay(response, headers, accept_encoding)
+                flight.start(response.status_code, headers)
+                async for chunk in chunks:
+                    await flight.append(chunk)
+            finally:
+                await response.aclose()
+                upstreams.end(used, response.status_code)
+                upstream_timing.done()
+
+        subscriber, leader = coalescer.join(coalesce_key, fetch)
+        log_fields["coalesced"] = not leader
+        try:
+            # Giving up only stops this request waiting; the shared call goes on for the others
+            status_code, headers = await within_deadline(subscriber.head())
+        except CircuitOpen as e:
+            subscriber.leave()
+            finish(503, request_sample)
+            return stamp(circuit_open_response(e))
+        except ClientDisconnected:
+            subscriber.leave()
+            finish(499, request_sample)
+            return Response(status_code=499)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            subscriber.leave()
+            finish(504, request_sample)
+            return stamp(gateway_timeout_response(deadline))
+        except Exception as e:
+            subscriber.leave()
+            log_fields["error"] = repr(e)
+            finish(502, request_sample)
+            return stamp(bad_gateway_response(e))
+        if cache_key is not None:
+            headers["X-Cache"] = "MISS"
+        if conditional.is_current(if_none_match, status_code, headers):
+            subscriber.leave()
+            finish(304, request_sample)
+            return stamp(not_modified(headers))
+
+        def log_shared():
+            # The body may never have been iterated if the client left before it started
+            subscriber.leave()
+            finish(499 if shared.client_disconnected else status_code, request_sample, response_sample)
+
+        shared = RelayResponse(
+            response_sample.tap(subscriber.iterate()),
+            status_code=status_code,
+            headers=headers,
+            background=BackgroundTask(log_shared),
         )
+        return stamp(shared)
+
+    try:
+        response, target = await within_deadline(send_upstream())
+    except CircuitOpen as e:
+        finish(503, request_sample)
+        return stamp(circuit_open_response(e))
+    except ClientDisconnected:
+        # The upstream call was cancelled; nobody is left to read a response
+        finish(499, request_sample)
+        return Response(status_code=499)
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        finish(504, request_sample)
+        return stamp(gateway_timeout_response(deadline))
+    except RequestBodyTooLarge as e:
+        finish(413, request_sample)
+        return stamp(JSONResponse({"detail": str(e)}, status_code=413))
+    except Exception as e:
+        # Retries are used up: answer what the log records
+        log_fields["error"] = repr(e)
+        finish(502, request_sample)
+        return stamp(bad_gateway_response(e))
+    upstream_timing.first_byte()
+
+    # A successful write makes this user's cached reads of the resource stale
+    if request.method in WRITE_METHODS and response.is_success:
+        response_cache.invalidate(custom_headers["X-User-ID"], path)
+
+    async def read_failed(e: Exception) -> Response:
+        # Upstream broke off mid-body: give back the connection, the instance and the admission slot
+        await response.aclose()
+        upstreams.end(target, error=e)
+        upstream_timing.done()
+        log_fields["error"] = repr(e)
+        finish(502, request_sample)
+        return stamp(bad_gateway_response(e))
+
+    if buffered:
+        try:
+            status_code, headers, content = await read_buffered(response)
+        except Exception as e:
+            return await read_failed(e)
+        upstreams.end(target, response.status_code)
+        upstream_timing.done()
+        if cache_key is not None:
+            response_cache.put(cache_key, cache_policy, status_code, headers, content)
+            headers["X-Cache"] = "MISS"
+        reply = full_or_not_modified(status_code, headers, content)
+        if reply.status_code != 304:
+            response_sample.feed(content)
+        finish(reply.status_code, request_sample, response_sample)
+        return stamp(reply)
+
+    async def close_and_log():
+        await response.aclose()
+        upstreams.end(target, response.status_code)
+        upstream_timing.done()
+        if relayed.client_disconnected:
+            timeouts.disconnected += 1
+            log_fields["client_disconnected"] = True
+        finish(499 if relayed.client_disconnected else response.status_code, request_sample, response_sample)
+
+    # Relay the upstream body chunk by chunk, preserving status and a filtered
+    # set of headers. The upstream response is closed once the relay finishes,
+    # or as soon as the client disconnects.
+    headers = relay_response_headers(response.headers)
+    try:
+        chunks = await compression.relay(response, headers, accept_encoding)
+    except Exception as e:
+        return await read_failed(e)
+    if conditional.is_current(if_none_match, response.status_code, headers):
+        # The client has this body already: close upstream without reading it
+        await response.aclose()
+        upstreams.end(target, response.status_code)
+        upstream_timing.done()
+        finish(304, request_sample)
+        return stamp(not_modified(headers))
+    relayed = RelayResponse(
+        response_sample.tap(chunks),
+        status_code=response.status_code,
+        headers=headers,
+        background=BackgroundTask(close_and_log),
+    )
+    return stamp(relayed)
+
+
+# WebSocket relay for story generation and upload status channels.
+# platform-api builds these addresses from X-Forwarded-Host, so they point here.
+@app.websocket("/ws/{ws_uuid}")
+@app.websocket("/user/ws/{ws_uuid}")
+@app.websocket("/api/ws/{ws_uuid}")
+@app.websocket("/api/user/ws/{ws_uuid}")
+async def websocket_relay(websocket: WebSocket, ws_uuid: str):
+    path = websocket.url.path
+    if path.startswith("/api/"):
+        path = path[len("/api"):]
+
+    headers = add_custom_headers(incoming_headers=websocket.headers)
+    headers.pop("Accept", None)
+    headers["X-Forwarded-Host"] = websocket.headers.get("host", "localhost:8000")
+
+    upstream_url = upstream_ws_url(upstreams.pick().url, path, websocket.url.query)
+    if WS_FANOUT_ENABLED:
+        # One shared upstream subscription per user and channel, broadcast to all local tabs
+        channel_key = f"{headers.get('X-User-ID', USER_ID)} {path}?{websocket.url.query}"
+        await fanout(ws_hub, websocket, channel_key, upstream_url, headers)
+    else:
+        await relay(websocket, upstream_url, headers)
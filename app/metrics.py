@@ -0,0 +1,271 @@
+"""Prometheus-style metrics for proxied requests.
+
+Every request through the catch-all route is recorded against a series
+labeled by normalized route, method and status class. Routes are normalized
+once per distinct path: the ``v1/`` prefix is already gone, and ID-like
+segments (numbers, UUIDs, long hex or opaque tokens) collapse to ``{id}``, so
+``stories/story/42`` and ``stories/story/43`` share a series.
+
+Recording is a few dict lookups and list increments. Series live in nested
+dicts (route -> method -> one slot per status class), so no label tuple is
+built per request; the label text is only assembled when ``/metrics`` is
+scraped. The number of distinct routes is capped, and anything beyond the
+cap is recorded as ``other``.
+"""
+
+import re
+import time
+from bisect import bisect_left
+
+from app.config import env_bool, env_int
+
+
+METRICS_ENABLED = env_bool("METRICS_ENABLED", True)
+# Distinct normalized routes tracked before new ones are folded into "other"
+METRICS_MAX_ROUTES = env_int("METRICS_MAX_ROUTES", 500)
+# Raw paths remembered by the route normalizer
+METRICS_ROUTE_CACHE_SIZE = env_int("METRICS_ROUTE_CACHE_SIZE", 10000)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+OTHER_ROUTE = "other"
+
+_ID_SEGMENT = re.compile(
+    r"\d+"
+    r"|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+    r"|[0-9a-fA-F]{16,}"
+    r"|(?=[A-Za-z_-]*\d)[A-Za-z0-9_-]{20,}"
+)
+
+
+def normalize_route(path: str) -> str:
+    """Collapse ID-like path segments, e.g. ``stories/story/42`` -> ``stories/story/{id}``."""
+    if path.startswith("v1/"):
+        path = path[3:]
+    return "/".join(
+        "{id}" if _ID_SEGMENT.fullmatch(segment) else segment
+        for segment in path.strip("/").split("/")
+    )
+
+
+class Histogram:
+    """Cumulative-on-render histogram with fixed bucket bounds."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteSeries:
+    """Everything recorded for one (route, method, status class)."""
+
+    __slots__ = (
+        "requests", "duration", "upstream_connect", "upstream_ttfb", "upstream_total",
+        "request_bytes", "response_bytes",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.upstream_connect = Histogram(LATENCY_BUCKETS)
+        self.upstream_ttfb = Histogram(LATENCY_BUCKETS)
+        self.upstream_total = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+
+class UpstreamTiming:
+    """Connect/TTFB/total timestamps for one upstream call.
+
+    ``trace`` is passed as the httpx ``trace`` request extension, which
+    reports connection setup; the first send, TTFB and total are marked by
+    the caller.
+    """
+
+    __slots__ = ("started", "connect", "ttfb", "total", "connect_started", "_sent")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect: float | None = None  # only set when a new connection was opened
+        self.ttfb: float | None = None
+        self.total: float | None = None
+        self.connect_started = 0.0
+        self._sent = False
+
+    def sending(self):
+        """The request is about to go upstream; retries and hedges keep the first send time."""
+        if not self._sent:
+            self._sent = True
+            self.started = time.perf_counter()
+
+    async def trace(self, event: str, info: dict):
+        if event == "connection.connect_tcp.started":
+            self.connect_started = time.perf_counter()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect = time.perf_counter() - self.connect_started
+
+    def first_byte(self):
+        self.ttfb = time.perf_counter() - self.started
+
+    def done(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self.started
+
+
+class ProxyMetrics:
+    """Registry of per-route series plus process-wide gauges."""
+
+    def __init__(
+        self,
+        enabled: bool = METRICS_ENABLED,
+        max_routes: int = METRICS_MAX_ROUTES,
+        route_cache_size: int = METRICS_ROUTE_CACHE_SIZE,
+    ):
+        self.enabled = enabled
+        self.max_routes = max_routes
+        self.route_cache_size = route_cache_size
+        self.in_flight = 0
+        self._routes: dict[str, str] = {}
+        self._series: dict[str, dict[str, list[RouteSeries | None]]] = {}
+
+    def route(self, path: str) -> str:
+        """Normalized route label for ``path``, memoized per raw path."""
+        route = self._routes.get(path)
+        if route is not None:
+            return route
+        route = normalize_route(path)
+        if route not in self._series and len(self._series) >= self.max_routes:
+            route = OTHER_ROUTE
+        if len(self._routes) < self.route_cache_size:
+            self._routes[path] = route
+        return route
+
+    def series(self, route: str, method: str, status_code: int) -> RouteSeries:
+        by_method = self._series.get(route)
+        if by_method is None:
+            by_method = self._series[route] = {}
+        slots = by_method.get(method)
+        if slots is None:
+            slots = by_method[method] = [None] * len(STATUS_CLASSES)
+        index = min(max(status_code // 100, 1), 5) - 1
+        series = slots[index]
+        if series is None:
+            series = slots[index] = RouteSeries()
+        return series
+
+    def observe(
+        self,
+        route: str,
+        method: str,
+        status_code: int,
+        duration: float,
+        request_bytes: int | None = None,
+        response_bytes: int | None = None,
+        upstream: UpstreamTiming | None = None,
+    ):
+        if not self.enabled:
+            return
+        series = self.series(route, method, status_code)
+        series.requests += 1
+        series.duration.observe(duration)
+        if request_bytes is not None:
+            series.request_bytes.observe(request_bytes)
+        if response_bytes is not None:
+            series.response_bytes.observe(response_bytes)
+        if upstream is not None:
+            if upstream.connect is not None:
+                series.upstream_connect.observe(upstream.connect)
+            if upstream.ttfb is not None:
+                series.upstream_ttfb.observe(upstream.ttfb)
+            if upstream.total is not None:
+                series.upstream_total.observe(upstream.total)
+
+    def render(self, pool: dict | None = None) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines: list[str] = []
+        labeled = [
+            (f'route="{_escape(route)}",method="{method}",status="{STATUS_CLASSES[i]}"', series)
+            for route, by_method in self._series.items()
+            for method, slots in by_method.items()
+            for i, series in enumerate(slots)
+            if series is not None
+        ]
+
+        lines.append("# HELP proxy_requests_total Requests handled by the catch-all route.")
+        lines.append("# TYPE proxy_requests_total counter")
+        for labels, series in labeled:
+            lines.append(f"proxy_requests_total{{{labels}}} {series.requests}")
+
+        for name, attr, help_text in (
+            ("proxy_request_duration_seconds", "duration", "Time from request arrival to the last response byte."),
+            ("proxy_upstream_connect_seconds", "upstream_connect", "Time to open a new upstream connection (TCP and TLS)."),
+            ("proxy_upstream_ttfb_seconds", "upstream_ttfb", "Time from sending upstream to receiving response headers."),
+            ("proxy_upstream_duration_seconds", "upstream_total", "Time from sending upstream to the end of the response body."),
+            ("proxy_request_size_bytes", "request_bytes", "Request body bytes forwarded upstream."),
+            ("proxy_response_size_bytes", "response_bytes", "Response body bytes relayed to the client."),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, series in labeled:
+                _render_histogram(lines, name, labels, getattr(series, attr))
+
+        lines.append("# HELP proxy_in_flight_requests Requests currently being handled.")
+        lines.append("# TYPE proxy_in_flight_requests gauge")
+        lines.append(f"proxy_in_flight_requests {self.in_flight}")
+
+        if pool is not None:
+            lines.append("# HELP proxy_upstream_pool_connections Upstream pool connections by state.")
+            lines.append("# TYPE proxy_upstream_pool_connections gauge")
+            lines.append(f'proxy_upstream_pool_connections{{state="active"}} {pool["active"]}')
+            lines.append(f'proxy_upstream_pool_connections{{state="idle"}} {pool["idle"]}')
+            lines.append("# HELP proxy_upstream_pool_max_connections Configured upstream pool size.")
+            lines.append("# TYPE proxy_upstream_pool_max_connections gauge")
+            lines.append(f"proxy_upstream_pool_max_connections {pool['max']}")
+            lines.append("# HELP proxy_upstream_pool_waiting Requests waiting for an upstream connection.")
+            lines.append("# TYPE proxy_upstream_pool_waiting gauge")
+            lines.append(f"proxy_upstream_pool_waiting {pool['waiting']}")
+            lines.append("# HELP proxy_upstream_pool_utilization Share of the pool in use (0-1).")
+            lines.append("# TYPE proxy_upstream_pool_utilization gauge")
+            utilization = pool["active"] / pool["max"] if pool["max"] else 0.0
+            lines.append(f"proxy_upstream_pool_utilization {utilization:.4f}")
+
+        lines.append("")
+        return "\n".join(lines)
+
+    def reset(self):
+        self.in_flight = 0
+        self._routes.clear()
+        self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_histogram(lines: list[str], name: str, labels: str, histogram: Histogram):
+    if histogram.count == 0:
+        return
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Global registry used by the catch-all route
+metrics = ProxyMetrics()
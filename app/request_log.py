@@ -0,0 +1,171 @@
+"""Non-blocking structured logging for the proxy.
+
+Log records are handed to a bounded in-memory queue on the event loop and
+formatted/written by a background thread (``QueueListener``), so slow stdout
+never stalls request handling. When the queue is full, records are dropped
+and counted instead of blocking.
+
+Each proxied request produces one JSON record keyed by its ``stack_id``.
+Request/response bodies and headers are only attached to a sampled fraction
+of records, truncated, with sensitive headers redacted.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from app.config import env_bool, env_float, env_int
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Max records waiting for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = env_int("LOG_QUEUE_SIZE", 10000)
+# Attach request/response bodies and headers to sampled records
+LOG_BODIES = env_bool("LOG_BODIES", False)
+LOG_BODY_SAMPLE_RATE = env_float("LOG_BODY_SAMPLE_RATE", 0.01)
+LOG_BODY_MAX_BYTES = env_int("LOG_BODY_MAX_BYTES", 2048)
+LOG_REDACTED_HEADERS = frozenset(
+    h.strip().lower()
+    for h in os.getenv(
+        "LOG_REDACTED_HEADERS", "x-api-key,authorization,cookie,set-cookie,proxy-authorization"
+    ).split(",")
+    if h.strip()
+)
+
+REDACTED = "[REDACTED]"
+
+request_logger = logging.getLogger("proxy.request")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Request records carry their fields in ``record.request``."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        fields = getattr(record, "request", None)
+        if fields is not None:
+            entry.update(fields)
+        else:
+            entry["msg"] = record.getMessage()
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: drops records when the queue is full."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only resolve the message on the loop; JSON encoding happens in the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: logging.handlers.QueueListener | None = None
+_queue_handler: DroppingQueueHandler | None = None
+
+
+def setup_logging():
+    """Route all logging through the queue and a background JSON writer. Idempotent."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(
+        _queue_handler.queue, stream_handler, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def should_sample() -> bool:
+    """Decide once per request whether bodies/headers go into its log record."""
+    return LOG_BODIES and random.random() < LOG_BODY_SAMPLE_RATE
+
+
+def redact_headers(headers) -> dict[str, str]:
+    return {
+        name: REDACTED if name.lower() in LOG_REDACTED_HEADERS else value
+        for name, value in headers.items()
+    }
+
+
+class BodySample:
+    """Keeps the first ``LOG_BODY_MAX_BYTES`` of a body as it streams past."""
+
+    __slots__ = ("limit", "chunks", "size", "total")
+
+    def __init__(self, limit: int | None = None):
+        self.limit = LOG_BODY_MAX_BYTES if limit is None else limit
+        self.chunks: list[bytes] = []
+        self.size = 0
+        self.total = 0
+
+    def feed(self, chunk: bytes):
+        self.total += len(chunk)
+        if self.size < self.limit:
+            part = chunk[: self.limit - self.size]
+            self.chunks.append(part)
+            self.size += len(part)
+
+    async def tap(self, iterator):
+        async for chunk in iterator:
+            self.feed(chunk)
+            yield chunk
+
+    def text(self) -> str:
+        text = b"".join(self.chunks).decode("utf-8", errors="replace")
+        if self.total > self.size:
+            text += f"... [truncated, {self.total} bytes]"
+        return text
+
+
+def log_request(fields: dict):
+    """Emit the single structured record for a proxied request."""
+    request_logger.info("request", extra={"request": fields})
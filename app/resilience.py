@@ -0,0 +1,440 @@
+"""Circuit breakers, budgeted retries and hedged requests for upstream calls.
+
+``Resilience.send`` wraps ``client.send`` for the catch-all route:
+
+- Circuit breaker per (instance, normalized route). After
+  ``BREAKER_FAILURE_THRESHOLD`` consecutive failures (5xx or transport
+  errors) it opens, and requests fail fast with ``CircuitOpen`` (a 503 to the
+  client) instead of waiting on a struggling upstream. With several
+  instances, an open breaker just steers the request to another one. After
+  ``BREAKER_OPEN_SECONDS`` one trial request is let through (half-open). Its
+  outcome closes or re-opens the breaker.
+- Retries for requests whose body can be replayed. Idempotent methods are
+  retried on transport errors and 502/503/504. Other methods are retried
+  only when the connection could not be made, i.e. upstream never saw them.
+  Every retry spends a token from one global ``RetryBudget``. The budget
+  refills by a fraction of the normal request rate, so during an outage
+  retries add at most ``RETRY_BUDGET_RATIO`` extra load.
+- Hedged GETs (opt-in, routes matching ``HEDGE_ROUTES``, two or more
+  instances). If the first instance has not answered within the route's
+  recent p95 latency, the same request is sent to a second instance, and
+  whichever answers first wins. Hedges spend retry budget too.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from typing import Callable
+
+import httpx
+
+from app.balancer import Upstream, UpstreamPool
+from app.config import env_bool, env_float, env_int
+
+
+BREAKER_ENABLED = env_bool("BREAKER_ENABLED", True)
+BREAKER_FAILURE_THRESHOLD = env_int("BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_OPEN_SECONDS = env_float("BREAKER_OPEN_SECONDS", 10.0)
+
+# Extra attempts after the first one
+RETRY_MAX_ATTEMPTS = env_int("RETRY_MAX_ATTEMPTS", 2)
+RETRY_BACKOFF_MS = env_float("RETRY_BACKOFF_MS", 50.0)
+# Retries allowed per normal request, plus a floor per second
+RETRY_BUDGET_RATIO = env_float("RETRY_BUDGET_RATIO", 0.2)
+RETRY_BUDGET_MIN_PER_SECOND = env_float("RETRY_BUDGET_MIN_PER_SECOND", 5.0)
+RETRY_BUDGET_MAX_TOKENS = env_float("RETRY_BUDGET_MAX_TOKENS", 100.0)
+
+HEDGE_ENABLED = env_bool("HEDGE_ENABLED", False)
+# Regex full-matched against the normalized route
+HEDGE_ROUTES = os.getenv("HEDGE_ROUTES", ".*")
+HEDGE_MIN_DELAY_MS = env_float("HEDGE_MIN_DELAY_MS", 10.0)
+# Used until a route has enough latency samples for a p95
+HEDGE_DEFAULT_DELAY_MS = env_float("HEDGE_DEFAULT_DELAY_MS", 100.0)
+HEDGE_SAMPLES = env_int("HEDGE_SAMPLES", 200)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({502, 503, 504})
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Every eligible instance has an open breaker for this route."""
+
+    def __init__(self, route: str, retry_after: float):
+        super().__init__(f"Circuit open for {route}")
+        self.route = route
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open trial."""
+
+    __slots__ = ("state", "failures", "opened_at", "trial_started", "trips")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started: float | None = None
+        self.trips = 0
+
+    def allow(self, now: float, open_seconds: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now - self.opened_at < open_seconds:
+                return False
+            self.state = HALF_OPEN
+            self.trial_started = None
+        # Half-open: one trial at a time; a trial that never reported back expires
+        if self.trial_started is None or now - self.trial_started >= open_seconds:
+            self.trial_started = now
+            return True
+        return False
+
+    def record(self, success: bool, now: float, threshold: int):
+        if success:
+            self.state = CLOSED
+            self.failures = 0
+            self.trial_started = None
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = now
+            self.trial_started = None
+
+    def retry_after(self, now: float, open_seconds: float) -> float:
+        return max(self.opened_at + open_seconds - now, 0.0)
+
+
+class BreakerRegistry:
+    """Breakers keyed by instance URL and normalized route."""
+
+    def __init__(
+        self,
+        enabled: bool = BREAKER_ENABLED,
+        threshold: int = BREAKER_FAILURE_THRESHOLD,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self._breakers: dict[str, dict[str, CircuitBreaker]] = {}
+        self.rejected = 0
+
+    def get(self, upstream_url: str, route: str) -> CircuitBreaker:
+        by_route = self._breakers.get(upstream_url)
+        if by_route is None:
+            by_route = self._breakers[upstream_url] = {}
+        breaker = by_route.get(route)
+        if breaker is None:
+            breaker = by_route[route] = CircuitBreaker()
+        return breaker
+
+    def allow(self, upstream_url: str, route: str) -> bool:
+        if not self.enabled:
+            return True
+        return self.get(upstream_url, route).allow(self.clock(), self.open_seconds)
+
+    def record(self, upstream_url: str, route: str, success: bool):
+        if self.enabled:
+            self.get(upstream_url, route).record(success, self.clock(), self.threshold)
+
+    def retry_after(self, upstream_url: str, route: str) -> float:
+        return self.get(upstream_url, route).retry_after(self.clock(), self.open_seconds)
+
+    def clear(self):
+        self._breakers.clear()
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        now = self.clock()
+        return {
+            "enabled": self.enabled,
+            "rejected": self.rejected,
+            "breakers": [
+                {
+                    "upstream": url,
+                    "route": route,
+                    "state": b.state,
+                    "failures": b.failures,
+                    "trips": b.trips,
+                    "retry_after": round(b.retry_after(now, self.open_seconds), 1) if b.state == OPEN else 0,
+                }
+                for url, by_route in self._breakers.items()
+                for route, b in by_route.items()
+                # Healthy breakers are the common case; only show ones with history
+                if b.state != CLOSED or b.failures or b.trips
+            ],
+        }
+
+
+class RetryBudget:
+    """Token bucket shared by all retries and hedges.
+
+    Each original request deposits ``ratio`` tokens and a floor of
+    ``min_per_second`` tokens accrues over time; each retry spends one.
+    """
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+        max_tokens: float = RETRY_BUDGET_MAX_TOKENS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.clock = clock
+        self.tokens = max_tokens
+        self._updated = clock()
+        self.spent = 0
+        self.denied = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.spent += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> dict:
+        self._refill()
+        return {"tokens": round(self.tokens, 2), "spent": self.spent, "denied": self.denied}
+
+
+class LatencyTracker:
+    """Recent upstream latencies per route, for the hedge delay."""
+
+    RECOMPUTE_EVERY = 20
+
+    def __init__(self, samples: int = HEDGE_SAMPLES):
+        self.samples = samples
+        self._latencies: dict[str, deque] = {}
+        self._observed: dict[str, int] = {}
+        self._p95: dict[str, float] = {}
+
+    def observe(self, route: str, seconds: float):
+        window = self._latencies.get(route)
+        if window is None:
+            window = self._latencies[route] = deque(maxlen=self.samples)
+        window.append(seconds)
+        # Recompute the percentile every few samples, not per request
+        observed = self._observed[route] = self._observed.get(route, 0) + 1
+        if observed % self.RECOMPUTE_EVERY == 0:
+            ordered = sorted(window)
+            self._p95[route] = ordered[max(int(len(ordered) * 0.95) - 1, 0)]
+
+    def hedge_delay(self, route: str) -> float:
+        p95 = self._p95.get(route)
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY_MS / 1000
+        return max(p95, HEDGE_MIN_DELAY_MS / 1000)
+
+
+class Resilience:
+    """Breakers, retry budget and hedging policy for one upstream pool."""
+
+    def __init__(
+        self,
+        breakers: BreakerRegistry | None = None,
+        budget: RetryBudget | None = None,
+        latencies: LatencyTracker | None = None,
+        hedge_enabled: bool = HEDGE_ENABLED,
+        hedge_routes: str = HEDGE_ROUTES,
+    ):
+        self.breakers = breakers or BreakerRegistry()
+        self.budget = budget or RetryBudget()
+        self.latencies = latencies or LatencyTracker()
+        self.hedge_enabled = hedge_enabled
+        self.hedge_routes = re.compile(hedge_routes)
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._tasks: set[asyncio.Task] = set()
+
+    def should_hedge(self, method: str, route: str, replayable: bool, pool: UpstreamPool) -> bool:
+        return (
+            self.hedge_enabled
+            and method == "GET"
+            and replayable
+            and len(pool) > 1
+            and self.hedge_routes.fullmatch(route) is not None
+        )
+
+    def choose(self, pool: UpstreamPool, route: str, avoid: list[Upstream]) -> Upstream:
+        """Pick an instance whose breaker admits the request, preferring ones not in ``avoid``."""
+        for exclude in ((avoid, []) if avoid else ([],)):
+            skip = list(exclude)
+            while (target := pool.pick(skip)) is not None:
+                if self.breakers.allow(target.url, route):
+                    return target
+                skip.append(target)
+        self.breakers.rejected += 1
+        retry_after = min(self.breakers.retry_after(u.url, route) for u in pool.upstreams)
+        raise CircuitOpen(route, retry_after)
+
+    async def attempt(
+        self,
+        client: httpx.AsyncClient,
+        pool: UpstreamPool,
+        target: Upstream,
+        build: Callable[[Upstream], httpx.Request],
+        route: str,
+    ) -> httpx.Response:
+        """One upstream call, with load and breaker accounting.
+
+        On success the caller owns the response and must call ``pool.end``.
+        """
+        pool.begin(target)
+        started = time.perf_counter()
+        try:
+            response = await client.send(build(target), stream=True)
+        except Exception as e:
+            pool.end(target, error=e)
+            if isinstance(e, httpx.TransportError):
+                self.breakers.record(target.url, route, False)
+            raise
+        except BaseException:
+            pool.end(target)  # cancelled (hedge loser, client gone)
+            raise
+        self.breakers.record(target.url, route, response.status_code < 500)
+        self.latencies.observe(route, time.perf_counter() - started)
+        return response
+
+    async def hedged(
+        self,
+        client: httpx.AsyncClient,
+        pool: UpstreamPool,
+        first: Upstream,
+        build: Callable[[Upstream], httpx.Request],
+        route: str,
+    ) -> tuple[httpx.Response, Upstream]:
+        primary = asyncio.create_task(self.attempt(client, pool, first, build, route))
+        targets = {primary: first}
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.latencies.hedge_delay(route))
+            if not done:
+                second = pool.pick([first])
+                if second is not None and self.breakers.allow(second.url, route) and self.budget.try_spend():
+                    self.hedges += 1
+                    targets[asyncio.create_task(self.attempt(client, pool, second, build, route))] = second
+
+            pending = set(targets)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if winner is None and task.exception() is None:
+                        winner = task
+            if winner is None:
+                return primary.result(), first  # every attempt failed: raise the primary's error
+            if winner is not primary:
+                self.hedge_wins += 1
+            return winner.result(), targets[winner]
+        finally:
+            for task, target in targets.items():
+                if task is not winner:
+                    self._discard(task, pool, target)
+
+    def _discard(self, task: asyncio.Task, pool: UpstreamPool, target: Upstream):
+        """Cancel a losing attempt and release its response if it produced one."""
+
+        async def cleanup():
+            task.cancel()
+            try:
+                response = await task
+            except BaseException:
+                return
+            await response.aclose()
+            pool.end(target, response.status_code)
+
+        cleaner = asyncio.create_task(cleanup())
+        self._tasks.add(cleaner)
+        cleaner.add_done_callback(self._tasks.discard)
+
+    async def send(
+        self,
+        client: httpx.AsyncClient,
+        pool: UpstreamPool,
+        build: Callable[[Upstream], httpx.Request],
+        method: str,
+        route: str,
+        replayable: bool,
+    ) -> tuple[httpx.Response, Upstream]:
+        """Send with breaker, retries and hedging; returns (response, instance).
+
+        ``build`` makes the request for an instance and is called again for
+        each retry/hedge, so it must only be replayable when the body is.
+        The caller must close the response and call ``pool.end(instance, status)``.
+        """
+        self.budget.deposit()
+        idempotent = method in IDEMPOTENT_METHODS
+        hedge = self.should_hedge(method, route, replayable, pool)
+        tried: list[Upstream] = []
+        attempt = 0
+        while True:
+            target = self.choose(pool, route, tried)
+            tried.append(target)
+            try:
+                if hedge:
+                    response, target = await self.hedged(client, pool, target, build, route)
+                else:
+                    response = await self.attempt(client, pool, target, build, route)
+            except httpx.TransportError as e:
+                retry = replayable and (idempotent or isinstance(e, CONNECT_ERRORS))
+                if not retry or attempt >= RETRY_MAX_ATTEMPTS or not self.budget.try_spend():
+                    raise
+                logging.warning(f"Retrying {method} {route} after {e!r} from {target.url}")
+            else:
+                if not (
+                    idempotent and replayable
+                    and response.status_code in RETRY_STATUSES
+                    and attempt < RETRY_MAX_ATTEMPTS
+                    and self.budget.try_spend()
+                ):
+                    return response, target
+                await response.aclose()
+                pool.end(target, response.status_code)
+                logging.warning(f"Retrying {method} {route} after {response.status_code} from {target.url}")
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0.5, 1.0) * RETRY_BACKOFF_MS * 2 ** (attempt - 1) / 1000)
+
+    def stats(self) -> dict:
+        return {
+            **self.breakers.stats(),
+            "retry_budget": self.budget.stats(),
+            "retries": self.retries,
+            "hedging": self.hedge_enabled,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+# Global policy used by the catch-all route
+resilience = Resilience()
@@ -0,0 +1,233 @@
+"""Per-user in-process cache for read-mostly GET endpoints.
+
+Entries are keyed by method + path + query + effective ``X-User-ID`` (plus the
+client's Accept-Encoding, since bodies are stored exactly as upstream sent
+them). Each cacheable route has a TTL policy. After the TTL an entry may still
+be served for a while as stale, while a background refresh fetches a new copy
+(stale-while-revalidate). Memory is bounded by entry count and total body
+bytes, with LRU eviction.
+
+A successful write (POST/PUT/PATCH/DELETE) to a resource family drops that
+user's cached entries for the family, e.g. ``PUT /user/storyplan-config``
+invalidates ``GET /user/storyplan-config/default``.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from app.config import env_bool, env_int
+
+
+RESPONSE_CACHE_ENABLED = env_bool("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_MAX_ENTRIES = env_int("RESPONSE_CACHE_MAX_ENTRIES", 10000)
+RESPONSE_CACHE_MAX_BYTES = env_int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+# Larger responses are never cached (bytes)
+RESPONSE_CACHE_MAX_ENTRY_BYTES = env_int("RESPONSE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+
+WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    pattern: str      # regex, full-matched against the path (after the v1/ strip)
+    ttl: float        # seconds an entry is fresh
+    stale_ttl: float  # extra seconds it may be served stale while refreshing
+    family: str       # writes to this path (or below it) invalidate the entry
+
+
+DEFAULT_POLICIES = [
+    CachePolicy(r"user/current-user", ttl=30, stale_ttl=60, family="user/current-user"),
+    CachePolicy(r"user/membership/current-membership", ttl=60, stale_ttl=120, family="user/membership"),
+    CachePolicy(r"prompts", ttl=60, stale_ttl=120, family="prompts"),
+    CachePolicy(r"organizations/me", ttl=60, stale_ttl=120, family="organizations"),
+    CachePolicy(r"user/storyplan-config/default", ttl=30, stale_ttl=60, family="user/storyplan-config"),
+]
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: dict[str, str]
+    body: bytes
+    user_id: str
+    family: str
+    fresh_until: float
+    stale_until: float
+
+
+CacheKey = tuple[str, str, str, str, str]
+
+FRESH = "HIT"
+STALE = "STALE"
+
+
+class ResponseCache:
+    """Bounded LRU of upstream responses with per-route TTL policies."""
+
+    def __init__(
+        self,
+        policies: list[CachePolicy],
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.policies = list(policies)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.enabled = enabled
+        self.clock = clock
+        self._compiled = re.compile(
+            "|".join(f"(?P<p{i}>{p.pattern})" for i, p in enumerate(self.policies)) or r"(?!)"
+        )
+        self._entries: OrderedDict[CacheKey, CachedResponse] = OrderedDict()
+        self._by_user: dict[str, set[CacheKey]] = {}
+        self._bytes = 0
+        self._refreshing: set[CacheKey] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def policy_for(self, method: str, path: str) -> CachePolicy | None:
+        if not self.enabled or method != "GET":
+            return None
+        m = self._compiled.fullmatch(path)
+        if m is None:
+            return None
+        return self.policies[int(m.lastgroup[1:])]
+
+    @staticmethod
+    def key(method: str, path: str, query: str, user_id: str, accept_encoding: str) -> CacheKey:
+        return (method, path, query, user_id, accept_encoding)
+
+    def get(self, key: CacheKey) -> tuple[CachedResponse | None, str | None]:
+        """Return (entry, FRESH|STALE), or (None, None) on a miss."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        now = self.clock()
+        if now < entry.fresh_until:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry, FRESH
+        if now < entry.stale_until:
+            self._entries.move_to_end(key)
+            self.stale_hits += 1
+            return entry, STALE
+        self._remove(key)
+        self.misses += 1
+        return None, None
+
+    def put(
+        self,
+        key: CacheKey,
+        policy: CachePolicy,
+        status_code: int,
+        headers: dict[str, str],
+        body: bytes,
+    ) -> bool:
+        """Store a response if it is cacheable. Returns True if stored."""
+        if status_code != 200 or len(body) > self.max_entry_bytes:
+            return False
+        cache_control = headers.get("cache-control", "").lower()
+        if "no-store" in cache_control or "private" in cache_control:
+            return False
+
+        if key in self._entries:
+            self._remove(key)
+        now = self.clock()
+        user_id = key[3]
+        self._entries[key] = CachedResponse(
+            status_code=status_code,
+            headers=headers,
+            body=body,
+            user_id=user_id,
+            family=policy.family,
+            fresh_until=now + policy.ttl,
+            stale_until=now + policy.ttl + policy.stale_ttl,
+        )
+        self._by_user.setdefault(user_id, set()).add(key)
+        self._bytes += len(body)
+        self._evict()
+        return True
+
+    def invalidate(self, user_id: str, path: str) -> int:
+        """Drop this user's entries whose family is ``path`` or contains it."""
+        keys = self._by_user.get(user_id)
+        if not keys:
+            return 0
+        doomed = [
+            key for key in keys
+            if path == self._entries[key].family or path.startswith(self._entries[key].family + "/")
+        ]
+        for key in doomed:
+            self._remove(key)
+        self.invalidations += len(doomed)
+        return len(doomed)
+
+    def refresh_in_background(self, key: CacheKey, fetch: Callable[[], Awaitable[None]]):
+        """Run ``fetch`` once per key at a time to revalidate a stale entry."""
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def run():
+            try:
+                await fetch()
+            except Exception as e:
+                logging.warning(f"Background cache refresh failed for {key[1]}: {e!r}")
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+        self._bytes = 0
+
+    def _remove(self, key: CacheKey):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+        keys = self._by_user.get(entry.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[entry.user_id]
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+# Global cache used by the catch-all route
+response_cache = ResponseCache(DEFAULT_POLICIES)
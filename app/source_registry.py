@@ -0,0 +1,354 @@
+"""Registry of embedded sources for ``chat/async`` injection.
+
+Sources are owned by a user (``user:<X-User-ID>``), an org (``org:<id>``)
+or everyone (``*``, e.g. the startup sample upload). A user's org comes from
+the operator's ``SOURCE_USER_ORGS`` map, never from the request.
+The index keeps each owner's sources in recency order and a precomputed
+top-N injection payload per owner, so a lookup is a few dict reads. When a
+request matches several owners, the merged payload is cached until the
+registry next changes.
+
+The registry is persisted as one compact JSON document of rows, written to a
+temp file and renamed into place, and loaded with a single ``json.loads`` at
+startup. Changes are a locked read-modify-write of that file, so several
+worker processes can register sources safely. Other workers reload when
+notified (see ``app/workers.py``), or when a background watcher sees the
+file change, so the request path never touches the filesystem. On first
+start the legacy single-source file (``SOURCE_ID_FILE``) is imported as a
+shared source.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, TypeVar
+
+from app.config import env_float, env_int
+from app.workers import FileLock, atomic_write
+
+
+# Injected sources per request, newest first
+SOURCE_REGISTRY_TOP_N = env_int("SOURCE_REGISTRY_TOP_N", 10)
+# Oldest sources of an owner are evicted past this
+SOURCE_REGISTRY_MAX_PER_OWNER = env_int("SOURCE_REGISTRY_MAX_PER_OWNER", 100)
+# How often the background watcher stats the registry file (seconds)
+SOURCE_CACHE_POLL_SECONDS = env_float("SOURCE_CACHE_POLL_SECONDS", 5.0)
+# Org membership for org-owned sources: "user=org,user=org"
+SOURCE_USER_ORGS = os.getenv("SOURCE_USER_ORGS", "")
+
+SHARED = "*"
+FORMAT_VERSION = 1
+# Merged payloads for multi-owner lookups, dropped wholesale past this
+MERGED_CACHE_SIZE = 10000
+
+T = TypeVar("T")
+
+
+def owner_key(user_id: str | None = None, org_id: str | None = None) -> str:
+    if user_id:
+        return f"user:{user_id}"
+    if org_id:
+        return f"org:{org_id}"
+    return SHARED
+
+
+def parse_user_orgs(value: str) -> dict[str, str]:
+    """``{user_id: org_id}`` from ``user=org`` pairs; malformed pairs are skipped."""
+    orgs = {}
+    for pair in value.split(","):
+        user_id, sep, org_id = (part.strip() for part in pair.partition("="))
+        if not pair.strip():
+            continue
+        if not sep or not user_id or not org_id:
+            logging.warning(f"Invalid SOURCE_USER_ORGS entry {pair.strip()!r}, expected user=org")
+            continue
+        orgs[user_id] = org_id
+    return orgs
+
+
+@dataclass(frozen=True)
+class SourceRecord:
+    source_id: str
+    owner: str
+    name: str               # document name; a re-upload under the same name replaces the old one
+    download_url: str
+    registered_at: float
+
+    def entry(self) -> dict:
+        """Capitol-llm validates that each entry has exactly {"download_url", "filename"}."""
+        # Use the parquet filename from the URL (matches production pattern)
+        filename = self.download_url.split("/")[-1] if "/" in self.download_url else self.name
+        return {"download_url": self.download_url, "filename": filename}
+
+
+def record_from_upload(
+    source_data: dict, owner: str = SHARED, registered_at: float | None = None
+) -> SourceRecord | None:
+    """Build a record from persisted upload data ({source_id, filename, upload_response})."""
+    # Get the embedded parquet URL from the upload response
+    upload_response = source_data.get("upload_response", {})
+    download_url = upload_response.get("download_url") or upload_response.get("embedded_file_url", "")
+
+    if not download_url:
+        logging.warning("No download_url found in source data, skipping injection")
+        return None
+    return SourceRecord(
+        source_id=source_data["source_id"],
+        owner=owner,
+        name=source_data["filename"],
+        download_url=download_url,
+        registered_at=time.time() if registered_at is None else registered_at,
+    )
+
+
+def _file_signature(path: Path) -> tuple[int, int, int] | None:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class SourceRegistry:
+    """In-memory source index per owner, persisted to ``path``."""
+
+    def __init__(
+        self,
+        path: Path,
+        legacy_path: Path | None = None,
+        top_n: int = SOURCE_REGISTRY_TOP_N,
+        max_per_owner: int = SOURCE_REGISTRY_MAX_PER_OWNER,
+    ):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.top_n = top_n
+        self.max_per_owner = max_per_owner
+        self._by_id: dict[str, SourceRecord] = {}
+        # owner -> source_id -> record, oldest first
+        self._by_owner: dict[str, OrderedDict[str, SourceRecord]] = {}
+        # owner -> newest ``top_n`` records and their injection entries
+        self._top: dict[str, list[SourceRecord]] = {}
+        self._payloads: dict[str, list[dict]] = {}
+        self._merged: dict[tuple[str, ...], list[dict]] = {}
+        self._signature: tuple[int, int, int] | None = None
+        self._loaded = False
+        self._save_lock = asyncio.Lock()
+        # Serializes read-modify-write of the file across worker processes
+        self._file_lock = FileLock(path.with_name(f".{path.name}.lock"))
+        # Called after this process changed the file, e.g. to notify other workers
+        self.on_change: Callable[[], None] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    # Lookup ------------------------------------------------------------------
+
+    def lookup(self, user_id: str | None, org_id: str | None = None) -> list[dict] | None:
+        """Injection payload for a request: newest sources of the user, org and shared owners.
+
+        Only the very first call may read the file.
+        """
+        if self._loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.refresh()
+        owners = tuple(
+            key for key in (
+                f"user:{user_id}" if user_id else None,
+                f"org:{org_id}" if org_id else None,
+                SHARED,
+            )
+            if key in self._payloads
+        )
+        if not owners:
+            return None
+        if len(owners) == 1:
+            return self._payloads[owners[0]]
+        merged = self._merged.get(owners)
+        if merged is None:
+            records = sorted(
+                itertools.chain.from_iterable(self._top[owner] for owner in owners),
+                key=lambda r: r.registered_at,
+                reverse=True,
+            )
+            merged = [r.entry() for r in records[:self.top_n]]
+            if len(self._merged) >= MERGED_CACHE_SIZE:
+                self._merged.clear()
+            self._merged[owners] = merged
+        return merged
+
+    def get(self, source_id: str) -> SourceRecord | None:
+        return self._by_id.get(source_id)
+
+    # Register / evict --------------------------------------------------------
+
+    def register(self, record: SourceRecord):
+        """Add or replace a source; replaces the owner's source with the same name."""
+        self._ensure_loaded()
+        self._remove(record.source_id)
+        for other in [r for r in self._by_owner.get(record.owner, {}).values() if r.name == record.name]:
+            self._remove(other.source_id)
+        sources = self._by_owner.setdefault(record.owner, OrderedDict())
+        sources[record.source_id] = record
+        self._by_id[record.source_id] = record
+        while len(sources) > self.max_per_owner:
+            _, dropped = sources.popitem(last=False)
+            del self._by_id[dropped.source_id]
+            self.evictions += 1
+        self._reindex(record.owner)
+
+    def evict(self, source_id: str) -> bool:
+        self._ensure_loaded()
+        return self._remove(source_id) is not None
+
+    def _ensure_loaded(self):
+        # Changes apply on top of what is persisted, never replace it
+        if not self._loaded:
+            self.refresh()
+
+    def _remove(self, source_id: str) -> SourceRecord | None:
+        record = self._by_id.pop(source_id, None)
+        if record is not None:
+            sources = self._by_owner[record.owner]
+            del sources[source_id]
+            if not sources:
+                del self._by_owner[record.owner]
+            self._reindex(record.owner)
+        return record
+
+    def _reindex(self, owner: str):
+        sources = self._by_owner.get(owner)
+        if sources:
+            top = list(itertools.islice(reversed(sources.values()), self.top_n))
+            self._top[owner] = top
+            self._payloads[owner] = [r.entry() for r in top]
+        else:
+            self._top.pop(owner, None)
+            self._payloads.pop(owner, None)
+        self._merged.clear()
+
+    def _replace(self, records: list[SourceRecord]):
+        self._by_id.clear()
+        self._by_owner.clear()
+        self._top.clear()
+        self._payloads.clear()
+        self._merged.clear()
+        for record in sorted(records, key=lambda r: r.registered_at):
+            self._by_id[record.source_id] = record
+            self._by_owner.setdefault(record.owner, OrderedDict())[record.source_id] = record
+        for owner in self._by_owner:
+            self._reindex(owner)
+
+    # Persistence -------------------------------------------------------------
+
+    def snapshot(self) -> bytes:
+        rows = [[r.source_id, r.owner, r.name, r.download_url, r.registered_at] for r in self._by_id.values()]
+        return json.dumps({"version": FORMAT_VERSION, "sources": rows}, separators=(",", ":")).encode()
+
+    def write(self, data: bytes):
+        """Atomically replace the registry file. Blocking; see ``update``."""
+        atomic_write(self.path, data)
+        self._signature = _file_signature(self.path)
+
+    async def update(self, change: Callable[[], T]) -> T:
+        """Apply ``change`` (e.g. a ``register``) on top of the latest file and persist it.
+
+        Another worker may have written the file since this one loaded it, so
+        the reload, change and write happen under a lock shared by every process.
+        """
+        async with self._save_lock:
+            await asyncio.to_thread(self._file_lock.acquire)
+            try:
+                result = await asyncio.to_thread(self._read)
+                if result is not None:
+                    self._apply(*result)
+                value = change()
+                await asyncio.to_thread(self.write, self.snapshot())
+            finally:
+                self._file_lock.release()
+        if self.on_change is not None:
+            self.on_change()
+        return value
+
+    def _read(self) -> tuple[tuple[int, int, int] | None, list[SourceRecord]] | None:
+        """Read the file if it changed since the last load; None when unchanged. Blocking."""
+        signature = _file_signature(self.path)
+        if self._loaded and signature == self._signature:
+            return None
+        records = []
+        if signature is not None:
+            try:
+                data = json.loads(self.path.read_bytes())
+                records = [SourceRecord(*row) for row in data["sources"]]
+            except Exception as e:
+                logging.error(f"Error reading source registry {self.path}: {e}")
+        elif self.legacy_path is not None and self.legacy_path.exists():
+            try:
+                record = record_from_upload(
+                    json.loads(self.legacy_path.read_text()), registered_at=self.legacy_path.stat().st_mtime
+                )
+                records = [record] if record is not None else []
+            except Exception as e:
+                logging.error(f"Error reading source ID file: {e}")
+        return signature, records
+
+    def _apply(self, signature: tuple[int, int, int] | None, records: list[SourceRecord]):
+        self._replace(records)
+        self._signature = signature
+        self._loaded = True
+        self.reloads += 1
+
+    def refresh(self) -> bool:
+        """Reload the index if the file changed. Returns True on reload.
+
+        Blocking; call through ``asyncio.to_thread`` from async code.
+        """
+        result = self._read()
+        if result is None:
+            return False
+        self._apply(*result)
+        return True
+
+    async def reload(self) -> bool:
+        """Pick up changes made to the file by another process. Returns True on reload."""
+        async with self._save_lock:
+            # Read off the loop, swap the index on it so lookups never see a half-built one
+            result = await asyncio.to_thread(self._read)
+            if result is None:
+                return False
+            self._apply(*result)
+        logging.info(f"Source registry reloaded from {self.path}")
+        return True
+
+    async def watch(self, interval: float | None = None):
+        """Background task: safety net for changes no worker notified us about."""
+        if interval is None:
+            interval = SOURCE_CACHE_POLL_SECONDS
+        while True:
+            try:
+                await self.reload()
+            except Exception as e:
+                logging.error(f"Source registry refresh failed: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "loaded": self._loaded,
+            "sources": len(self._by_id),
+            "owners": len(self._by_owner),
+            "evictions": self.evictions,
+        }
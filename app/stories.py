@@ -0,0 +1,203 @@
+"""Story forwarding: the ``StoryPayload`` model and ``POST /forward-story/bulk``.
+
+Batch jobs that trigger story generation for hundreds of stories send them
+in one request, either as a JSON array of ``StoryPayload`` objects or as
+NDJSON (one per line, ``Content-Type: application/x-ndjson``). NDJSON is
+pipelined: each line is forwarded as soon as it arrives, so a job can stream
+its stories while earlier ones are already running. At most
+``STORY_BULK_CONCURRENCY`` stories are forwarded at a time over the shared
+upstream pool, and the body is only read as fast as slots free up.
+
+The response is NDJSON with one status line per story, in completion order::
+
+    {"index": 3, "story_id": "s-3", "status": 200, "body": {...}}
+    {"index": 0, "story_id": "s-0", "status": 502, "error": "ConnectError(...)"}
+    {"index": 1, "status": 422, "error": [{"loc": ["story_id"], ...}]}
+
+A story that fails validation or upstream gets its own error line; the rest
+of the batch carries on.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable
+
+import httpx
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from starlette.requests import ClientDisconnect
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from app import codec
+from app.admission import Overloaded
+from app.config import env_int
+
+
+STORY_BULK_CONCURRENCY = env_int("STORY_BULK_CONCURRENCY", 8)
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-lines")
+
+
+# Define the request model for the specific POST request
+class StoryPayload(BaseModel):
+    story_id: str
+    user_config_params: dict
+    story_plan_config_id: str
+
+
+_story_list = TypeAdapter(list[StoryPayload])
+
+
+@dataclass
+class StoryItem:
+    index: int
+    payload: StoryPayload | None = None
+    errors: list | None = None  # validation errors when payload is None
+
+
+def _invalid(index: int, e: ValidationError) -> StoryItem:
+    return StoryItem(index, errors=e.errors(include_url=False, include_context=False, include_input=False))
+
+
+def is_ndjson(content_type: str) -> bool:
+    return content_type.partition(";")[0].strip().lower() in NDJSON_TYPES
+
+
+def parse_story_array(body: bytes) -> list[StoryItem]:
+    """Validate a JSON array of stories. Raises ValueError if the body is not an array."""
+    try:
+        return [StoryItem(i, payload) for i, payload in enumerate(_story_list.validate_json(body))]
+    except ValidationError:
+        pass
+    # Some items are invalid: validate them one by one so only those fail
+    try:
+        raw = codec.loads(body)
+    except ValueError as e:
+        raise ValueError(f"Body is not valid JSON: {e}") from None
+    if not isinstance(raw, list):
+        raise ValueError("Body must be a JSON array of stories")
+    items = []
+    for i, value in enumerate(raw):
+        try:
+            items.append(StoryItem(i, StoryPayload.model_validate(value)))
+        except ValidationError as e:
+            items.append(_invalid(i, e))
+    return items
+
+
+async def parse_story_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[StoryItem]:
+    """Validate NDJSON stories as their lines arrive; blank lines are skipped."""
+    index = 0
+    buffer = b""
+
+    def parse(line: bytes) -> StoryItem:
+        try:
+            return StoryItem(index, StoryPayload.model_validate_json(line))
+        except ValidationError as e:
+            return _invalid(index, e)
+
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse(line)
+                index += 1
+    if buffer.strip():
+        yield parse(buffer)
+
+
+class StoryBulkRun:
+    """Forwards a stream of stories with bounded concurrency and reports each as it completes."""
+
+    def __init__(
+        self,
+        send: Callable[[StoryPayload], Awaitable[httpx.Response]],
+        concurrency: int = STORY_BULK_CONCURRENCY,
+    ):
+        self.send = send
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        self._results: asyncio.Queue[dict | None] = asyncio.Queue()
+        self.forwarded = 0
+        self.failed = 0
+        self.invalid = 0
+
+    async def _forward(self, item: StoryItem):
+        result = {"index": item.index, "story_id": item.payload.story_id}
+        try:
+            response = await self.send(item.payload)
+        except Overloaded as e:
+            result.update(status=503, error=f"Proxy overloaded: {e}")
+        except Exception as e:
+            result.update(status=502, error=repr(e))
+        else:
+            result["status"] = response.status_code
+            try:
+                result["body"] = codec.loads(response.content) if response.content else None
+            except ValueError:
+                result["body"] = response.text
+        finally:
+            self._slots.release()
+        if result["status"] >= 400:
+            self.failed += 1
+        else:
+            self.forwarded += 1
+        self._results.put_nowait(result)
+
+    async def _dispatch(self, items: AsyncIterator[StoryItem], tasks: set[asyncio.Task]):
+        try:
+            async for item in items:
+                if item.payload is None:
+                    self.invalid += 1
+                    self._results.put_nowait({"index": item.index, "status": 422, "error": item.errors})
+                    continue
+                # Wait for a free slot before reading on, so a fast producer cannot queue up the whole body
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._forward(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except Exception as e:
+            # The body broke off or grew too large: report it, keep what was already sent
+            self._results.put_nowait({"status": 400, "error": str(e)})
+        if tasks:
+            await asyncio.wait(set(tasks))
+        self._results.put_nowait(None)
+
+    async def stream(self, items: AsyncIterator[StoryItem]) -> AsyncIterator[bytes]:
+        """One NDJSON status line per story, as each completes."""
+        tasks: set[asyncio.Task] = set()
+        dispatcher = asyncio.ensure_future(self._dispatch(items, tasks))
+        try:
+            while (result := await self._results.get()) is not None:
+                yield codec.dumps(result) + b"\n"
+        finally:
+            # Client went away mid-stream: stop reading and cancel the stories still running
+            dispatcher.cancel()
+            for task in list(tasks):
+                task.cancel()
+            logging.info(
+                f"Bulk forward-story: {self.forwarded} forwarded, {self.failed} failed, {self.invalid} invalid"
+            )
+
+
+class PipelinedResponse(StreamingResponse):
+    """StreamingResponse that leaves ``receive`` to a request body still being read.
+
+    The stock response listens on ``receive`` for a disconnect while it
+    streams, which would swallow the NDJSON lines still arriving. Here a
+    disconnect shows up in the request body stream or as a failed send.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+
+async def story_items(items: list[StoryItem]) -> AsyncIterator[StoryItem]:
+    for item in items:
+        yield item
@@ -0,0 +1,276 @@
+"""Request IDs, per-phase timing and optional span export.
+
+Every proxied request has an ID: the ``stack_id`` of its log record. It is
+the client's ``X-Request-ID`` if that is a sane token, else a new UUID. It is
+sent to platform-api as ``X-Request-ID`` and echoed on the response, so a
+slow browser request can be found in platform-api's logs.
+
+``RequestTiming`` records the phases of a request, as offsets from its
+arrival:
+
+- ``admit``: waiting for an admission slot
+- ``read``: buffering a request body that gets rewritten
+- ``transform``: request transformers, including source injection
+- ``connect``: opening a new upstream connection (absent when one was reused)
+- ``ttfb``: from first sending upstream to its response headers
+- ``relay``: from upstream's response headers to the end of its body
+
+The phases done by the time the response headers go out are sent in a
+``Server-Timing`` header, with ``total`` up to that moment. For streamed
+responses that excludes ``relay``. The complete timings go into the request's
+log record. When ``TRACE_EXPORT_FILE`` or ``TRACE_EXPORT_ENDPOINT`` is set,
+sampled requests are also exported as OpenTelemetry spans in OTLP/JSON: a
+server span per request, with a child span per phase. The request path only
+appends to a bounded queue. A background task encodes the queue in batches,
+then appends each batch to the file or POSTs it to a collector. An incoming
+W3C ``traceparent`` makes the request part of the caller's trace, and is
+forwarded to platform-api with the proxy's span as parent.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+import httpx
+
+from app import codec
+from app.config import env_bool, env_float, env_int
+from app.metrics import UpstreamTiming
+
+
+SERVER_TIMING_ENABLED = env_bool("SERVER_TIMING_ENABLED", True)
+# OTLP/JSON span export: one ExportTraceServiceRequest per line, and/or an OTLP/HTTP endpoint
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+TRACE_EXPORT_ENDPOINT = os.getenv("TRACE_EXPORT_ENDPOINT") or os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT", "")
+TRACE_SAMPLE_RATE = env_float("TRACE_SAMPLE_RATE", 1.0)
+# Finished requests waiting for export before new ones are dropped
+TRACE_EXPORT_QUEUE_SIZE = env_int("TRACE_EXPORT_QUEUE_SIZE", 10000)
+TRACE_EXPORT_INTERVAL = env_float("TRACE_EXPORT_INTERVAL", 2.0)
+TRACE_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "demo-proxy-app")
+
+# Requests encoded into one export payload
+EXPORT_BATCH_SIZE = 512
+
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+_TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER = 1, 2
+STATUS_UNSET, STATUS_ERROR = 0, 2
+
+
+def request_id(incoming: str | None) -> str:
+    """The client's X-Request-ID when it is a sane token, otherwise a new UUID."""
+    if incoming and _REQUEST_ID.fullmatch(incoming):
+        return incoming
+    return str(uuid.uuid4())
+
+
+class RequestTiming:
+    """Phase durations of one request, plus its trace identity."""
+
+    __slots__ = (
+        "request_id", "trace_id", "span_id", "parent_span_id", "sampled",
+        "started", "started_ns", "ended", "phases",
+    )
+
+    def __init__(self, request_id: str, traceparent: str | None = None, sample_rate: float | None = None):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.started_ns = time.time_ns()
+        self.ended: float | None = None
+        # name -> (start offset, duration), seconds
+        self.phases: dict[str, tuple[float, float]] = {}
+        if sample_rate is None:
+            sample_rate = TRACE_SAMPLE_RATE if span_exporter.enabled else 0.0
+        self.sampled = sample_rate > 0 and random.random() < sample_rate
+        self.trace_id = self.span_id = self.parent_span_id = ""
+        if not self.sampled:
+            return
+        self.span_id = os.urandom(8).hex()
+        parent = _TRACEPARENT.fullmatch(traceparent.strip().lower()) if traceparent else None
+        if parent is not None:
+            self.trace_id, self.parent_span_id = parent.group(1), parent.group(2)
+        else:
+            # Default request IDs are UUIDs, so the trace ID is the request ID's hex
+            try:
+                self.trace_id = uuid.UUID(request_id).hex
+            except ValueError:
+                self.trace_id = os.urandom(16).hex()
+
+    def phase(self, name: str, since: float, until: float | None = None):
+        """Record phase ``name`` from perf_counter ``since`` to ``until`` (default: now)."""
+        if until is None:
+            until = time.perf_counter()
+        self.phases[name] = (since - self.started, until - since)
+
+    def add_upstream(self, upstream: UpstreamTiming):
+        if upstream.connect is not None:
+            self.phase("connect", upstream.connect_started, upstream.connect_started + upstream.connect)
+        if upstream.ttfb is not None:
+            headers_at = upstream.started + upstream.ttfb
+            self.phase("ttfb", upstream.started, headers_at)
+            if upstream.total is not None:
+                self.phase("relay", headers_at, upstream.started + upstream.total)
+
+    def server_timing(self, upstream: UpstreamTiming | None = None) -> str:
+        """``Server-Timing`` value for the phases done so far."""
+        if upstream is not None:
+            self.add_upstream(upstream)
+        entries = [f"{name};dur={duration * 1000:.2f}" for name, (_, duration) in self.phases.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(entries)
+
+    def traceparent(self, incoming: str | None) -> str | None:
+        """What to send upstream: our span as parent when exported, else the caller's header."""
+        if self.sampled:
+            return f"00-{self.trace_id}-{self.span_id}-01"
+        return incoming
+
+    def finish(self, upstream: UpstreamTiming | None = None):
+        if upstream is not None:
+            self.add_upstream(upstream)
+        self.ended = time.perf_counter()
+
+    def as_ms(self) -> dict[str, float]:
+        return {name: round(duration * 1000, 2) for name, (_, duration) in self.phases.items()}
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _span(trace_id: str, span_id: str, parent: str, name: str, kind: int, start_ns: int, end_ns: int) -> dict:
+    return {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "parentSpanId": parent,
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+    }
+
+
+def encode_spans(timing: RequestTiming, name: str, attributes: dict, error: bool) -> list[dict]:
+    """The server span of a finished request and one child span per phase."""
+    def ns(offset: float) -> int:
+        return timing.started_ns + int(offset * 1e9)
+
+    end = (timing.ended or time.perf_counter()) - timing.started
+    root = _span(timing.trace_id, timing.span_id, timing.parent_span_id, name, SPAN_KIND_SERVER, ns(0), ns(end))
+    root["attributes"] = [_attribute(key, value) for key, value in attributes.items()]
+    root["status"] = {"code": STATUS_ERROR if error else STATUS_UNSET}
+    spans = [root]
+    for phase, (start, duration) in timing.phases.items():
+        spans.append(_span(
+            timing.trace_id, os.urandom(8).hex(), timing.span_id, f"proxy.{phase}",
+            SPAN_KIND_INTERNAL, ns(start), ns(start + duration),
+        ))
+    return spans
+
+
+class SpanExporter:
+    """Bounded queue of finished requests, exported as OTLP/JSON in the background."""
+
+    def __init__(
+        self,
+        file_path: str = TRACE_EXPORT_FILE,
+        endpoint: str = TRACE_EXPORT_ENDPOINT,
+        max_queue: int = TRACE_EXPORT_QUEUE_SIZE,
+        interval: float = TRACE_EXPORT_INTERVAL,
+        service_name: str = TRACE_SERVICE_NAME,
+    ):
+        self.file_path = Path(file_path) if file_path else None
+        self.endpoint = endpoint
+        self.max_queue = max_queue
+        self.interval = interval
+        self.resource = {"attributes": [_attribute("service.name", service_name)]}
+        self._queue: deque[tuple[RequestTiming, str, dict, bool]] = deque()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.file_path is not None or bool(self.endpoint)
+
+    def submit(self, timing: RequestTiming, name: str, attributes: dict, error: bool = False):
+        """Queue a finished request; never blocks, drops when the queue is full."""
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append((timing, name, attributes, error))
+
+    def _payload(self) -> tuple[bytes, int] | None:
+        batch = [self._queue.popleft() for _ in range(min(EXPORT_BATCH_SIZE, len(self._queue)))]
+        if not batch:
+            return None
+        spans = [span for item in batch for span in encode_spans(*item)]
+        payload = {
+            "resourceSpans": [{
+                "resource": self.resource,
+                "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+            }]
+        }
+        return codec.dumps(payload), len(batch)
+
+    def _append(self, data: bytes):
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.file_path, "ab") as f:
+            f.write(data + b"\n")
+
+    async def flush(self, client: httpx.AsyncClient | None = None):
+        """Export everything queued so far."""
+        while True:
+            result = self._payload()
+            if result is None:
+                return
+            data, count = result
+            try:
+                if self.file_path is not None:
+                    await asyncio.to_thread(self._append, data)
+                if self.endpoint and client is not None:
+                    response = await client.post(
+                        self.endpoint, content=data, headers={"Content-Type": "application/json"}
+                    )
+                    response.raise_for_status()
+                self.exported += count
+            except Exception as e:
+                self.failed += count
+                logging.warning(f"Span export failed, {count} requests lost: {e}")
+
+    async def run(self):
+        """Background task: export queued spans every ``interval`` seconds."""
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            try:
+                while True:
+                    await asyncio.sleep(self.interval)
+                    await self.flush(client)
+            finally:
+                await self.flush(client)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "file": str(self.file_path) if self.file_path is not None else None,
+            "endpoint": self.endpoint or None,
+            "queued": len(self._queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+# Global exporter used by the catch-all route
+span_exporter = SpanExporter()
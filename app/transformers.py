@@ -0,0 +1,127 @@
+"""Per-route request/response body transformers for the catch-all proxy.
+
+Transformers are registered against a route pattern and a set of methods.
+All patterns are compiled into one alternation regex, so matching a request
+is a single regex call no matter how many transformers exist. Requests on
+routes with no transformer are never buffered or parsed.
+
+A transformer receives the parsed JSON body and a ``TransformContext`` and
+returns the new body, or ``None`` to forward the original bytes untouched.
+"""
+
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Mapping
+
+from app import codec
+
+
+@dataclass
+class TransformContext:
+    """What a transformer knows about the request being proxied."""
+
+    method: str
+    path: str
+    headers: Mapping[str, str]
+    stack_id: str
+    user_id: str | None = None
+    # Extra fields merged into the request's structured log record
+    notes: dict = field(default_factory=dict)
+
+
+Transformer = Callable[[Any, TransformContext], Any]
+
+
+@dataclass
+class Route:
+    pattern: str
+    request: dict[str, list[Transformer]] = field(default_factory=dict)
+    response: dict[str, list[Transformer]] = field(default_factory=dict)
+
+
+class RouteTable:
+    """Registry of transformers matched by a precompiled route table."""
+
+    def __init__(self):
+        self._routes: list[Route] = []
+        self._compiled: re.Pattern | None = None
+
+    def _route(self, pattern: str) -> Route:
+        for route in self._routes:
+            if route.pattern == pattern:
+                return route
+        route = Route(pattern=pattern)
+        self._routes.append(route)
+        self._compiled = None
+        return route
+
+    def request(self, pattern: str, methods=("POST",)):
+        """Decorator registering a request body transformer for ``pattern``."""
+        def register(fn: Transformer) -> Transformer:
+            route = self._route(pattern)
+            for method in methods:
+                route.request.setdefault(method.upper(), []).append(fn)
+            return fn
+        return register
+
+    def response(self, pattern: str, methods=("GET",)):
+        """Decorator registering a response body transformer for ``pattern``."""
+        def register(fn: Transformer) -> Transformer:
+            route = self._route(pattern)
+            for method in methods:
+                route.response.setdefault(method.upper(), []).append(fn)
+            return fn
+        return register
+
+    def _compile(self) -> re.Pattern:
+        alternatives = "|".join(
+            f"(?P<r{i}>{route.pattern})" for i, route in enumerate(self._routes)
+        )
+        return re.compile(alternatives or r"(?!)")
+
+    def match(self, method: str, path: str) -> tuple[list[Transformer], list[Transformer]]:
+        """Return the (request, response) transformers for this request.
+
+        Patterns are matched against the full path (after the ``v1/`` strip);
+        if several patterns match, the first one registered wins.
+        """
+        if self._compiled is None:
+            self._compiled = self._compile()
+        m = self._compiled.fullmatch(path)
+        if m is None:
+            return [], []
+        route = self._routes[int(m.lastgroup[1:])]
+        return route.request.get(method, []), route.response.get(method, [])
+
+
+def apply_transformers(
+    transformers: list[Transformer], body: bytes, ctx: TransformContext
+) -> bytes | None:
+    """Run transformers over a JSON body. Returns new bytes, or None if unchanged.
+
+    Errors are logged and the original body is forwarded, matching the
+    proxy's long-standing "never break the request" behaviour.
+    """
+    try:
+        data = codec.loads(body)
+    except ValueError as e:
+        logging.error(f"Stack ID: {ctx.stack_id} Cannot transform non-JSON body on {ctx.path}: {e}")
+        return None
+
+    changed = False
+    for transformer in transformers:
+        try:
+            result = transformer(data, ctx)
+        except Exception as e:
+            logging.error(f"Stack ID: {ctx.stack_id} Transformer {transformer.__name__} failed on {ctx.path}: {e}")
+            continue
+        if result is not None:
+            data = result
+            changed = True
+
+    return codec.dumps(data) if changed else None
+
+
+# Global registry used by the catch-all route
+transformers = RouteTable()
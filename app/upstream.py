@@ -0,0 +1,90 @@
+"""Shared upstream HTTP client for requests forwarded to platform-api.
+
+One pooled ``httpx.AsyncClient`` is created in the app lifespan and reused by
+every route, so proxied calls reuse keep-alive connections instead of paying a
+new TCP+TLS handshake each time.
+"""
+
+import logging
+import httpx
+
+from app.config import env_bool, env_float, env_int
+
+
+# Connection pool tuning
+UPSTREAM_MAX_CONNECTIONS = env_int("UPSTREAM_MAX_CONNECTIONS", 100)
+UPSTREAM_MAX_KEEPALIVE = env_int("UPSTREAM_MAX_KEEPALIVE", 20)
+UPSTREAM_KEEPALIVE_EXPIRY = env_float("UPSTREAM_KEEPALIVE_EXPIRY", 30.0)
+UPSTREAM_HTTP2 = env_bool("UPSTREAM_HTTP2", False)
+
+# Timeouts (seconds)
+UPSTREAM_CONNECT_TIMEOUT = env_float("UPSTREAM_CONNECT_TIMEOUT", 5.0)
+UPSTREAM_READ_TIMEOUT = env_float("UPSTREAM_READ_TIMEOUT", 30.0)
+UPSTREAM_WRITE_TIMEOUT = env_float("UPSTREAM_WRITE_TIMEOUT", 30.0)
+UPSTREAM_POOL_TIMEOUT = env_float("UPSTREAM_POOL_TIMEOUT", 5.0)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_upstream_client() -> httpx.AsyncClient:
+    """Build the long-lived pooled client used for all upstream calls."""
+    http2 = UPSTREAM_HTTP2
+    if http2 and not _http2_available():
+        logging.warning("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed, using HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_WRITE_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT,
+    )
+    logging.info(
+        f"Upstream client: http2={http2} max_connections={limits.max_connections} "
+        f"max_keepalive={limits.max_keepalive_connections} keepalive_expiry={limits.keepalive_expiry}"
+    )
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+
+# Upstream response headers relayed to the client. Everything else (hop-by-hop
+# headers, content-length of a re-chunked body, upstream server details) is dropped.
+RELAYED_RESPONSE_HEADERS = ("content-type", "content-encoding", "etag", "cache-control")
+
+
+def relay_response_headers(upstream_headers: httpx.Headers) -> dict[str, str]:
+    """Pick the upstream response headers that are safe to pass to the client."""
+    return {
+        name: upstream_headers[name]
+        for name in RELAYED_RESPONSE_HEADERS
+        if name in upstream_headers
+    }
+
+
+def pool_stats(client: httpx.AsyncClient) -> dict | None:
+    """Active/idle/waiting counts for the client's connection pool.
+
+    Reads httpcore's pool state, so it returns None if the transport is not
+    the default pooled one (e.g. a mock transport in tests).
+    """
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return None
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "active": len(connections) - idle,
+        "idle": idle,
+        "max": getattr(pool, "_max_connections", UPSTREAM_MAX_CONNECTIONS),
+        "waiting": sum(1 for request in getattr(pool, "_requests", ()) if request.is_queued()),
+    }
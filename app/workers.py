@@ -0,0 +1,204 @@
+"""Coordination between uvicorn worker processes (``--workers N``).
+
+Workers share state only through files in ``WORKER_STATE_DIR``:
+
+- ``FileLock``: an ``flock`` on a lock file. Leader election takes
+  ``leader.lock`` without blocking and holds it for the life of the process.
+  The single worker that gets it runs startup ingestion. If the leader dies,
+  the kernel drops the lock, and the worker started in its place takes over.
+  Writers of shared files also hold a blocking lock around their
+  read-modify-write.
+- ``atomic_write``: a temp file in the same directory, fsynced, then
+  ``os.replace``d into place. Readers see either the old or the new file,
+  never half of one.
+- ``ChangeNotifier``: each worker binds a Unix datagram socket in the state
+  directory. After changing shared state, a worker sends a short topic
+  (e.g. ``sources``) to all its peers, which reload at once. The request
+  path never checks the filesystem; background pollers remain only as a slow
+  safety net. The peer list is cached: it is rescanned off the event loop
+  every ``WORKER_PEER_REFRESH_SECONDS``, and at once when a new worker
+  announces itself. Datagrams are sent from a thread.
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import socket
+from pathlib import Path
+from typing import Callable
+
+from app.config import env_float
+
+
+WORKER_STATE_DIR = os.getenv("WORKER_STATE_DIR", "")
+# How often the cached list of peer worker sockets is rescanned (seconds)
+WORKER_PEER_REFRESH_SECONDS = env_float("WORKER_PEER_REFRESH_SECONDS", 5.0)
+
+# Sent by a worker that just started, so its peers rescan at once
+PEERS_TOPIC = "peers"
+
+
+def atomic_write(path: Path, data: bytes):
+    """Replace ``path`` with ``data`` atomically. Blocking."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class FileLock:
+    """Exclusive ``flock`` on ``path``, held by at most one process at a time."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int | None = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True, content: str | None = None) -> bool:
+        """Take the lock and write ``content`` (default: our pid) into the file.
+
+        Blocking when ``blocking``; call through ``asyncio.to_thread`` from async code.
+        """
+        if self._fd is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        os.ftruncate(fd, 0)
+        os.write(fd, (content or f"{os.getpid()}\n").encode())
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class _NotifyProtocol(asyncio.DatagramProtocol):
+    def __init__(self, notifier: "ChangeNotifier"):
+        self.notifier = notifier
+
+    def datagram_received(self, data: bytes, addr):
+        self.notifier.received += 1
+        topic = data.decode(errors="replace")
+        if topic == PEERS_TOPIC:
+            self.notifier.refresh_soon()
+        else:
+            self.notifier.on_message(topic)
+
+
+class ChangeNotifier:
+    """Best-effort "something changed" datagrams between sibling workers."""
+
+    def __init__(self, directory: Path, on_message: Callable[[str], None], name: str | None = None):
+        self.directory = directory
+        self.on_message = on_message
+        self.path = directory / f"{name or os.getpid()}.sock"
+        self._transport: asyncio.DatagramTransport | None = None
+        self._sender: socket.socket | None = None
+        self._peers: list[Path] = []
+        self._tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.received = 0
+        self.refreshes = 0
+
+    async def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _NotifyProtocol(self), local_addr=str(self.path), family=socket.AF_UNIX
+        )
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        await self.refresh()
+        self.notify(PEERS_TOPIC)
+
+    def _scan(self) -> list[Path]:
+        """Sockets of the other workers. Blocking."""
+        return [peer for peer in self.directory.glob("*.sock") if peer != self.path]
+
+    async def refresh(self):
+        """Rescan the peer sockets off the event loop."""
+        self._peers = await asyncio.to_thread(self._scan)
+        self.refreshes += 1
+
+    def refresh_soon(self):
+        self._spawn(self.refresh())
+
+    async def watch(self, interval: float = WORKER_PEER_REFRESH_SECONDS):
+        """Background task: pick up workers that started or died since the last scan."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except OSError as e:
+                logging.warning(f"Rescanning worker sockets failed: {e}")
+
+    def notify(self, topic: str):
+        """Send ``topic`` to every other live worker, from a thread; sockets of dead ones are removed."""
+        if self._sender is None or not self._peers:
+            return
+        self._spawn(self._send_all(topic.encode(), list(self._peers)))
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_all(self, data: bytes, peers: list[Path]):
+        dead = await asyncio.to_thread(self._send, data, peers)
+        if dead:
+            self._peers = [peer for peer in self._peers if peer not in dead]
+
+    def _send(self, data: bytes, peers: list[Path]) -> list[Path]:
+        """Blocking; returns the peers found dead."""
+        dead = []
+        for peer in peers:
+            sender = self._sender
+            if sender is None:
+                break
+            try:
+                sender.sendto(data, str(peer))
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                peer.unlink(missing_ok=True)
+                dead.append(peer)
+            except OSError as e:
+                # A full peer buffer just means it will catch up on its next poll
+                logging.debug(f"Notifying {peer} failed: {e}")
+        return dead
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+        self.path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "peers": len(self._peers),
+            "sent": self.sent,
+            "received": self.received,
+            "peer_refreshes": self.refreshes,
+        }
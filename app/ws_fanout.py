@@ -0,0 +1,229 @@
+"""Fan-out of one upstream WebSocket subscription to many local subscribers.
+
+Several tabs or collaborators often watch the same story generation or
+upload channel. Instead of one upstream socket (and one platform-api pub/sub
+subscription) per browser, the proxy keeps a single upstream connection per
+channel and broadcasts its frames to every local subscriber.
+
+Channels are reference-counted: the upstream socket is opened by the first
+subscriber, with that subscriber's headers, and closed when the last one
+leaves. Frames from any subscriber are forwarded upstream on the shared socket.
+
+The broadcast never waits on a subscriber. Each one has a bounded queue, and
+when it is full ``WS_SLOW_CONSUMER_POLICY`` decides what happens:
+
+  drop_oldest  discard the oldest queued frame to make room (default)
+  drop_newest  discard the incoming frame
+  disconnect   close that subscriber with 1013 (try again later)
+"""
+
+import asyncio
+import logging
+import os
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketDisconnect
+from websockets.asyncio.client import ClientConnection
+from websockets.exceptions import ConnectionClosed
+
+from app.config import env_bool, env_int
+from app.ws_relay import GOING_AWAY, INTERNAL_ERROR, Closed, close_from, open_upstream, sendable
+
+
+WS_FANOUT_ENABLED = env_bool("WS_FANOUT_ENABLED", True)
+# Frames queued per subscriber before the slow-consumer policy applies
+WS_SUBSCRIBER_BUFFER_FRAMES = env_int("WS_SUBSCRIBER_BUFFER_FRAMES", 256)
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+TRY_AGAIN_LATER = 1013
+
+
+class Subscriber:
+    """One local client of a shared channel."""
+
+    def __init__(self, websocket: WebSocket, buffer_frames: int | None = None):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(
+            maxsize=WS_SUBSCRIBER_BUFFER_FRAMES if buffer_frames is None else buffer_frames
+        )
+        self.dropped = 0
+        self.evicted = False
+
+    def offer(self, message, policy: str) -> bool:
+        """Queue a frame without waiting. Returns False if the subscriber must go."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.dropped += 1
+        if policy == "drop_newest":
+            return True
+        if policy == "disconnect":
+            self.evicted = True
+            self.close(Closed(TRY_AGAIN_LATER, "slow consumer"))
+            return False
+        self.queue.get_nowait()  # drop_oldest
+        self.queue.put_nowait(message)
+        return True
+
+    def close(self, closed: Closed):
+        """Deliver a close sentinel, discarding queued frames if there is no room."""
+        while True:
+            try:
+                self.queue.put_nowait(closed)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+
+class Channel:
+    """A shared upstream socket and the subscribers listening to it."""
+
+    def __init__(self, key: str, upstream: ClientConnection, policy: str):
+        self.key = key
+        self.upstream = upstream
+        self.policy = policy
+        self.subscribers: set[Subscriber] = set()
+        self.closed: Closed | None = None
+        self.pump: asyncio.Task | None = None
+
+    async def run_pump(self):
+        """Read upstream frames and broadcast them to every subscriber."""
+        try:
+            async for message in self.upstream:
+                for subscriber in list(self.subscribers):
+                    if not subscriber.offer(message, self.policy):
+                        self.subscribers.discard(subscriber)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            logging.warning(f"WebSocket channel {self.key} upstream read failed: {e!r}")
+        self.closed = close_from(self.upstream)
+        for subscriber in list(self.subscribers):
+            subscriber.close(self.closed)
+
+
+class ChannelHub:
+    """Reference-counted registry of shared upstream channels."""
+
+    def __init__(self, policy: str | None = None):
+        policy = policy or WS_SLOW_CONSUMER_POLICY
+        if policy not in SLOW_CONSUMER_POLICIES:
+            logging.warning(f"Unknown WS_SLOW_CONSUMER_POLICY {policy!r}, using drop_oldest")
+            policy = "drop_oldest"
+        self.policy = policy
+        self.channels: dict[str, Channel] = {}
+        self._opening: dict[str, asyncio.Future] = {}
+
+    async def subscribe(
+        self, key: str, upstream_url: str, headers: dict[str, str], subscriber: Subscriber
+    ) -> Channel:
+        """Attach to the channel for ``key``, opening the upstream socket if needed."""
+        while True:
+            channel = self.channels.get(key)
+            if channel is not None and channel.closed is None:
+                channel.subscribers.add(subscriber)
+                return channel
+
+            opening = self._opening.get(key)
+            if opening is not None:
+                # Another subscriber is connecting; wait for it, then retry
+                await asyncio.shield(opening)
+                continue
+
+            opening = asyncio.get_running_loop().create_future()
+            self._opening[key] = opening
+            try:
+                upstream = await open_upstream(upstream_url, headers)
+                channel = Channel(key, upstream, self.policy)
+                channel.subscribers.add(subscriber)
+                channel.pump = asyncio.create_task(channel.run_pump())
+                self.channels[key] = channel
+                return channel
+            finally:
+                del self._opening[key]
+                opening.set_result(None)
+
+    async def unsubscribe(self, channel: Channel, subscriber: Subscriber, closed: Closed):
+        """Detach; the last subscriber out closes the upstream socket."""
+        channel.subscribers.discard(subscriber)
+        if channel.subscribers:
+            return
+        if self.channels.get(channel.key) is channel:
+            del self.channels[channel.key]
+        if channel.pump is not None:
+            channel.pump.cancel()
+        # Own task, so the close completes even if the caller is being cancelled
+        closing = asyncio.create_task(channel.upstream.close(closed.code, closed.reason))
+        await asyncio.shield(closing)
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "channels": len(self.channels),
+            "subscribers": sum(len(c.subscribers) for c in self.channels.values()),
+        }
+
+
+async def _client_to_upstream(websocket: WebSocket, channel: Channel) -> Closed:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return Closed(sendable(message.get("code")), message.get("reason") or "")
+        data = message.get("text")
+        if data is None:
+            data = message.get("bytes")
+        if data is not None:
+            await channel.upstream.send(data)
+
+
+async def _queue_to_client(subscriber: Subscriber) -> Closed:
+    while True:
+        item = await subscriber.queue.get()
+        if isinstance(item, Closed):
+            return item
+        if isinstance(item, str):
+            await subscriber.websocket.send_text(item)
+        else:
+            await subscriber.websocket.send_bytes(item)
+
+
+async def fanout(hub: ChannelHub, websocket: WebSocket, key: str, upstream_url: str, headers: dict[str, str]):
+    """Serve one client WebSocket from the shared channel for ``key``."""
+    subscriber = Subscriber(websocket)
+    try:
+        channel = await hub.subscribe(key, upstream_url, headers, subscriber)
+    except Exception as e:
+        logging.warning(f"WebSocket upstream connect failed for {upstream_url}: {e!r}")
+        await websocket.close(code=INTERNAL_ERROR)
+        return
+
+    leave_with = Closed(GOING_AWAY)
+    try:
+        await websocket.accept()
+        reader = asyncio.create_task(_client_to_upstream(websocket, channel))
+        writer = asyncio.create_task(_queue_to_client(subscriber))
+        try:
+            done, _ = await asyncio.wait([reader, writer], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            reader.cancel()
+            writer.cancel()
+            await asyncio.gather(reader, writer, return_exceptions=True)
+
+        close_client = Closed(GOING_AWAY)
+        if writer in done and writer.exception() is None:
+            close_client = writer.result()
+        if reader in done and reader.exception() is None:
+            leave_with = reader.result()
+        try:
+            await websocket.close(code=close_client.code, reason=close_client.reason)
+        except (RuntimeError, WebSocketDisconnect):
+            pass  # client already gone
+    finally:
+        await hub.unsubscribe(channel, subscriber, leave_with)
+
+
+# Global hub used by the WebSocket routes
+hub = ChannelHub()
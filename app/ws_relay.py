@@ -0,0 +1,174 @@
+"""WebSocket relay between browser clients and platform-api.
+
+platform-api hands out WebSocket addresses on the proxy's host (via
+``X-Forwarded-Host``). This module accepts those connections, opens the
+matching upstream socket with the proxy's ``X-API-Key``/``X-Domain``/
+``X-User-ID`` headers, and pumps frames both ways concurrently.
+
+Each direction has a bounded queue between a reader and a writer task. When
+a queue is full the reader stops reading, so a slow receiver pushes back on
+the sender through TCP instead of growing memory. Frames already queued are
+flushed when the sending side closes; when either side disconnects, the
+other is closed promptly with the same close code.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketDisconnect
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import ConnectionClosed
+
+from app.config import env_float, env_int
+
+
+# Frames buffered per direction before the reader applies backpressure
+WS_BUFFER_FRAMES = env_int("WS_BUFFER_FRAMES", 64)
+# Largest single frame accepted from upstream (bytes)
+WS_MAX_MESSAGE_BYTES = env_int("WS_MAX_MESSAGE_BYTES", 16 * 1024 * 1024)
+WS_CONNECT_TIMEOUT = env_float("WS_CONNECT_TIMEOUT", 10.0)
+WS_PING_INTERVAL = env_float("WS_PING_INTERVAL", 20.0)
+# How long to wait for the upstream close handshake before dropping the TCP connection
+WS_CLOSE_TIMEOUT = env_float("WS_CLOSE_TIMEOUT", 5.0)
+
+NORMAL_CLOSURE = 1000
+GOING_AWAY = 1001
+INTERNAL_ERROR = 1011
+
+
+@dataclass
+class Closed:
+    """Queue sentinel: the reading side is gone, with this close code."""
+
+    code: int = NORMAL_CLOSURE
+    reason: str = ""
+
+
+def upstream_ws_url(base_url: str, path: str, query: str = "") -> str:
+    """Map the HTTP API base URL and a proxy path onto the upstream ws:// URL."""
+    if base_url.startswith("https://"):
+        base_url = "wss://" + base_url[len("https://"):]
+    elif base_url.startswith("http://"):
+        base_url = "ws://" + base_url[len("http://"):]
+    url = f"{base_url.rstrip('/')}/{path.lstrip('/')}"
+    return f"{url}?{query}" if query else url
+
+
+async def open_upstream(url: str, headers: dict[str, str]) -> ClientConnection:
+    return await connect(
+        url,
+        additional_headers=headers,
+        open_timeout=WS_CONNECT_TIMEOUT,
+        ping_interval=WS_PING_INTERVAL,
+        close_timeout=WS_CLOSE_TIMEOUT,
+        max_size=WS_MAX_MESSAGE_BYTES,
+        max_queue=WS_BUFFER_FRAMES,
+    )
+
+
+async def _read_client(websocket: WebSocket, queue: asyncio.Queue):
+    closed = Closed(GOING_AWAY)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                closed = Closed(sendable(message.get("code")), message.get("reason") or "")
+                break
+            data = message.get("text")
+            if data is None:
+                data = message.get("bytes")
+            if data is not None:
+                await queue.put(data)
+    except Exception as e:
+        logging.warning(f"WebSocket client read failed: {e!r}")
+    await queue.put(closed)
+
+
+async def _write_upstream(upstream: ClientConnection, queue: asyncio.Queue) -> Closed:
+    while True:
+        item = await queue.get()
+        if isinstance(item, Closed):
+            return item
+        await upstream.send(item)
+
+
+async def _read_upstream(upstream: ClientConnection, queue: asyncio.Queue):
+    try:
+        async for message in upstream:
+            await queue.put(message)
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        logging.warning(f"WebSocket upstream read failed: {e!r}")
+    await queue.put(close_from(upstream))
+
+
+async def _write_client(websocket: WebSocket, queue: asyncio.Queue) -> Closed:
+    while True:
+        item = await queue.get()
+        if isinstance(item, Closed):
+            return item
+        if isinstance(item, str):
+            await websocket.send_text(item)
+        else:
+            await websocket.send_bytes(item)
+
+
+def sendable(code: int | None) -> int:
+    """Map close codes that may not appear in a Close frame onto ones that can."""
+    if code == 1005:  # no status received
+        return NORMAL_CLOSURE
+    if code is None or code == 1006:  # abnormal closure
+        return GOING_AWAY
+    return code
+
+
+def close_from(upstream: ClientConnection) -> Closed:
+    return Closed(sendable(upstream.close_code), upstream.close_reason or "")
+
+
+async def relay(websocket: WebSocket, upstream_url: str, headers: dict[str, str]):
+    """Proxy one client WebSocket to ``upstream_url`` until either side closes."""
+    try:
+        upstream = await open_upstream(upstream_url, headers)
+    except Exception as e:
+        logging.warning(f"WebSocket upstream connect failed for {upstream_url}: {e!r}")
+        # Closing before accept rejects the handshake (HTTP 403 to the client)
+        await websocket.close(code=INTERNAL_ERROR)
+        return
+
+    await websocket.accept()
+
+    to_upstream: asyncio.Queue = asyncio.Queue(maxsize=WS_BUFFER_FRAMES)
+    to_client: asyncio.Queue = asyncio.Queue(maxsize=WS_BUFFER_FRAMES)
+    readers = [
+        asyncio.create_task(_read_client(websocket, to_upstream)),
+        asyncio.create_task(_read_upstream(upstream, to_client)),
+    ]
+    client_to_upstream = asyncio.create_task(_write_upstream(upstream, to_upstream))
+    upstream_to_client = asyncio.create_task(_write_client(websocket, to_client))
+
+    close_upstream = close_client = Closed(GOING_AWAY)
+    try:
+        done, _ = await asyncio.wait(
+            [client_to_upstream, upstream_to_client], return_when=asyncio.FIRST_COMPLETED
+        )
+        if client_to_upstream in done and client_to_upstream.exception() is None:
+            close_upstream = client_to_upstream.result()
+        if upstream_to_client in done and upstream_to_client.exception() is None:
+            close_client = upstream_to_client.result()
+    finally:
+        tasks = (*readers, client_to_upstream, upstream_to_client)
+        for task in tasks:
+            task.cancel()
+        # Close upstream in its own task so it completes even if this handler
+        # is being cancelled (server shutdown, client gone mid-teardown)
+        closing = asyncio.create_task(upstream.close(close_upstream.code, close_upstream.reason))
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.shield(closing)
+            await websocket.close(code=close_client.code, reason=close_client.reason)
+        except (RuntimeError, WebSocketDisconnect, ConnectionClosed):
+            pass  # one side already gone
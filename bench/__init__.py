@@ -0,0 +1 @@
+"""Offline load benchmarks for the proxy (see ``bench/run.py``)."""
@@ -0,0 +1,228 @@
+"""Replay captured proxy traffic and report latency distributions.
+
+Reads the JSONL ring written by the proxy's traffic capture (``CAPTURE_ENABLED``,
+see ``app/capture.py``) and sends the requests again, in capture order:
+
+  python -m bench.replay captures/                    # original pacing, local stand-in + proxy
+  python -m bench.replay captures/ --speed 4          # 4x faster than captured
+  python -m bench.replay captures/ --concurrency 32   # as fast as 32 clients can go
+  python -m bench.replay captures/ --target http://localhost:8000   # a proxy that is already running
+
+Without ``--target``, ``bench.standin`` and the proxy are started on loopback
+as for ``bench.run``, so replays need no services or network access. The
+stand-in answers routes it does not know with a small JSON echo.
+
+Timed replays (``--speed``) are open-loop: each request is sent at its
+captured offset divided by the speed, whether or not earlier ones returned.
+``lag_p99_ms`` reports how late the client itself sent requests; when it grows,
+the replay is limited by this process, not by the proxy.
+``--concurrency`` replays are closed-loop, like ``bench.run``.
+
+Headers redacted at capture are left out. The proxy injects its own API key
+anyway. Bodies cut at capture are padded back to their original size: the
+transfer cost is preserved, not the content. The report has one row per
+normalized route plus ``all``: requests, errors (transport errors and 5xx),
+responses whose status differs from the captured one, and latency
+percentiles.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import httpx
+
+from app.metrics import normalize_route
+from bench.run import local_stack, percentile, print_table
+
+
+TABLE_COLUMNS = ("requests", "errors", "mismatched", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+# Captured headers that must not be sent again as they are
+NOT_REPLAYED = frozenset({"x-request-id", "traceparent"})
+REDACTED = "[REDACTED]"
+
+
+@dataclass
+class Result:
+    route: str
+    latency: float
+    status: int | None  # None: transport error
+    expected: int | None
+    lag: float = 0.0
+
+
+def capture_files(paths: list[Path]) -> list[Path]:
+    """The given files, plus the capture ring files of the given directories."""
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(path.glob("capture.jsonl*")))
+        else:
+            files.append(path)
+    return files
+
+
+def load_records(paths: list[Path], limit: int | None = None) -> list[dict]:
+    """Captured requests from all files, oldest first; unreadable lines are skipped."""
+    records = []
+    for path in capture_files(paths):
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "method" in record and "path" in record:
+                    records.append(record)
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records[:limit] if limit else records
+
+
+def build_request(record: dict) -> tuple[str, str, dict[str, str], bytes | None]:
+    """(method, URL path with query, headers, body) to send for a captured request."""
+    headers = {
+        name: value for name, value in record.get("headers", {}).items()
+        if value != REDACTED and name.lower() not in NOT_REPLAYED
+    }
+    if "body_b64" in record:
+        body = base64.b64decode(record["body_b64"])
+    else:
+        body = record.get("body", "").encode()
+    if record.get("body_truncated"):
+        body += b" " * max(record.get("body_bytes", 0) - len(body), 0)
+    url = record["path"] + (f"?{record['query']}" if record.get("query") else "")
+    return record["method"], url, headers, body or None
+
+
+def route_of(path: str) -> str:
+    return normalize_route(path.removeprefix("/api/"))
+
+
+async def send(client: httpx.AsyncClient, record: dict, lag: float = 0.0) -> Result:
+    method, url, headers, body = build_request(record)
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, headers=headers, content=body)
+        await response.aread()
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return Result(route_of(record["path"]), time.perf_counter() - started, status, record.get("status"), lag)
+
+
+async def replay_timed(client: httpx.AsyncClient, records: list[dict], speed: float) -> list[Result]:
+    """Open loop: send each request at its captured offset divided by ``speed``."""
+    if not records:
+        return []
+    first = records[0].get("ts", 0)
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        due = started + (record.get("ts", first) - first) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send(client, record, max(time.perf_counter() - due, 0.0))))
+    return list(await asyncio.gather(*tasks))
+
+
+async def replay_concurrent(client: httpx.AsyncClient, records: list[dict], concurrency: int) -> list[Result]:
+    """Closed loop: ``concurrency`` clients, each sending its next request when the last one returns."""
+    pending = iter(records)
+    results: list[Result] = []
+
+    async def worker():
+        for record in pending:
+            results.append(await send(client, record))
+
+    await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+    return results
+
+
+def summarize(results: list[Result], elapsed: float) -> dict[str, dict]:
+    """One report row per route, plus ``all``."""
+    by_route: dict[str, list[Result]] = {}
+    for result in results:
+        by_route.setdefault(result.route, []).append(result)
+    rows = {}
+    for route, group in sorted(by_route.items(), key=lambda item: -len(item[1])) + [("all", results)]:
+        latencies = sorted(result.latency for result in group)
+        rows[route] = {
+            "requests": len(group),
+            "errors": sum(1 for result in group if result.status is None or result.status >= 500),
+            "mismatched": sum(
+                1 for result in group if result.expected is not None and result.status != result.expected
+            ),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+    lags = sorted(result.lag for result in results)
+    rows["all"]["rps"] = round(len(results) / elapsed, 1) if elapsed > 0 else 0.0
+    rows["all"]["lag_p99_ms"] = round(percentile(lags, 99) * 1000, 2)
+    return rows
+
+
+async def replay(target: str, records: list[dict], speed: float, concurrency: int | None) -> dict[str, dict]:
+    limits = httpx.Limits(max_connections=concurrency or 1000, max_keepalive_connections=concurrency or 100)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        if concurrency:
+            results = await replay_concurrent(client, records, concurrency)
+        else:
+            results = await replay_timed(client, records, speed)
+        return summarize(results, time.perf_counter() - started)
+
+
+# ── main ─────────────────────────────────────────────────────────────────────
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", type=Path, help="capture directories or JSONL files")
+    parser.add_argument("--target", help="proxy to replay against (default: a local stand-in + proxy)")
+    parser.add_argument("--speed", type=float, default=1.0, help="pacing multiplier for timed replay")
+    parser.add_argument("--concurrency", type=int, help="closed-loop clients instead of timed replay")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="stand-in upstream latency")
+    parser.add_argument("--large-kb", type=int, default=512, help="stand-in large JSON response size")
+    parser.add_argument("--proxy-arg", action="append", default=[], help="extra uvicorn argument for the proxy")
+    parser.add_argument("--output", type=Path, help="also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    if args.speed <= 0:
+        print("--speed must be positive", file=sys.stderr)
+        return 2
+    records = load_records(args.captures, args.limit)
+    if not records:
+        print(f"No captured requests in {', '.join(map(str, args.captures))}", file=sys.stderr)
+        return 2
+
+    mode = f"{args.concurrency} clients" if args.concurrency else f"{args.speed:g}x speed"
+    print(f"Replaying {len(records)} requests at {mode}...", flush=True)
+    if args.target:
+        report = asyncio.run(replay(args.target, records, args.speed, args.concurrency))
+    else:
+        with local_stack(args.latency_ms, args.large_kb, args.proxy_arg) as (proxy_url, _):
+            report = asyncio.run(replay(proxy_url, records, args.speed, args.concurrency))
+
+    print()
+    print_table(report, columns=TABLE_COLUMNS, label="route")
+    overall = report["all"]
+    print(f"\n{overall['rps']} requests/s; client send lag p99 {overall['lag_p99_ms']} ms")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+"""Load benchmark: the proxy against a local stand-in platform-api.
+
+Starts ``bench.standin`` and ``app.main:app`` as uvicorn subprocesses on free
+local ports, drives each traffic mix with a fixed number of concurrent
+clients, and reports throughput, latency percentiles and the proxy's RSS.
+Everything runs on loopback, so no services or network access are needed.
+
+  python -m bench.run                                # all mixes, compare to baseline if present
+  python -m bench.run --mixes small-get,upload       # a subset
+  python -m bench.run --save-baseline                # record bench/baseline.json
+  python -m bench.run --scaling 1,2,4                # throughput per proxy worker count
+
+A run fails (exit status 1) when any mix is slower than the baseline by more
+than ``--threshold``: lower RPS, or higher p95/p99 latency or RSS.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+import httpx
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# Metrics compared against the baseline, and which direction is worse
+HIGHER_IS_WORSE = ("p95_ms", "p99_ms", "rss_mb")
+LOWER_IS_WORSE = ("rps",)
+TABLE_COLUMNS = ("requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "rss_mb")
+
+
+@dataclass
+class Scenario:
+    """One kind of request in a traffic mix."""
+
+    method: str
+    path: str
+    weight: int = 1
+    headers: dict[str, str] = field(default_factory=dict)
+    body: bytes | None = None
+    expect: tuple[int, ...] = (200,)
+
+
+def multipart_body(size_kb: int) -> tuple[bytes, str]:
+    """Pre-encoded multipart upload, so the load generator does no encoding work."""
+    boundary = "benchboundary7d9f"
+    payload = os.urandom(size_kb * 1024)
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def build_mixes(upload_kb: int) -> dict[str, list[Scenario]]:
+    chat = json.dumps({"message": "Summarize the sources", "user-config-params": {}}).encode()
+    upload, upload_type = multipart_body(upload_kb)
+    small_get = Scenario("GET", "/api/v1/project/list")
+    chat_async = Scenario(
+        "POST", "/api/v1/chat/async", headers={"Content-Type": "application/json"}, body=chat, expect=(202,)
+    )
+    large_json = Scenario("GET", "/api/stories/large")
+    multipart = Scenario("POST", "/api/sources/upload-source", headers={"Content-Type": upload_type}, body=upload)
+    return {
+        "small-get": [small_get],
+        "chat-async": [chat_async],
+        "large-json": [large_json],
+        "upload": [multipart],
+        "mixed": [
+            Scenario(**{**small_get.__dict__, "weight": 70}),
+            Scenario(**{**chat_async.__dict__, "weight": 15}),
+            Scenario(**{**large_json.__dict__, "weight": 10}),
+            Scenario(**{**multipart.__dict__, "weight": 5}),
+        ],
+    }
+
+
+# ── processes ────────────────────────────────────────────────────────────────
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args: list[str], env: dict[str, str], log_path: Path) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", *args],
+        cwd=ROOT,
+        env={**os.environ, **env},
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def wait_until(check, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except (httpx.HTTPError, OSError):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {what}")
+
+
+def rss_bytes(pid: int) -> int | None:
+    """Resident memory of ``pid`` and its descendants (Linux only)."""
+    try:
+        total = 0
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                total += rss_bytes(int(child)) or 0
+        return total
+    except (FileNotFoundError, ProcessLookupError, ValueError):
+        return None
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ── load generation ──────────────────────────────────────────────────────────
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def drive(
+    base_url: str, mix: list[Scenario], concurrency: int, duration: float, warmup: float, first_user: int = 0
+) -> tuple[list[float], int, float]:
+    """Closed-loop load: each worker sends its next request when the last one returns.
+
+    Returns the measured latencies, the error count and the measured seconds.
+    """
+    picks = [scenario for scenario in mix for _ in range(scenario.weight)]
+    latencies: list[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def worker(n: int):
+            nonlocal errors
+            rng = random.Random(n)
+            # One user per worker: realistic per-user caching/coalescing, not one hot key
+            user = {"X-User-ID": f"bench-{n}"}
+            while True:
+                scenario = rng.choice(picks)
+                t0 = time.perf_counter()
+                if t0 >= stop_at:
+                    return
+                try:
+                    response = await client.request(
+                        scenario.method, scenario.path, headers={**scenario.headers, **user}, content=scenario.body
+                    )
+                    ok = response.status_code in scenario.expect
+                except httpx.HTTPError:
+                    ok = False
+                t1 = time.perf_counter()
+                if t0 >= measure_from:
+                    latencies.append(t1 - t0)
+                    if not ok:
+                        errors += 1
+
+        await asyncio.gather(*(worker(n) for n in range(first_user, first_user + concurrency)))
+        elapsed = time.perf_counter() - measure_from
+
+    return latencies, errors, elapsed
+
+
+def _drive_process(job: tuple) -> tuple[list[float], int, float]:
+    return asyncio.run(drive(*job))
+
+
+def drive_parallel(
+    base_url: str, mix: list[Scenario], concurrency: int, duration: float, warmup: float, processes: int
+) -> dict:
+    """Split the clients over ``processes`` load generator processes and merge their results.
+
+    One Python process cannot saturate several proxy workers, so scaling runs
+    generate load from as many processes as there are workers.
+    """
+    if processes <= 1:
+        return summarize(*asyncio.run(drive(base_url, mix, concurrency, duration, warmup)))
+    share = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+    jobs = [(base_url, mix, n, duration, warmup, sum(share[:i])) for i, n in enumerate(share) if n]
+    with ProcessPoolExecutor(len(jobs)) as pool:
+        parts = list(pool.map(_drive_process, jobs))
+    latencies = [latency for part in parts for latency in part[0]]
+    return summarize(latencies, sum(part[1] for part in parts), max(part[2] for part in parts))
+
+
+# ── baseline ─────────────────────────────────────────────────────────────────
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Describe every metric that regressed by more than ``threshold`` (a fraction)."""
+    regressions = []
+    for mix, current in results.items():
+        before = baseline.get(mix)
+        if not before:
+            continue
+        for metric in HIGHER_IS_WORSE:
+            if current.get(metric) is not None and before.get(metric):
+                if current[metric] > before[metric] * (1 + threshold):
+                    regressions.append(f"{mix}: {metric} {before[metric]} -> {current[metric]}")
+        for metric in LOWER_IS_WORSE:
+            if current.get(metric) is not None and before.get(metric):
+                if current[metric] < before[metric] * (1 - threshold):
+                    regressions.append(f"{mix}: {metric} {before[metric]} -> {current[metric]}")
+    return regressions
+
+
+def print_table(results: dict, columns: tuple[str, ...] = TABLE_COLUMNS, label: str = "mix"):
+    width = max([12, *(len(mix) + 2 for mix in results)])
+    print(f"{label:<{width}}" + "".join(f"{c:>11}" for c in columns))
+    for mix, row in results.items():
+        print(f"{mix:<{width}}" + "".join(f"{'-' if row.get(c) is None else row[c]:>11}" for c in columns))
+
+
+# ── main ─────────────────────────────────────────────────────────────────────
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mixes", default="small-get,chat-async,large-json,upload,mixed")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per mix")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per mix")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="stand-in upstream latency")
+    parser.add_argument("--large-kb", type=int, default=512, help="large JSON response size")
+    parser.add_argument("--upload-kb", type=int, default=1024, help="multipart upload size")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed regression (fraction)")
+    parser.add_argument("--output", type=Path, help="also write results to this JSON file")
+    parser.add_argument("--proxy-arg", action="append", default=[], help="extra uvicorn argument for the proxy")
+    parser.add_argument(
+        "--scaling", metavar="COUNTS", help="compare proxy worker counts, e.g. 1,2,4 (no baseline check)"
+    )
+    return parser.parse_args(argv)
+
+
+@contextmanager
+def local_stack(
+    latency_ms: float, large_kb: int, proxy_args: list[str] = (), workers: int = 1
+) -> Iterator[tuple[str, subprocess.Popen]]:
+    """Run the stand-in and the proxy until the block exits; yields (proxy URL, proxy process)."""
+    with tempfile.TemporaryDirectory(prefix="proxy-bench-") as tmp:
+        tmp_path = Path(tmp)
+        upstream_port, proxy_port = free_port(), free_port()
+        upstream_url = f"http://127.0.0.1:{upstream_port}"
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        source_file = tmp_path / "sources.json"
+        proxy_args = list(proxy_args)
+        if workers > 1:
+            proxy_args += ["--workers", str(workers)]
+
+        # The stand-in gets the same worker count so it is never the bottleneck
+        upstream = start_server(
+            [
+                "bench.standin:app", "--port", str(upstream_port), "--log-level", "warning", "--no-access-log",
+                "--workers", str(max(workers, 1)),
+            ],
+            {"BENCH_LATENCY_MS": str(latency_ms), "BENCH_LARGE_KB": str(large_kb)},
+            tmp_path / "standin.log",
+        )
+        proxy = start_server(
+            ["app.main:app", "--port", str(proxy_port), "--log-level", "warning", "--no-access-log", *proxy_args],
+            {
+                "API_URL": upstream_url,
+                "SOURCE_REGISTRY_FILE": str(source_file),
+                "SOURCE_MANIFEST_FILE": str(tmp_path / "source_manifest.json"),
+                # Rate limits would throttle the closed-loop workers; the benchmark measures proxy overhead
+                "RATE_LIMIT_ENABLED": "false",
+            },
+            tmp_path / "proxy.log",
+        )
+        try:
+            wait_until(lambda: httpx.get(f"{upstream_url}/project/list").status_code == 200, 30, "stand-in upstream")
+            wait_until(lambda: httpx.get(f"{proxy_url}/metrics").status_code == 200, 30, "proxy")
+            # chat/async only succeeds once startup ingestion has enabled injection
+            wait_until(lambda: httpx.get(f"{proxy_url}/ready").status_code == 200, 30, "startup source ingestion")
+            yield proxy_url, proxy
+        except Exception:
+            print((tmp_path / "proxy.log").read_text(errors="replace")[-4000:], file=sys.stderr)
+            raise
+        finally:
+            stop(proxy)
+            stop(upstream)
+
+
+def run_suite(args: argparse.Namespace, mixes: dict, selected: list[str], workers: int = 1) -> dict:
+    """Start the stand-in and the proxy, drive every selected mix, and stop them again."""
+    with local_stack(args.latency_ms, args.large_kb, args.proxy_arg, workers) as (proxy_url, proxy):
+        results = {}
+        for name in selected:
+            label = f" with {workers} proxy workers" if workers > 1 else ""
+            print(f"Running {name} ({args.concurrency} clients, {args.duration:g}s){label}...", flush=True)
+            row = drive_parallel(proxy_url, mixes[name], args.concurrency, args.duration, args.warmup, workers)
+            rss = rss_bytes(proxy.pid)
+            row["rss_mb"] = round(rss / 1024 / 1024, 1) if rss is not None else None
+            results[name] = row
+        return results
+
+
+def scaling_table(by_workers: dict[int, dict]) -> dict:
+    """Throughput per worker count, with speedup and efficiency against the smallest count."""
+    counts = sorted(by_workers)
+    base = counts[0]
+    table = {}
+    for mix in by_workers[base]:
+        base_rps = by_workers[base][mix]["rps"]
+        for workers in counts:
+            row = by_workers[workers][mix]
+            speedup = row["rps"] / base_rps if base_rps else 0.0
+            table[f"{mix}@{workers}"] = {
+                **row,
+                "speedup": round(speedup, 2),
+                "efficiency": round(speedup * base / workers, 2),
+            }
+    return table
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    mixes = build_mixes(args.upload_kb)
+    selected = [name.strip() for name in args.mixes.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in mixes]
+    if unknown:
+        print(f"Unknown mix(es): {', '.join(unknown)}. Available: {', '.join(mixes)}", file=sys.stderr)
+        return 2
+
+    if args.scaling:
+        counts = sorted({int(n) for n in args.scaling.split(",") if n.strip()})
+        table = scaling_table({n: run_suite(args, mixes, selected, workers=n) for n in counts})
+        print()
+        print_table(table, columns=("errors", "rps", "p95_ms", "p99_ms", "rss_mb", "speedup", "efficiency"))
+        if args.output:
+            args.output.write_text(json.dumps(table, indent=2) + "\n")
+        return 0
+
+    results = run_suite(args, mixes, selected)
+
+    print()
+    print_table(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.threshold)
+    if regressions:
+        print(f"\nRegressed by more than {args.threshold:.0%} against {args.baseline}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
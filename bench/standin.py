@@ -0,0 +1,95 @@
+"""Local stand-in for platform-api, used by the load benchmark.
+
+Serves the handful of endpoints the benchmark mixes hit, with a fixed
+artificial latency and configurable payload sizes, so proxy overhead can be
+measured without the real stack:
+
+  POST /sources/upload-source/sync   startup upload (enables source injection)
+  GET  /project/list                 small JSON
+  GET  /stories/large                large JSON (BENCH_LARGE_KB)
+  POST /chat/async                   422 unless sources were injected
+  POST /sources/upload-source        multipart upload, body drained and counted
+  *    anything else                 small JSON echo of method and path, for
+                                     replayed production traffic (bench/replay.py)
+
+Settings come from the environment so ``bench/run.py`` can pass them to the
+uvicorn subprocess:
+
+  BENCH_LATENCY_MS   added to every response (default 5)
+  BENCH_LARGE_KB     approximate size of the large JSON body (default 512)
+
+Run standalone with:  uvicorn bench.standin:app --port 9100
+"""
+
+import asyncio
+import json
+import os
+
+from fastapi import FastAPI, Request, Response
+
+
+LATENCY = float(os.getenv("BENCH_LATENCY_MS", "5")) / 1000
+LARGE_KB = int(os.getenv("BENCH_LARGE_KB", "512"))
+
+
+def _large_body(kb: int) -> bytes:
+    item = {"id": 0, "title": "Renewable energy overview", "body": "x" * 200, "tags": ["solar", "wind"]}
+    size = len(json.dumps(item)) + 1
+    items = [dict(item, id=i) for i in range(max(1, kb * 1024 // size))]
+    return json.dumps({"items": items}).encode()
+
+
+SMALL_BODY = json.dumps({"projects": [{"id": i, "name": f"project-{i}"} for i in range(5)]}).encode()
+LARGE_BODY = _large_body(LARGE_KB)
+
+app = FastAPI()
+
+
+def _json(body: bytes, status_code: int = 200) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+
+@app.post("/sources/upload-source/sync")
+async def upload_source_sync(request: Request):
+    await request.body()
+    return {"download_url": "http://standin.local/embedded/sample_source.parquet"}
+
+
+@app.get("/project/list")
+async def project_list():
+    await asyncio.sleep(LATENCY)
+    return _json(SMALL_BODY)
+
+
+@app.get("/stories/large")
+async def large_json():
+    await asyncio.sleep(LATENCY)
+    return _json(LARGE_BODY)
+
+
+@app.post("/chat/async")
+async def chat_async(request: Request):
+    body = json.loads(await request.body())
+    await asyncio.sleep(LATENCY)
+    sources = body.get("user-config-params", {}).get("user_pre_processed_sources")
+    if not sources:
+        return _json(b'{"detail": "sources not injected"}', status_code=422)
+    return _json(json.dumps({"status": "queued", "sources": len(sources)}).encode(), status_code=202)
+
+
+@app.post("/sources/upload-source")
+async def upload_source(request: Request):
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+    await asyncio.sleep(LATENCY)
+    return {"received": received}
+
+
+# Registered last: only paths the routes above do not serve get here
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def anything(path: str, request: Request):
+    async for _ in request.stream():
+        pass
+    await asyncio.sleep(LATENCY)
+    return _json(json.dumps({"method": request.method, "path": f"/{path}"}).encode())
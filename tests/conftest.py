@@ -4,6 +4,7 @@ These tests hit the running demo-proxy-app at localhost:8000 and validate
 the full request path through to platform-api and its downstream services.
 
 Required: all services running (just start-services && just setup-demo).
+Offline tests (test_proxy.py, ...) use a mocked upstream and run anywhere.
 """
 
 import os
@@ -71,11 +72,17 @@ def client(base_url: str) -> httpx.Client:
 
 
 # ---------------------------------------------------------------------------
-# Pre-flight: make sure the proxy is reachable before running any tests
+# Pre-flight: make sure the proxy is reachable before running any e2e tests
 # ---------------------------------------------------------------------------
 
-def pytest_configure(config):
-    """Skip entire suite early if proxy is unreachable."""
+def pytest_collection_finish(session):
+    """Skip entire suite early if e2e tests are selected and the proxy is unreachable.
+
+    Offline tests (everything outside test_e2e.py) run against an in-process
+    app and never need the live stack.
+    """
+    if not any(item.path.name == "test_e2e.py" for item in session.items):
+        return
     url = os.getenv("TEST_PROXY_URL", "http://localhost:8000")
     try:
         r = httpx.get(f"{url}/docs", timeout=5.0)
@@ -0,0 +1,93 @@
+"""Offline tests for the benchmark harness (bench/).
+
+Run with:  pytest tests/test_bench.py
+Requires:  nothing — the stand-in upstream runs in-process via TestClient.
+"""
+
+import asyncio
+import json
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from bench.replay import build_request, load_records, replay_concurrent, summarize
+from bench.run import compare, multipart_body, percentile
+from bench.standin import app as standin_app
+
+
+class TestStandIn:
+    def test_chat_async_requires_injected_sources(self):
+        client = TestClient(standin_app)
+        assert client.post("/chat/async", json={"user-config-params": {}}).status_code == 422
+        injected = {"user-config-params": {"user_pre_processed_sources": [{"download_url": "u", "filename": "f"}]}}
+        assert client.post("/chat/async", json=injected).status_code == 202
+
+    def test_upload_body_drained(self):
+        body, content_type = multipart_body(4)
+        response = TestClient(standin_app).post(
+            "/sources/upload-source", content=body, headers={"Content-Type": content_type}
+        )
+        assert response.json()["received"] == len(body)
+
+    def test_large_json_is_valid(self):
+        payload = TestClient(standin_app).get("/stories/large").content
+        assert len(json.loads(payload)["items"]) > 1
+
+
+class TestBaseline:
+    @pytest.mark.parametrize("pct, expected", [(50, 5), (95, 10), (99, 10), (1, 1)])
+    def test_percentile(self, pct: float, expected: float):
+        assert percentile([float(v) for v in range(1, 11)], pct) == expected
+
+    def test_regressions_past_threshold_reported(self):
+        baseline = {"small-get": {"rps": 1000, "p95_ms": 10, "p99_ms": 20, "rss_mb": 60}}
+        current = {"small-get": {"rps": 800, "p95_ms": 10.5, "p99_ms": 30, "rss_mb": 61}}
+        regressions = compare(current, baseline, threshold=0.15)
+        assert len(regressions) == 2
+        assert any("rps" in line for line in regressions)
+        assert any("p99_ms" in line for line in regressions)
+
+    def test_new_mix_without_baseline_ignored(self):
+        assert compare({"upload": {"rps": 1}}, {}, threshold=0.15) == []
+
+
+class TestReplay:
+    def test_ring_files_merged_in_capture_order(self, tmp_path):
+        (tmp_path / "capture.jsonl.1").write_text(
+            json.dumps({"ts": 1.0, "method": "GET", "path": "/api/a"}) + "\nnot json\n"
+        )
+        (tmp_path / "capture.jsonl").write_text(
+            json.dumps({"ts": 3.0, "method": "GET", "path": "/api/c"}) + "\n"
+            + json.dumps({"ts": 2.0, "method": "GET", "path": "/api/b"}) + "\n"
+        )
+        assert [r["path"] for r in load_records([tmp_path])] == ["/api/a", "/api/b", "/api/c"]
+        assert len(load_records([tmp_path], limit=1)) == 1
+
+    def test_redacted_headers_dropped_and_truncated_body_padded(self):
+        method, url, headers, body = build_request({
+            "method": "POST",
+            "path": "/api/sources/upload-source",
+            "query": "x=1",
+            "headers": {"authorization": "[REDACTED]", "x-user-id": "u-1", "x-request-id": "old"},
+            "body": "abc",
+            "body_truncated": True,
+            "body_bytes": 10,
+        })
+        assert (method, url) == ("POST", "/api/sources/upload-source?x=1")
+        assert headers == {"x-user-id": "u-1"}
+        assert body == b"abc" + b" " * 7
+
+    def test_concurrent_replay_reports_routes(self):
+        records = [
+            {"ts": i, "method": "GET", "path": "/project/list", "status": 200} for i in range(4)
+        ] + [{"ts": 9, "method": "POST", "path": "/stories/story/42", "status": 201, "body": "{}"}]
+
+        async def main():
+            transport = httpx.ASGITransport(app=standin_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://standin") as client:
+                return await replay_concurrent(client, records, concurrency=2)
+
+        report = summarize(asyncio.run(main()), elapsed=1.0)
+        assert report["project/list"]["requests"] == 4
+        assert report["stories/story/{id}"]["mismatched"] == 1  # the stand-in echoes with 200
+        assert report["all"]["requests"] == 5 and report["all"]["errors"] == 0
@@ -0,0 +1,1560 @@
+"""Offline tests for the proxy request path.
+
+Run with:  pytest tests/test_proxy.py
+Requires:  nothing — platform-api is replaced by an httpx.MockTransport, and
+           the app runs in-process through Starlette's TestClient.
+"""
+
+import asyncio
+import gzip
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import pytest
+import httpx
+from fastapi.testclient import TestClient
+from starlette.background import BackgroundTask
+
+from app.admission import (
+    AdmissionController, Overloaded, RateLimit, RateLimited, RateLimiter, admission, rate_limiter,
+)
+from app.balancer import UpstreamPool
+from app.capture import TrafficCapture
+from app.coalesce import Flight, SingleFlight, coalescer
+from app.compression import ENCODINGS, choose_encoding
+from app.conditional import ConditionalRequests, etag_matches
+from app.deadlines import (
+    ClientDisconnected,
+    RelayResponse,
+    TimeoutPolicies,
+    TimeoutPolicy,
+    default_timeout_policies,
+    unless_disconnected,
+)
+from app.ingest import SourceFile, SourceIngestor, read_source, source_paths
+from app.main import app, send_story
+from app.metrics import metrics, normalize_route
+from app.resilience import RetryBudget, resilience
+from app.response_cache import CachePolicy, ResponseCache, response_cache
+from app.stories import StoryBulkRun, StoryPayload, parse_story_array, story_items
+from app.source_registry import (
+    SHARED, SourceRecord, SourceRegistry, owner_key, parse_user_orgs, record_from_upload,
+)
+from app.tracing import SpanExporter
+from app.transformers import RouteTable
+
+
+# ── helpers ──────────────────────────────────────────────────────────────────
+
+
+def upstream_response(
+    status_code: int = 200,
+    content: bytes = b"",
+    headers: Optional[Dict[str, str]] = None,
+    json_body=None,
+) -> httpx.Response:
+    """Build an upstream response whose body is streamed like a real socket read.
+
+    httpx eagerly reads plain ``content=`` bodies, which the proxy would then
+    be unable to relay with ``aiter_raw``.
+    """
+    headers = dict(headers or {})
+    if json_body is not None:
+        content = json.dumps(json_body).encode()
+        headers.setdefault("Content-Type", "application/json")
+
+    async def chunks():
+        yield content
+
+    return httpx.Response(status_code, content=chunks(), headers=headers)
+
+
+class FakeUpstream:
+    """Records forwarded requests and answers them with a configurable handler."""
+
+    def __init__(self):
+        self.requests: List[httpx.Request] = []
+        self.handler: Callable[[httpx.Request], httpx.Response] = (
+            lambda request: upstream_response(json_body={"ok": True})
+        )
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        self.requests.append(request)
+        return self.handler(request)
+
+
+@pytest.fixture()
+def upstream() -> FakeUpstream:
+    fake = FakeUpstream()
+    response_cache.clear()
+    resilience.breakers.clear()
+    rate_limiter.clear()
+    app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+    yield fake
+    del app.state.http_client
+
+
+@pytest.fixture()
+def proxy(upstream: FakeUpstream) -> TestClient:
+    # No context manager: skip lifespan so the startup upload never runs
+    return TestClient(app)
+
+
+# ── 1. Response streaming ────────────────────────────────────────────────────
+
+
+class TestResponseStreaming:
+    def test_status_and_body_relayed(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(404, json_body={"detail": "nope"})
+        r = proxy.get("/api/project/list")
+        assert r.status_code == 404
+        assert r.json() == {"detail": "nope"}
+
+    def test_headers_filtered(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(
+            200,
+            content=b"[]",
+            headers={
+                "Content-Type": "application/json",
+                "ETag": '"abc"',
+                "Cache-Control": "no-cache",
+                "Server": "uvicorn",
+                "Set-Cookie": "session=1",
+            },
+        )
+        r = proxy.get("/api/prompts")
+        assert r.headers["etag"] == '"abc"'
+        assert r.headers["cache-control"] == "no-cache"
+        assert "server" not in r.headers
+        assert "set-cookie" not in r.headers
+
+    def test_compressed_body_relayed_untouched(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        payload = json.dumps([{"id": i} for i in range(100)]).encode()
+        upstream.handler = lambda request: upstream_response(
+            200,
+            content=gzip.compress(payload),
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        r = proxy.get("/api/project/list", headers={"Accept-Encoding": "gzip"})
+        assert r.headers["content-encoding"] == "gzip"
+        assert r.json() == json.loads(payload)
+        assert upstream.requests[0].headers["accept-encoding"] == "gzip"
+
+    def test_large_uncompressed_body_compressed(self, proxy: TestClient, upstream: FakeUpstream):
+        payload = [{"id": i, "title": f"Story {i}"} for i in range(200)]
+        upstream.handler = lambda request: upstream_response(json_body=payload, headers={"ETag": '"v1"'})
+        r = proxy.get("/api/project/list", headers={"Accept-Encoding": "gzip"})
+        assert r.headers["content-encoding"] == "gzip"
+        assert r.headers["vary"] == "Accept-Encoding"
+        assert r.headers["etag"] == '"v1-gzip"'
+        assert r.json() == payload
+
+    def test_small_body_not_compressed(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.get("/api/project/list", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in r.headers
+        assert r.json() == {"ok": True}
+
+    def test_unaccepted_encoding_decoded(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(
+            content=gzip.compress(b'{"a": 1}'),
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        r = proxy.get("/api/project/list", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in r.headers
+        assert r.content == b'{"a": 1}'
+
+    def test_accept_encoding_preferences(self):
+        assert choose_encoding("gzip, deflate") == "gzip"
+        assert choose_encoding("gzip;q=0, identity") is None
+        assert choose_encoding("*") == ENCODINGS[0]
+        assert choose_encoding("") is None
+
+    def test_non_json_body_relayed(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(
+            200, content=b"plain", headers={"Content-Type": "text/plain"}
+        )
+        r = proxy.get("/api/health")
+        assert r.text == "plain"
+        assert r.headers["content-type"].startswith("text/plain")
+
+
+# ── 2. Request forwarding ────────────────────────────────────────────────────
+
+
+class TestRequestForwarding:
+    def test_v1_prefix_stripped_and_query_kept(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        proxy.get("/api/v1/stories/mini", params={"story-id": "s1"})
+        forwarded = upstream.requests[0]
+        assert forwarded.url.path.endswith("/stories/mini")
+        assert forwarded.url.params["story-id"] == "s1"
+
+    def test_custom_headers_injected(self, proxy: TestClient, upstream: FakeUpstream):
+        proxy.get("/api/user/current-user", headers={"X-User-ID": "u-42"})
+        forwarded = upstream.requests[0]
+        assert forwarded.headers["x-user-id"] == "u-42"
+        assert "x-api-key" in forwarded.headers
+        assert "x-domain" in forwarded.headers
+
+
+# ── 3. Request bodies ────────────────────────────────────────────────────────
+
+
+class TestRequestBodies:
+    def test_upload_streamed_to_upstream(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        data = b"%PDF-1.4" + b"x" * 200_000
+        r = proxy.post(
+            "/api/sources/upload-source/file",
+            files={"file": ("doc.pdf", data, "application/pdf")},
+        )
+        assert r.status_code == 200
+        forwarded = upstream.requests[0]
+        assert data in forwarded.content
+        assert forwarded.headers["content-type"].startswith("multipart/form-data")
+
+    def test_get_without_body_not_chunked(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        proxy.get("/api/prompts")
+        forwarded = upstream.requests[0]
+        assert "transfer-encoding" not in forwarded.headers
+        assert forwarded.content == b""
+
+    def test_declared_oversize_rejected(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        monkeypatch.setattr("app.bodies.MAX_REQUEST_BODY_BYTES", 1024)
+        r = proxy.post("/api/sources/upload-source/sync", content=b"x" * 2048)
+        assert r.status_code == 413
+        assert upstream.requests == []
+
+    def test_chunked_oversize_rejected(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        monkeypatch.setattr("app.bodies.MAX_REQUEST_BODY_BYTES", 1024)
+
+        def chunks():
+            for _ in range(4):
+                yield b"x" * 512
+
+        r = proxy.post("/api/sources/upload-source/sync", content=chunks())
+        assert r.status_code == 413
+
+    def test_buffered_body_read_whole(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        body = json.dumps({"prompt": "p" * 100_000}).encode()
+
+        def chunks():
+            for i in range(0, len(body), 4096):
+                yield body[i:i + 4096]
+
+        r = proxy.post("/api/chat/async", content=chunks(), headers={"Content-Type": "application/json"})
+        assert r.status_code == 200
+        assert json.loads(upstream.requests[0].content)["prompt"] == "p" * 100_000
+
+    def test_buffered_oversize_rejected(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        monkeypatch.setattr("app.bodies.MAX_REQUEST_BODY_BYTES", 1024)
+
+        def chunks():
+            for _ in range(4):
+                yield b'"' + b"x" * 510 + b'"'
+
+        r = proxy.post("/api/chat/async", content=chunks(), headers={"Content-Type": "application/json"})
+        assert r.status_code == 413
+        assert upstream.requests == []
+
+
+# ── 4. Source injection ──────────────────────────────────────────────────────
+
+
+SOURCE_DATA = {
+    "source_id": "src-1",
+    "filename": "sample_source.txt",
+    "upload_response": {"download_url": "https://cdn.example.com/embedded/src-1.parquet"},
+}
+
+
+@pytest.fixture()
+def source_registry(tmp_path, monkeypatch) -> SourceRegistry:
+    registry = SourceRegistry(tmp_path / "sources.json", legacy_path=tmp_path / "source_id.json", top_n=3)
+    monkeypatch.setattr("app.main.source_registry", registry)
+    return registry
+
+
+def source(source_id: str, owner: str = SHARED, registered_at: float = 1.0, name: str | None = None) -> SourceRecord:
+    return SourceRecord(source_id, owner, name or source_id, f"https://cdn.example.com/{source_id}.parquet", registered_at)
+
+
+class TestSourceInjection:
+    def test_chat_async_gets_sources(
+        self, proxy: TestClient, upstream: FakeUpstream, source_registry
+    ):
+        source_registry.register(record_from_upload(SOURCE_DATA))
+        proxy.post("/api/chat/async", json={"prompt": "hi"})
+        sent = json.loads(upstream.requests[0].content)
+        assert sent["user-config-params"]["user_pre_processed_sources"] == [
+            {
+                "download_url": "https://cdn.example.com/embedded/src-1.parquet",
+                "filename": "src-1.parquet",
+            }
+        ]
+
+    def test_no_sources_forwards_unchanged(
+        self, proxy: TestClient, upstream: FakeUpstream, source_registry
+    ):
+        proxy.post("/api/chat/async", json={"prompt": "hi"})
+        assert json.loads(upstream.requests[0].content) == {"prompt": "hi"}
+
+    def test_user_and_org_sources_newest_first(
+        self, proxy: TestClient, upstream: FakeUpstream, source_registry, monkeypatch
+    ):
+        monkeypatch.setattr("app.main.USER_ORGS", {"alice": "acme"})
+        source_registry.register(source("shared", registered_at=1))
+        source_registry.register(source("alice-old", owner_key("alice"), registered_at=2))
+        source_registry.register(source("acme", owner_key(org_id="acme"), registered_at=3))
+        source_registry.register(source("alice-new", owner_key("alice"), registered_at=4))
+        source_registry.register(source("bob", owner_key("bob"), registered_at=5))
+
+        proxy.post("/api/chat/async", json={}, headers={"X-User-ID": "alice"})
+        sent = json.loads(upstream.requests[0].content)["user-config-params"]["user_pre_processed_sources"]
+        # top_n=3: newest of alice's, acme's and shared sources; bob's are never visible
+        assert [s["filename"] for s in sent] == ["alice-new.parquet", "acme.parquet", "alice-old.parquet"]
+        assert source_registry.lookup("carol") == [source("shared").entry()]
+
+        # An org claimed by the client is ignored: carol is not a member of acme
+        proxy.post("/api/chat/async", json={}, headers={"X-User-ID": "carol", "X-Org-ID": "acme"})
+        sent = json.loads(upstream.requests[1].content)["user-config-params"]["user_pre_processed_sources"]
+        assert [s["filename"] for s in sent] == ["shared.parquet"]
+
+    def test_user_orgs_parsed(self):
+        assert parse_user_orgs(" alice=acme, bob = beta ,broken,,=x") == {"alice": "acme", "bob": "beta"}
+
+    def test_register_replaces_same_name_and_caps_owner(self, source_registry):
+        source_registry.max_per_owner = 2
+        source_registry.register(source("v1", registered_at=1, name="doc.txt"))
+        source_registry.register(source("v2", registered_at=2, name="doc.txt"))
+        assert source_registry.lookup(None) == [source("v2").entry()]
+        source_registry.register(source("a", registered_at=3))
+        source_registry.register(source("b", registered_at=4))
+        assert [e["filename"] for e in source_registry.lookup(None)] == ["b.parquet", "a.parquet"]
+        assert source_registry.stats()["evictions"] == 1
+        assert source_registry.evict("a") and not source_registry.evict("a")
+
+    def test_register_and_evict_endpoints(self, proxy: TestClient, source_registry, monkeypatch):
+        monkeypatch.setattr("app.main.ADMIN_API_KEY", "admin-secret")
+        proxy.headers["X-Admin-Key"] = "admin-secret"
+        r = proxy.post(
+            "/internal/sources",
+            json={"source_id": "s1", "download_url": "https://cdn.example.com/s1.parquet", "user_id": "alice"},
+        )
+        assert r.status_code == 201 and r.json()["owner"] == "user:alice"
+        assert proxy.get("/internal/sources", params={"user_id": "alice"}).json()["sources"][0]["filename"] == "s1.parquet"
+        assert source_registry.path.exists()
+        assert proxy.delete("/internal/sources/s1").status_code == 204
+        assert proxy.delete("/internal/sources/s1").status_code == 404
+        assert proxy.get("/internal/sources", params={"user_id": "alice"}).json()["sources"] == []
+
+    def test_source_endpoints_require_admin_key(self, proxy: TestClient, source_registry, monkeypatch):
+        registration = {"source_id": "s1", "download_url": "https://evil.example.com/s1.parquet"}
+        # Disabled until an admin key is configured
+        assert proxy.post("/internal/sources", json=registration).status_code == 403
+        monkeypatch.setattr("app.main.ADMIN_API_KEY", "admin-secret")
+        assert proxy.post("/internal/sources", json=registration).status_code == 401
+        assert proxy.post("/internal/sources", json=registration, headers={"X-Admin-Key": "guess"}).status_code == 401
+        assert proxy.get("/internal/sources").status_code == 401
+        assert proxy.delete("/internal/sources/s1").status_code == 401
+        assert len(source_registry) == 0
+
+    def test_persisted_and_reloaded(self, source_registry):
+        source_registry.register(source("s1", owner_key("alice"), registered_at=1))
+        source_registry.register(source("s2", owner_key("alice"), registered_at=2))
+        source_registry.write(source_registry.snapshot())
+
+        reloaded = SourceRegistry(source_registry.path)
+        assert reloaded.refresh() is True
+        assert reloaded.lookup("alice") == source_registry.lookup("alice")
+        assert reloaded.refresh() is False
+
+    def test_legacy_file_imported(self, source_registry):
+        source_registry.legacy_path.write_text(json.dumps(SOURCE_DATA))
+        assert source_registry.lookup("anyone")[0]["filename"] == "src-1.parquet"
+
+    def test_steady_state_served_from_memory(self, source_registry, monkeypatch):
+        source_registry.refresh()
+        source_registry.register(source("s1"))
+
+        def no_disk(*args, **kwargs):
+            raise AssertionError("filesystem touched on the hot path")
+
+        monkeypatch.setattr("app.source_registry.os.stat", no_disk)
+        for _ in range(3):
+            assert source_registry.lookup("alice")
+        assert source_registry.stats()["hits"] == 3
+        assert source_registry.stats()["misses"] == 0
+
+
+class FakeUploads:
+    """Stands in for platform-api's sync upload; fails the first ``failures`` calls per file."""
+
+    def __init__(self, failures: int = 0, status_code: int = 503, delay: float = 0.0):
+        self.failures = failures
+        self.status_code = status_code
+        self.delay = delay
+        self.calls: List[str] = []
+        self.active = 0
+        self.max_active = 0
+
+    async def __call__(self, source: SourceFile) -> dict:
+        self.calls.append(source.filename)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if self.calls.count(source.filename) <= self.failures:
+            response = httpx.Response(self.status_code, request=httpx.Request("POST", "http://upstream/"))
+            raise httpx.HTTPStatusError("upload failed", request=response.request, response=response)
+        return {"download_url": f"https://cdn.example.com/embedded/{source.source_id}.parquet"}
+
+
+@pytest.fixture()
+def sources_dir(tmp_path):
+    directory = tmp_path / "sources"
+    directory.mkdir()
+    for i in range(4):
+        (directory / f"doc-{i}.txt").write_text(f"Document {i}\n\nBody {i}")
+    return directory
+
+
+class TestSourceIngestion:
+    def ingestor(self, registry: SourceRegistry, upload, tmp_path, **kwargs) -> SourceIngestor:
+        kwargs.setdefault("backoff", 0)
+        return SourceIngestor(registry, upload, manifest_path=tmp_path / "manifest.json", **kwargs)
+
+    def test_unchanged_files_not_uploaded_again(self, source_registry, sources_dir, tmp_path):
+        uploads = FakeUploads()
+        paths = source_paths(str(sources_dir), Path("unused"))
+        asyncio.run(self.ingestor(source_registry, uploads, tmp_path).run(paths))
+        assert len(uploads.calls) == 4
+        assert len(source_registry.lookup(None)) == 3  # top_n
+
+        # A restart with one edited file uploads only that file
+        (sources_dir / "doc-0.txt").write_text("Document 0, revised")
+        restarted = SourceRegistry(source_registry.path)
+        ingestor = self.ingestor(restarted, uploads, tmp_path)
+        asyncio.run(ingestor.run(paths))
+        assert uploads.calls[4:] == ["doc-0.txt"]
+        assert ingestor.stats()["skipped"] == 3
+        assert len(restarted) == 4  # the revision replaced the old doc-0
+
+    def test_source_id_is_content_addressed(self, sources_dir):
+        a = read_source(sources_dir / "doc-1.txt")
+        (sources_dir / "copy.txt").write_bytes((sources_dir / "doc-1.txt").read_bytes())
+        assert read_source(sources_dir / "copy.txt").source_id == a.source_id
+        assert a.title == "Document 1"
+
+    def test_binary_file_skipped(self, source_registry, sources_dir, tmp_path):
+        (sources_dir / "scan.pdf").write_bytes(b"%PDF-1.4\n\xff\xd8\xff\xe0 binary")
+        uploads = FakeUploads()
+        ingestor = self.ingestor(source_registry, uploads, tmp_path)
+        asyncio.run(ingestor.run(source_paths(str(sources_dir), Path("unused"))))
+        assert "scan.pdf" not in uploads.calls
+        assert ingestor.stats()["uploaded"] == 4
+        assert ingestor.stats()["not_text"] == 1 and ingestor.stats()["failed"] == 0
+
+    def test_uploads_bounded_and_retried(self, source_registry, sources_dir, tmp_path):
+        uploads = FakeUploads(failures=2, delay=0.01)
+        ingestor = self.ingestor(source_registry, uploads, tmp_path, concurrency=2)
+        asyncio.run(ingestor.run(source_paths(str(sources_dir), Path("unused"))))
+        assert uploads.max_active == 2
+        assert ingestor.stats()["uploaded"] == 4
+        assert ingestor.stats()["attempts"] == 12
+
+    def test_client_errors_not_retried(self, source_registry, sources_dir, tmp_path):
+        uploads = FakeUploads(failures=1, status_code=400)
+        ingestor = self.ingestor(source_registry, uploads, tmp_path)
+        asyncio.run(ingestor.run([sources_dir / "doc-0.txt"]))
+        assert ingestor.stats()["failed"] == 1 and ingestor.ready
+        assert uploads.calls == ["doc-0.txt"]
+
+    def test_chat_async_waits_for_ingestion(self, upstream: FakeUpstream, source_registry, sources_dir, tmp_path, monkeypatch):
+        ingestor = self.ingestor(source_registry, FakeUploads(delay=0.05), tmp_path)
+        monkeypatch.setattr("app.main.ingestion", ingestor)
+
+        async def main():
+            task = asyncio.create_task(ingestor.run([sources_dir / "doc-0.txt"]))
+            await asyncio.sleep(0)
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as c:
+                assert (await c.get("/ready")).status_code == 503
+                await c.post("/api/chat/async", json={})
+                assert (await c.get("/ready")).status_code == 200
+            await task
+
+        asyncio.run(main())
+        sent = json.loads(upstream.requests[0].content)
+        assert len(sent["user-config-params"]["user_pre_processed_sources"]) == 1
+
+
+# ── 5. Transformer pipeline ──────────────────────────────────────────────────
+
+
+class TestTransformers:
+    def test_route_table_matches_full_path(self):
+        table = RouteTable()
+
+        @table.request(r"(?:.+/)?chat/async", methods=["POST"])
+        def tag(body, ctx):
+            return body
+
+        assert table.match("POST", "chat/async")[0] == [tag]
+        assert table.match("POST", "user/chat/async")[0] == [tag]
+        assert table.match("GET", "chat/async") == ([], [])
+        assert table.match("POST", "chat/async/extra") == ([], [])
+        assert table.match("POST", "prompts") == ([], [])
+
+    def test_untransformed_body_not_parsed(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        def no_parse(data):
+            raise AssertionError("body parsed on a route with no transformer")
+
+        monkeypatch.setattr("app.codec.loads", no_parse)
+        r = proxy.put("/api/user/storyplan-config", content=b'{"a": 1}')
+        assert r.status_code == 200
+        assert upstream.requests[0].content == b'{"a": 1}'
+
+    def test_response_transformer_rewrites_body(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        table = RouteTable()
+
+        @table.response(r"events", methods=["GET"])
+        def rename(body, ctx):
+            body["socketAddress"] = body.pop("socket_address")
+            return body
+
+        monkeypatch.setattr("app.main.transformers", table)
+        upstream.handler = lambda request: upstream_response(
+            json_body={"socket_address": "ws://x"}, headers={"ETag": '"v1"'}
+        )
+        r = proxy.get("/api/events")
+        assert r.json() == {"socketAddress": "ws://x"}
+        # upstream's validator belonged to the original body; the proxy tags the rewritten one
+        assert r.headers["etag"] != '"v1"' and not r.headers["etag"].startswith("W/")
+
+    def test_transformed_response_fetched_uncompressed(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        table = RouteTable()
+
+        @table.response(r"events", methods=["GET"])
+        def pad(body, ctx):
+            body["padding"] = "x" * 4096
+            return body
+
+        monkeypatch.setattr("app.main.transformers", table)
+        r = proxy.get("/api/events", headers={"Accept-Encoding": "gzip"})
+        assert upstream.requests[0].headers["accept-encoding"] == "identity"
+        assert r.headers["content-encoding"] == "gzip"
+        assert r.json()["padding"] == "x" * 4096
+
+
+# ── 6. Request logging ───────────────────────────────────────────────────────
+
+
+def request_records(caplog) -> List[dict]:
+    return [r.request for r in caplog.records if r.name == "proxy.request"]
+
+
+class TestRequestLogging:
+    def test_one_record_per_request_without_bodies(
+        self, proxy: TestClient, upstream: FakeUpstream, caplog
+    ):
+        caplog.set_level("INFO", logger="proxy.request")
+        proxy.post("/api/prompts", content=b'{"secret": 1}', headers={"X-User-ID": "u-7"})
+        (record,) = request_records(caplog)
+        assert record["status"] == 200
+        assert record["user_id"] == "u-7"
+        assert record["request_bytes"] == len(b'{"secret": 1}')
+        assert "request_body" not in record
+        assert "headers" not in record
+
+    def test_sampled_record_redacts_and_truncates(
+        self, proxy: TestClient, upstream: FakeUpstream, caplog, monkeypatch
+    ):
+        monkeypatch.setattr("app.request_log.LOG_BODIES", True)
+        monkeypatch.setattr("app.request_log.LOG_BODY_SAMPLE_RATE", 1.0)
+        monkeypatch.setattr("app.request_log.LOG_BODY_MAX_BYTES", 8)
+        caplog.set_level("INFO", logger="proxy.request")
+        proxy.post(
+            "/api/prompts",
+            content=b"0123456789abcdef",
+            headers={"X-API-Key": "cap-secret"},
+        )
+        (record,) = request_records(caplog)
+        assert record["headers"]["x-api-key"] == "[REDACTED]"
+        assert record["request_body"].startswith("01234567... [truncated")
+        assert record["response_body"].startswith('{"ok": t')
+
+    def test_injection_noted_in_record(
+        self, proxy: TestClient, upstream: FakeUpstream, source_registry, caplog
+    ):
+        caplog.set_level("INFO", logger="proxy.request")
+        source_registry.register(record_from_upload(SOURCE_DATA))
+        proxy.post("/api/chat/async", json={"prompt": "hi"})
+        (record,) = request_records(caplog)
+        assert record["sources_injected"] == 1
+
+
+# ── 7. Response cache ────────────────────────────────────────────────────────
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestResponseCache:
+    def test_repeat_get_served_from_cache(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        r1 = proxy.get("/api/prompts", headers={"X-User-ID": "u-1"})
+        r2 = proxy.get("/api/prompts", headers={"X-User-ID": "u-1"})
+        assert r1.headers["x-cache"] == "MISS"
+        assert r2.headers["x-cache"] == "HIT"
+        assert r2.json() == {"ok": True}
+        assert len(upstream.requests) == 1
+
+    def test_users_do_not_share_entries(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        upstream.handler = lambda request: upstream_response(
+            json_body={"user": request.headers["x-user-id"]}
+        )
+        proxy.get("/api/user/current-user", headers={"X-User-ID": "u-1"})
+        r = proxy.get("/api/user/current-user", headers={"X-User-ID": "u-2"})
+        assert r.json() == {"user": "u-2"}
+        assert len(upstream.requests) == 2
+
+    def test_write_invalidates_family_for_that_user(
+        self, proxy: TestClient, upstream: FakeUpstream
+    ):
+        for user in ("u-1", "u-2"):
+            proxy.get("/api/user/storyplan-config/default", headers={"X-User-ID": user})
+        proxy.put("/api/user/storyplan-config", json={"id": "c"}, headers={"X-User-ID": "u-1"})
+        r1 = proxy.get("/api/user/storyplan-config/default", headers={"X-User-ID": "u-1"})
+        r2 = proxy.get("/api/user/storyplan-config/default", headers={"X-User-ID": "u-2"})
+        assert r1.headers["x-cache"] == "MISS"
+        assert r2.headers["x-cache"] == "HIT"
+
+    def test_errors_not_cached(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(500, json_body={})
+        proxy.get("/api/prompts")
+        proxy.get("/api/prompts")
+        assert len(upstream.requests) == 2
+
+    def test_stale_served_then_refreshed(self):
+        clock = FakeClock()
+        cache = ResponseCache([CachePolicy("prompts", ttl=10, stale_ttl=10, family="prompts")], clock=clock)
+        policy = cache.policy_for("GET", "prompts")
+        key = cache.key("GET", "prompts", "", "u-1", "gzip")
+        cache.put(key, policy, 200, {}, b"v1")
+        clock.now += 15
+        entry, state = cache.get(key)
+        assert (entry.body, state) == (b"v1", "STALE")
+        clock.now += 10
+        assert cache.get(key) == (None, None)
+
+    def test_background_refresh_is_its_own_resilient_request(self, upstream: FakeUpstream, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr(response_cache, "clock", clock)
+        statuses = iter([200, 503, 200])
+        upstream.handler = lambda request: upstream_response(next(statuses), json_body={"v": 1})
+
+        async def main():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as c:
+                await c.get("/api/prompts", headers={"X-Request-ID": "client-1"})
+                clock.now += 90  # past the TTL, within stale-while-revalidate
+                stale = await c.get("/api/prompts", headers={"X-Request-ID": "client-2"})
+                await asyncio.gather(*response_cache._tasks)
+                return stale
+
+        stale = asyncio.run(main())
+        assert stale.headers["x-cache"] == "STALE"
+        # The 503 was retried like any client GET
+        refreshes = upstream.requests[1:]
+        assert len(refreshes) == 2
+        assert {r.headers["x-request-id"] for r in refreshes} & {"client-1", "client-2"} == set()
+        assert all(int(r.headers["x-request-timeout-ms"]) > 0 for r in refreshes)
+        assert response_cache.stats()["entries"] == 1
+
+    def test_lru_eviction_bounds_memory(self):
+        cache = ResponseCache(
+            [CachePolicy("prompts", ttl=60, stale_ttl=0, family="prompts")], max_bytes=10
+        )
+        policy = cache.policy_for("GET", "prompts")
+        keys = [cache.key("GET", "prompts", "", f"u-{i}", "") for i in range(3)]
+        for key in keys:
+            cache.put(key, policy, 200, {}, b"12345")
+        assert cache.get(keys[0]) == (None, None)
+        assert cache.get(keys[2])[1] == "HIT"
+        assert cache.stats()["bytes"] <= 10
+
+
+# ── 8. Request coalescing ────────────────────────────────────────────────────
+
+
+def run_concurrently(requests: List[dict]) -> List[httpx.Response]:
+    """Fire requests at the app concurrently on one event loop."""
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as c:
+            return await asyncio.gather(*(c.request(**kwargs) for kwargs in requests))
+
+    return asyncio.run(main())
+
+
+@pytest.fixture()
+def slow_upstream(upstream: FakeUpstream) -> FakeUpstream:
+    """Upstream that answers after a short delay, so identical requests overlap."""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.05)
+        return upstream_response(
+            json_body={"path": request.url.path, "user": request.headers["x-user-id"]}
+        )
+
+    async def record(request: httpx.Request) -> httpx.Response:
+        request.read()
+        upstream.requests.append(request)
+        return await handler(request)
+
+    app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(record))
+    return upstream
+
+
+class TestCoalescing:
+    def test_identical_gets_share_one_upstream_call(self, slow_upstream: FakeUpstream):
+        responses = run_concurrently(
+            [{"method": "GET", "url": "/api/project/list", "headers": {"X-User-ID": "u-1"}}] * 5
+        )
+        assert [r.status_code for r in responses] == [200] * 5
+        assert len({r.content for r in responses}) == 1
+        assert len(slow_upstream.requests) == 1
+
+    def test_different_users_not_merged(self, slow_upstream: FakeUpstream):
+        responses = run_concurrently(
+            [
+                {"method": "GET", "url": "/api/project/list", "headers": {"X-User-ID": "u-1"}},
+                {"method": "GET", "url": "/api/project/list", "headers": {"X-User-ID": "u-2"}},
+            ]
+        )
+        assert [r.json()["user"] for r in responses] == ["u-1", "u-2"]
+        assert len(slow_upstream.requests) == 2
+
+    def test_writes_not_merged(self, slow_upstream: FakeUpstream):
+        run_concurrently([{"method": "POST", "url": "/api/project/list", "json": {}}] * 3)
+        assert len(slow_upstream.requests) == 3
+
+    def test_sequential_requests_not_merged(self, slow_upstream: FakeUpstream):
+        run_concurrently([{"method": "GET", "url": "/api/project/list"}])
+        run_concurrently([{"method": "GET", "url": "/api/project/list"}])
+        assert len(slow_upstream.requests) == 2
+
+    def test_failed_shared_call_is_502_for_every_waiter(self, upstream: FakeUpstream):
+        async def refuse(request: httpx.Request) -> httpx.Response:
+            upstream.requests.append(request)
+            await asyncio.sleep(0.05)
+            raise httpx.ConnectError("refused")
+
+        app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(refuse))
+        responses = run_concurrently([{"method": "GET", "url": "/api/project/list"}] * 3)
+        assert [r.status_code for r in responses] == [502] * 3
+        assert all(r.headers["x-request-id"] for r in responses)
+        assert len({r.headers["x-request-id"] for r in responses}) == 3
+
+    def test_buffer_bounded_past_cap_and_late_joiners_start_fresh(self):
+        async def main():
+            coalescer = SingleFlight(max_buffer=10)
+            release = asyncio.Event()
+            peak = 0
+
+            async def fetch(flight: Flight):
+                nonlocal peak
+                flight.start(200, {})
+                for _ in range(10):
+                    await flight.append(b"x" * 4)
+                    peak = max(peak, flight.buffered)
+                await release.wait()
+
+            subscriber, _ = coalescer.join("k", fetch)
+            await subscriber.head()
+            body = b""
+            async for chunk in subscriber.iterate():
+                body += chunk
+                if len(body) == 40:
+                    # Body is past the cap: a new request cannot replay it
+                    _, leader = coalescer.join("k", fetch)
+                    assert leader
+                    release.set()
+            assert body == b"x" * 40
+            assert peak <= 10 + 4
+            return coalescer.stats()
+
+        stats = asyncio.run(main())
+        assert stats["leaders"] == 2 and stats["overflowed"] >= 1
+
+    def test_upstream_read_waits_for_slowest_subscriber(self):
+        async def main():
+            coalescer = SingleFlight(max_buffer=8)
+            appended = 0
+
+            async def fetch(flight: Flight):
+                nonlocal appended
+                flight.start(200, {})
+                for _ in range(6):
+                    await flight.append(b"y" * 4)
+                    appended += 1
+
+            async def read(subscriber) -> bytes:
+                return b"".join([chunk async for chunk in subscriber.iterate()])
+
+            fast, _ = coalescer.join("k", fetch)
+            slow, _ = coalescer.join("k", fetch)
+            await fast.head()
+            fast_read = asyncio.ensure_future(read(fast))
+            await asyncio.sleep(0.05)
+            # Reading stalls once the buffer holds what the slow subscriber has not read
+            assert appended < 6 and not fast_read.done()
+            slow_body = await read(slow)
+            return appended, await fast_read, slow_body, coalescer.stats()
+
+        appended, fast_body, slow_body, stats = asyncio.run(main())
+        assert appended == 6 and fast_body == slow_body == b"y" * 24
+        assert stats["backpressure_stalls"] > 0
+
+    def test_upstream_call_cancelled_when_every_subscriber_leaves(self):
+        async def main():
+            coalescer = SingleFlight()
+            cancelled = asyncio.Event()
+
+            async def fetch(flight: Flight):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+            first, _ = coalescer.join("k", fetch)
+            second, _ = coalescer.join("k", fetch)
+            await asyncio.sleep(0)
+            first.leave()
+            await asyncio.sleep(0)
+            assert not cancelled.is_set()
+            second.leave()
+            await asyncio.wait_for(cancelled.wait(), 1)
+            await asyncio.sleep(0)
+            return coalescer.stats()
+
+        stats = asyncio.run(main())
+        assert stats["cancelled"] == 1 and stats["in_flight"] == 0
+
+    def test_large_streamed_body_relayed_whole_to_every_client(self, upstream: FakeUpstream, monkeypatch):
+        monkeypatch.setattr(coalescer, "max_buffer", 1024)
+        body = bytes(range(256)) * 64
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            upstream.requests.append(request)
+
+            async def chunks():
+                for i in range(0, len(body), 512):
+                    await asyncio.sleep(0.001)
+                    yield body[i:i + 512]
+
+            return httpx.Response(200, content=chunks(), headers={"Content-Type": "application/octet-stream"})
+
+        app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        responses = run_concurrently([{"method": "GET", "url": "/api/files/blob"}] * 4)
+        assert [r.content == body for r in responses] == [True] * 4
+
+
+# ── 9. Metrics ───────────────────────────────────────────────────────────────
+
+
+@pytest.fixture()
+def fresh_metrics():
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+
+
+class TestMetrics:
+    @pytest.mark.parametrize(
+        "path, route",
+        [
+            ("v1/stories/story/42", "stories/story/{id}"),
+            ("sources/3f2b8c1e-9d4a-4f7e-8a2b-1c3d5e7f9a0b/download", "sources/{id}/download"),
+            ("user/current-user", "user/current-user"),
+            ("project/list", "project/list"),
+        ],
+    )
+    def test_route_normalization(self, path: str, route: str):
+        assert normalize_route(path) == route
+
+    def test_requests_counted_by_route_method_and_status_class(self, proxy: TestClient, upstream: FakeUpstream, fresh_metrics):
+        upstream.handler = lambda request: upstream_response(
+            404 if request.url.path.endswith("/9") else 200, b"x" * 10
+        )
+        proxy.get("/api/v1/stories/story/7")
+        proxy.get("/api/stories/story/8")
+        proxy.get("/api/stories/story/9")
+
+        text = proxy.get("/metrics").text
+        assert 'proxy_requests_total{route="stories/story/{id}",method="GET",status="2xx"} 2' in text
+        assert 'proxy_requests_total{route="stories/story/{id}",method="GET",status="4xx"} 1' in text
+        assert 'proxy_response_size_bytes_sum{route="stories/story/{id}",method="GET",status="2xx"} 20' in text
+        assert 'proxy_upstream_ttfb_seconds_count{route="stories/story/{id}",method="GET",status="2xx"} 2' in text
+        assert "proxy_in_flight_requests 0" in text
+
+    def test_route_cardinality_capped(self, proxy: TestClient, upstream: FakeUpstream, fresh_metrics, monkeypatch):
+        monkeypatch.setattr(metrics, "max_routes", 2)
+        for name in ("alpha", "beta", "gamma", "delta"):
+            proxy.get(f"/api/{name}")
+        text = proxy.get("/metrics").text
+        assert 'route="other",method="GET",status="2xx"} 2' in text
+        assert 'route="gamma"' not in text
+
+
+# ── 10. Upstream balancing ───────────────────────────────────────────────────
+
+
+@pytest.fixture()
+def two_upstreams(upstream: FakeUpstream, monkeypatch) -> UpstreamPool:
+    pool = UpstreamPool(["http://a.test", "http://b.test"], policy="least_outstanding", eject_after=2)
+    monkeypatch.setattr("app.main.upstreams", pool)
+    return pool
+
+
+class TestBalancing:
+    def test_requests_spread_across_instances(self, proxy: TestClient, upstream: FakeUpstream, two_upstreams):
+        for _ in range(4):
+            proxy.post("/api/project/list", json={})
+        hosts = [request.url.host for request in upstream.requests]
+        assert set(hosts) == {"a.test", "b.test"}
+
+    def test_failing_instance_ejected(self, proxy: TestClient, upstream: FakeUpstream, two_upstreams):
+        upstream.handler = lambda request: upstream_response(503 if request.url.host == "a.test" else 200)
+        two_upstreams.upstreams[1].outstanding = 5  # steer the first requests to a.test
+        proxy.post("/api/project/list", json={})
+        proxy.post("/api/project/list", json={})
+        two_upstreams.upstreams[1].outstanding = 0
+
+        upstream.requests.clear()
+        for _ in range(3):
+            assert proxy.post("/api/project/list", json={}).status_code == 200
+        assert {request.url.host for request in upstream.requests} == {"b.test"}
+        stats = proxy.get("/internal/upstreams").json()["upstreams"]
+        assert stats[0]["available"] is False
+
+    def test_connect_failure_ejects_immediately(self):
+        pool = UpstreamPool(["http://a.test", "http://b.test"])
+        a = pool.upstreams[0]
+        pool.begin(a)
+        pool.end(a, error=httpx.ConnectError("refused"))
+        assert all(pool.pick() is pool.upstreams[1] for _ in range(10))
+
+    def test_readmitted_instance_ramps_up(self):
+        clock = FakeClock()
+        pool = UpstreamPool(["http://a.test", "http://b.test"], eject_seconds=10, slow_start=20, clock=clock)
+        a = pool.upstreams[0]
+        pool.eject(a, "test")
+        clock.now += 10
+        assert a.weight(clock.now, pool.slow_start) == pytest.approx(0.1)
+        clock.now += 10
+        assert a.weight(clock.now, pool.slow_start) == pytest.approx(0.55)
+        clock.now += 10
+        assert a.weight(clock.now, pool.slow_start) == 1.0
+
+    def test_all_ejected_still_serves(self):
+        clock = FakeClock()
+        pool = UpstreamPool(["http://a.test", "http://b.test"], eject_seconds=10, clock=clock)
+        pool.eject(pool.upstreams[1], "test")
+        clock.now += 1
+        pool.eject(pool.upstreams[0], "test")
+        assert pool.pick() is pool.upstreams[1]
+
+
+# ── 11. Circuit breaker, retries and hedging ─────────────────────────────────
+
+
+class TestResilience:
+    def test_idempotent_request_retried(self, proxy: TestClient, upstream: FakeUpstream):
+        statuses = iter([503, 200])
+        upstream.handler = lambda request: upstream_response(next(statuses), b"ok")
+        response = proxy.get("/api/project/list")
+        assert response.status_code == 200
+        assert len(upstream.requests) == 2
+
+    def test_non_idempotent_request_not_retried(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(503)
+        assert proxy.post("/api/project/create", json={}).status_code == 503
+        assert len(upstream.requests) == 1
+
+    def test_open_breaker_fails_fast(self, proxy: TestClient, upstream: FakeUpstream, monkeypatch):
+        monkeypatch.setattr(resilience.breakers, "threshold", 2)
+        upstream.handler = lambda request: upstream_response(500)
+        proxy.post("/api/stories/story/1", json={})
+        proxy.post("/api/stories/story/2", json={})
+        upstream.requests.clear()
+
+        response = proxy.post("/api/stories/story/3", json={})
+        assert response.status_code == 503
+        assert int(response.headers["retry-after"]) >= 1
+        assert upstream.requests == []
+        # Other routes are unaffected
+        assert proxy.post("/api/project/list", json={}).status_code == 500
+
+        breakers = proxy.get("/internal/breakers").json()["breakers"]
+        assert {b["route"]: b["state"] for b in breakers}["stories/story/{id}"] == "open"
+
+    def test_retry_budget_caps_retries(self):
+        clock = FakeClock()
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2, clock=clock)
+        assert budget.try_spend() and budget.try_spend()
+        assert not budget.try_spend()
+        budget.deposit()
+        budget.deposit()
+        assert budget.try_spend()
+
+    def test_slow_get_hedged_to_second_instance(self, upstream: FakeUpstream, monkeypatch):
+        async def handler(request: httpx.Request) -> httpx.Response:
+            upstream.requests.append(request)
+            if request.url.host == "slow.test":
+                await asyncio.sleep(0.5)
+            return upstream_response(json_body={"host": request.url.host})
+
+        pool = UpstreamPool(["http://slow.test", "http://fast.test"], policy="least_outstanding")
+        pool.upstreams[1].outstanding = 1  # make the slow instance the first choice
+        monkeypatch.setattr("app.main.upstreams", pool)
+        monkeypatch.setattr(resilience, "hedge_enabled", True)
+        monkeypatch.setattr("app.resilience.HEDGE_DEFAULT_DELAY_MS", 20)
+        app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        [response] = run_concurrently([{"method": "GET", "url": "/api/project/list"}])
+        assert response.json() == {"host": "fast.test"}
+        assert [r.url.host for r in upstream.requests] == ["slow.test", "fast.test"]
+
+
+# ── 12. Admission control and rate limiting ──────────────────────────────────
+
+
+class TestAdmission:
+    def test_user_bucket_returns_429(self, proxy: TestClient, upstream: FakeUpstream, monkeypatch):
+        limiter = RateLimiter([RateLimit("user", r".*", rate=1, burst=2)], enabled=True)
+        monkeypatch.setattr("app.main.rate_limiter", limiter)
+        alice = {"X-User-ID": "alice"}
+        assert proxy.get("/api/project/list", headers=alice).status_code == 200
+        assert proxy.get("/api/project/list", headers=alice).status_code == 200
+        limited = proxy.get("/api/project/list", headers=alice)
+        assert limited.status_code == 429
+        assert int(limited.headers["retry-after"]) >= 1
+        assert len(upstream.requests) == 2
+        # Buckets are per user
+        assert proxy.get("/api/project/list", headers={"X-User-ID": "bob"}).status_code == 200
+
+    def test_anonymous_clients_limited_by_address(self, upstream: FakeUpstream, monkeypatch):
+        limiter = RateLimiter([RateLimit("user", r".*", rate=0.1, burst=1)], enabled=True)
+        monkeypatch.setattr("app.main.rate_limiter", limiter)
+
+        async def main():
+            statuses = []
+            for address in ["10.0.0.1", "10.0.0.1", "10.0.0.2"]:
+                transport = httpx.ASGITransport(app=app, client=(address, 40000))
+                async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as c:
+                    statuses.append((await c.get("/api/project/list")).status_code)
+            return statuses
+
+        # Neither client sends X-User-ID: each gets its own bucket, not the default user's
+        assert asyncio.run(main()) == [200, 429, 200]
+
+    def test_chat_async_has_tighter_limit(self, proxy: TestClient, upstream: FakeUpstream, monkeypatch):
+        limiter = RateLimiter(
+            [
+                RateLimit("user", r".*", rate=100, burst=100),
+                RateLimit("chat", r"(?:.+/)?chat/async", rate=0.1, burst=1, methods=frozenset({"POST"})),
+            ],
+            enabled=True,
+        )
+        monkeypatch.setattr("app.main.rate_limiter", limiter)
+        assert proxy.post("/api/chat/async", json={}).status_code == 200
+        assert proxy.post("/api/chat/async", json={}).status_code == 429
+        assert proxy.get("/api/project/list").status_code == 200
+
+    def test_rejected_request_spends_no_tokens(self):
+        clock = FakeClock()
+        limiter = RateLimiter(
+            [RateLimit("user", r".*", rate=1, burst=2), RateLimit("route", r"chat", rate=1, burst=1, per_user=False)],
+            enabled=True,
+            clock=clock,
+        )
+        limiter.check("POST", "chat", "a")
+        with pytest.raises(RateLimited):
+            limiter.check("POST", "chat", "a")
+        # The shared route bucket refused; user a still has one token left
+        limiter.check("GET", "other", "a")
+
+    def test_buckets_bounded_and_idle_evicted(self):
+        clock = FakeClock()
+        limiter = RateLimiter(
+            [RateLimit("user", r".*", rate=1, burst=1)], enabled=True, max_buckets=3, idle_seconds=60, clock=clock
+        )
+        for user in "abcde":
+            limiter.check("GET", "x", user)
+        assert limiter.stats()["buckets"] == 3
+        clock.now += 61
+        limiter.check("GET", "x", "f")
+        assert limiter.stats()["buckets"] == 1
+
+    def test_overload_shed_with_503(self, slow_upstream: FakeUpstream, monkeypatch):
+        monkeypatch.setattr("app.main.admission", AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5))
+        responses = run_concurrently(
+            [{"method": "GET", "url": "/api/project/list", "headers": {"X-User-ID": str(i)}} for i in range(3)]
+        )
+        assert sorted(r.status_code for r in responses) == [200, 200, 503]
+        shed = next(r for r in responses if r.status_code == 503)
+        assert shed.headers["retry-after"] == "1"
+
+    def test_queue_wait_times_out(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=0.01)
+
+        async def main():
+            await controller.acquire()
+            with pytest.raises(Overloaded):
+                await controller.acquire()
+            controller.release()
+            await controller.acquire()  # the abandoned waiter did not keep the slot
+
+        asyncio.run(main())
+        assert controller.stats()["in_flight"] == 1
+        assert controller.stats()["shed"] == 1
+
+    def test_upstream_read_error_releases_slot(
+        self, proxy: TestClient, upstream: FakeUpstream, fresh_metrics, monkeypatch
+    ):
+        controller = AdmissionController(max_in_flight=2, max_queue=0)
+        monkeypatch.setattr("app.main.admission", controller)
+        monkeypatch.setattr(coalescer, "enabled", False)
+
+        def reset_mid_body(request: httpx.Request) -> httpx.Response:
+            async def chunks():
+                yield b'{"partial": '
+                raise httpx.ReadError("connection reset")
+
+            return httpx.Response(200, content=chunks(), headers={"Content-Type": "application/json"})
+
+        upstream.handler = reset_mid_body
+        for _ in range(3):
+            # Streamed (read ahead for compression) and buffered (polled route) relays
+            assert proxy.post("/api/project/list", json={}).status_code == 502
+            assert proxy.get("/api/events").status_code == 502
+        assert controller.in_flight == 0
+        assert metrics.in_flight == 0
+
+    def test_stats_endpoint(self, proxy: TestClient):
+        stats = proxy.get("/internal/admission").json()
+        assert stats["admission"]["max_in_flight"] == admission.max_in_flight
+        assert {r["name"] for r in stats["rate_limits"]["rules"]} >= {"user", "chat"}
+
+
+# ── 13. Request IDs, Server-Timing and span export ───────────────────────────
+
+
+class TestTracing:
+    def test_request_id_forwarded_and_echoed(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.get("/api/project/list")
+        sent = upstream.requests[0].headers["x-request-id"]
+        assert r.headers["x-request-id"] == sent
+        assert len(sent) == 36
+
+    def test_client_request_id_kept_unless_malformed(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.get("/api/project/list", headers={"X-Request-ID": "browser-42"})
+        assert r.headers["x-request-id"] == upstream.requests[0].headers["x-request-id"] == "browser-42"
+        r = proxy.get("/api/project/list", headers={"X-Request-ID": "bad id\t"})
+        assert r.headers["x-request-id"] != "bad id\t"
+
+    def test_server_timing_phases(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.post("/api/chat/async", json={"message": "hi"})
+        names = [entry.split(";")[0] for entry in r.headers["server-timing"].split(", ")]
+        assert {"admit", "read", "transform", "ttfb", "total"} <= set(names)
+        assert r.headers["x-request-id"]
+
+    def test_upstream_transport_error_is_502_with_request_id(
+        self, proxy: TestClient, upstream: FakeUpstream, monkeypatch
+    ):
+        monkeypatch.setattr(coalescer, "enabled", False)
+
+        def refuse(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectError("refused")
+
+        upstream.handler = refuse
+        for method, url in [("GET", "/api/project/list"), ("GET", "/api/user/current-user"), ("POST", "/api/chat/async")]:
+            r = proxy.request(method, url, json={} if method == "POST" else None)
+            assert r.status_code == 502
+            assert r.headers["x-request-id"] and "total;dur=" in r.headers["server-timing"]
+            assert "ConnectError" in r.json()["detail"]
+
+    def test_errors_carry_request_id(self, proxy: TestClient, upstream: FakeUpstream, monkeypatch):
+        app_admission = AdmissionController(max_in_flight=1, max_queue=0)
+        asyncio.run(app_admission.acquire())
+        monkeypatch.setattr("app.main.admission", app_admission)
+        r = proxy.get("/api/project/list")
+        assert r.status_code == 503
+        assert r.headers["x-request-id"]
+        assert "total;dur=" in r.headers["server-timing"]
+
+    def test_spans_exported_as_otlp_json(self, proxy: TestClient, upstream: FakeUpstream, tmp_path, monkeypatch):
+        exporter = SpanExporter(file_path=str(tmp_path / "spans.jsonl"), endpoint="")
+        monkeypatch.setattr("app.main.span_exporter", exporter)
+        monkeypatch.setattr("app.tracing.span_exporter", exporter)
+        parent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        proxy.get("/api/stories/story/42", headers={"traceparent": parent})
+        asyncio.run(exporter.flush())
+
+        (line,) = (tmp_path / "spans.jsonl").read_text().splitlines()
+        spans = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        root = spans[0]
+        assert root["name"] == "GET stories/story/{id}"
+        assert root["traceId"] == "0af7651916cd43dd8448eb211c80319c"
+        assert root["parentSpanId"] == "b7ad6b7169203331"
+        assert {s["name"] for s in spans[1:]} >= {"proxy.ttfb", "proxy.relay"}
+        assert all(s["parentSpanId"] == root["spanId"] for s in spans[1:])
+        forwarded = upstream.requests[0].headers["traceparent"]
+        assert forwarded == f"00-{root['traceId']}-{root['spanId']}-01"
+        assert exporter.stats()["exported"] == 1
+
+
+# ── 14. Batch API ────────────────────────────────────────────────────────────
+
+
+class TestBatch:
+    def test_results_in_request_order(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(
+            json_body={"path": request.url.path, "user": request.headers["x-user-id"]}
+        )
+        r = proxy.post(
+            "/api/batch",
+            json={"requests": [
+                {"path": "user/current-user"},
+                {"id": "list", "path": "/api/project/list?page=2"},
+            ]},
+            headers={"X-User-ID": "u-1"},
+        )
+        assert r.status_code == 200
+        first, second = r.json()["responses"]
+        assert (first["id"], first["status"], first["body"]) == ("0", 200, {"path": "/user/current-user", "user": "u-1"})
+        assert second["id"] == "list" and second["body"]["path"] == "/project/list"
+        forwarded = {req.url.path: req for req in upstream.requests}
+        assert forwarded["/project/list"].url.query == b"page=2"
+        assert forwarded["/project/list"].headers["x-api-key"]
+        assert forwarded["/project/list"].headers["x-request-id"] == f"{r.headers['x-request-id']}.1"
+
+    def test_sub_requests_share_the_cache(self, proxy: TestClient, upstream: FakeUpstream):
+        proxy.get("/api/prompts", headers={"X-User-ID": "u-1", "Accept-Encoding": "identity"})
+        r = proxy.post("/api/batch", json={"requests": [{"path": "prompts"}]}, headers={"X-User-ID": "u-1"})
+        assert r.json()["responses"][0]["headers"]["x-cache"] == "HIT"
+        assert len(upstream.requests) == 1
+
+    def test_post_body_and_failures_isolated(self, proxy: TestClient, upstream: FakeUpstream):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.endswith("broken"):
+                return upstream_response(500, json_body={"detail": "boom"})
+            return upstream_response(json_body=json.loads(request.content))
+
+        upstream.handler = handler
+        r = proxy.post("/api/batch", json={"requests": [
+            {"method": "POST", "path": "project/create", "body": {"name": "x"}},
+            {"path": "broken"},
+        ]})
+        ok, failed = r.json()["responses"]
+        assert ok["body"] == {"name": "x"}
+        assert failed["status"] == 500
+
+    def test_ndjson_stream(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.post(
+            "/api/batch",
+            json={"requests": [{"path": "a"}, {"path": "b"}, {"path": "c"}]},
+            headers={"Accept": "application/x-ndjson"},
+        )
+        assert r.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in r.text.splitlines()]
+        assert sorted(line["id"] for line in lines) == ["0", "1", "2"]
+
+    def test_limits(self, proxy: TestClient, monkeypatch):
+        monkeypatch.setattr("app.main.BATCH_MAX_REQUESTS", 2)
+        r = proxy.post("/api/batch", json={"requests": [{"path": "a"}] * 3})
+        assert r.status_code == 413
+        r = proxy.post("/api/batch", json={"requests": [{"path": "batch"}]})
+        assert r.status_code == 422
+
+
+# ── 15. Timeouts, deadlines and client disconnects ───────────────────────────
+
+
+class TestDeadlines:
+    def test_route_timeouts(self):
+        policies = TimeoutPolicies(default_timeout_policies(), default=30.0)
+        assert policies.timeout_for("GET", "user/current-user") < 30.0
+        assert policies.timeout_for("POST", "user/current-user") == 30.0
+        assert policies.timeout_for("POST", "project/p-1/chat/async") > 30.0
+        assert policies.timeout_for("GET", "project/list") == 30.0
+
+    def test_client_can_only_shorten(self):
+        policies = TimeoutPolicies([], default=30.0)
+        assert policies.deadline("GET", "x", "2000").timeout == 2.0
+        assert policies.deadline("GET", "x", "90000").timeout == 30.0
+        assert policies.deadline("GET", "x", "soon").timeout == 30.0
+        assert policies.client_deadlines == 1
+
+    def test_remaining_budget_forwarded(self, proxy: TestClient, upstream: FakeUpstream):
+        proxy.get("/api/project/list", headers={"X-Request-Timeout-Ms": "1500"})
+        assert 0 < int(upstream.requests[0].headers["x-request-timeout-ms"]) <= 1500
+
+    def test_slow_upstream_gets_504(self, slow_upstream: FakeUpstream, monkeypatch):
+        policies = TimeoutPolicies([TimeoutPolicy(r"project/list", 0.01)])
+        monkeypatch.setattr("app.main.timeouts", policies)
+        r = TestClient(app).post("/api/project/list", json={})
+        assert r.status_code == 504
+        assert r.headers["x-request-id"]
+        assert policies.timed_out == 1
+
+    def test_disconnect_cancels_upstream_call(self):
+        cancelled = []
+
+        async def upstream_call():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        messages = iter([{"type": "http.request", "body": b"", "more_body": False}, {"type": "http.disconnect"}])
+
+        async def receive():
+            await asyncio.sleep(0)
+            return next(messages)
+
+        with pytest.raises(ClientDisconnected):
+            asyncio.run(asyncio.wait_for(unless_disconnected(upstream_call(), receive), 1))
+        assert cancelled == [True]
+
+    def test_relay_cleans_up_when_client_leaves_mid_body(self):
+        closed = []
+
+        async def chunks():
+            yield b"first"
+            yield b"second"
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                raise OSError("connection reset")
+
+        async def receive():
+            await asyncio.sleep(5)
+
+        relayed = RelayResponse(chunks(), background=BackgroundTask(lambda: closed.append(True)))
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(Exception):
+            asyncio.run(relayed(scope, receive, send))
+        assert closed == [True] and relayed.client_disconnected
+
+
+# ── 16. Bulk story forwarding ────────────────────────────────────────────────
+
+
+def story(story_id: str) -> dict:
+    return {"story_id": story_id, "user_config_params": {"tone": "calm"}, "story_plan_config_id": "plan-1"}
+
+
+class TestStoryBulk:
+    def test_single_story_forwarded(self, proxy: TestClient, upstream: FakeUpstream):
+        upstream.handler = lambda request: upstream_response(json_body={"queued": json.loads(request.content)["story_id"]})
+        r = proxy.post("/forward-story", json=story("s-1"))
+        assert r.json() == {"queued": "s-1"}
+        assert upstream.requests[0].headers["content-type"] == "application/json"
+
+    def test_json_array_with_invalid_item(self, proxy: TestClient, upstream: FakeUpstream):
+        r = proxy.post("/forward-story/bulk", json=[story("s-0"), {"story_id": "s-1"}, story("s-2")])
+        assert r.headers["content-type"].startswith("application/x-ndjson")
+        lines = {line["index"]: line for line in map(json.loads, r.text.splitlines())}
+        assert {i: line["status"] for i, line in lines.items()} == {0: 200, 1: 422, 2: 200}
+        assert lines[1]["error"][0]["loc"] == ["user_config_params"]
+        assert lines[2]["story_id"] == "s-2" and lines[2]["body"] == {"ok": True}
+        assert len(upstream.requests) == 2
+
+    def test_ndjson_failures_isolated(self, proxy: TestClient, upstream: FakeUpstream):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if json.loads(request.content)["story_id"] == "s-1":
+                raise httpx.ConnectError("refused")
+            return upstream_response(json_body={"ok": True})
+
+        upstream.handler = handler
+        body = "\n".join(json.dumps(story(f"s-{i}")) for i in range(3)) + "\n\nnot json\n"
+        r = proxy.post("/forward-story/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+        statuses = {line["index"]: line["status"] for line in map(json.loads, r.text.splitlines())}
+        assert statuses == {0: 200, 1: 502, 2: 200, 3: 422}
+
+    def test_not_an_array(self, proxy: TestClient):
+        assert proxy.post("/forward-story/bulk", json=story("s-0")).status_code == 422
+
+    def test_concurrency_bounded(self):
+        running, peak = 0, 0
+
+        async def send(payload: StoryPayload) -> httpx.Response:
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return httpx.Response(200, json={"id": payload.story_id})
+
+        async def main() -> List[bytes]:
+            items = parse_story_array(json.dumps([story(f"s-{i}") for i in range(10)]).encode())
+            return [line async for line in StoryBulkRun(send, concurrency=3).stream(story_items(items))]
+
+        lines = asyncio.run(main())
+        assert len(lines) == 10 and peak == 3
+
+
+    def test_cancelled_bulk_run_ends_upstream_load(self, monkeypatch):
+        pool = UpstreamPool(["http://a.test"])
+        monkeypatch.setattr("app.main.upstreams", pool)
+        monkeypatch.setattr("app.main.admission", AdmissionController(max_in_flight=10))
+
+        async def hang(request: httpx.Request) -> httpx.Response:
+            await asyncio.sleep(10)
+            return upstream_response()
+
+        async def main():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(hang))
+            items = parse_story_array(json.dumps([story("s-0"), story("s-1")]).encode())
+            run = StoryBulkRun(lambda payload: send_story(client, payload), concurrency=2)
+            lines = run.stream(story_items(items))
+            pending = asyncio.ensure_future(lines.__anext__())
+            while pool.upstreams[0].outstanding < 2:
+                await asyncio.sleep(0.01)
+            # The bulk client disconnects while both stories are in flight
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+            await lines.aclose()
+            await asyncio.sleep(0.01)
+            return pool.upstreams[0].outstanding
+
+        assert asyncio.run(main()) == 0
+
+
+# ── 17. ETags and conditional requests ───────────────────────────────────────
+
+
+@pytest.fixture()
+def fresh_conditional(monkeypatch) -> ConditionalRequests:
+    conditional = ConditionalRequests()
+    monkeypatch.setattr("app.main.conditional", conditional)
+    return conditional
+
+
+class TestConditional:
+    def test_if_none_match_comparison(self):
+        assert etag_matches('"a", "b"', '"b"')
+        assert etag_matches('W/"a"', '"a"')
+        assert etag_matches("*", '"a"')
+        assert not etag_matches('"a-gzip"', '"a"')
+
+    def test_cached_route_answers_304(self, proxy: TestClient, upstream: FakeUpstream, fresh_conditional):
+        first = proxy.get("/api/prompts", headers={"Accept-Encoding": "identity"})
+        etag = first.headers["etag"]
+        again = proxy.get("/api/prompts", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+        assert again.status_code == 304 and again.content == b""
+        assert again.headers["etag"] == etag
+        assert len(upstream.requests) == 1
+        assert fresh_conditional.stats()["not_modified"] == 1
+
+    def test_streamed_response_keeps_upstream_etag(self, proxy: TestClient, upstream: FakeUpstream, fresh_conditional):
+        upstream.handler = lambda request: upstream_response(json_body={"ok": True}, headers={"ETag": '"v1"'})
+        assert proxy.get("/api/project/list").headers["etag"] == '"v1"'
+        r = proxy.get("/api/project/list", headers={"If-None-Match": '"v0", "v1"'})
+        assert r.status_code == 304 and r.content == b""
+        assert "if-none-match" not in upstream.requests[-1].headers
+
+    def test_polled_route_revalidated_upstream(self, proxy: TestClient, upstream: FakeUpstream, fresh_conditional):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.headers.get("if-none-match") == '"v7"':
+                return upstream_response(304, headers={"ETag": '"v7"'})
+            return upstream_response(json_body={"status": "generating"}, headers={"ETag": '"v7"'})
+
+        upstream.handler = handler
+        first = proxy.get("/api/stories/story/42")
+        second = proxy.get("/api/stories/story/42")
+        assert upstream.requests[1].headers["if-none-match"] == '"v7"'
+        assert second.status_code == 200 and second.json() == first.json() == {"status": "generating"}
+        third = proxy.get("/api/stories/story/42", headers={"If-None-Match": second.headers["etag"]})
+        assert third.status_code == 304
+        assert fresh_conditional.stats()["upstream_revalidated"] == 2
+        # another user's poll does not reuse this copy
+        proxy.get("/api/stories/story/42", headers={"X-User-ID": "u-2"})
+        assert "if-none-match" not in upstream.requests[-1].headers
+
+
+# ── 18. Traffic capture ──────────────────────────────────────────────────────
+
+
+class TestCapture:
+    def test_requests_captured_redacted(self, proxy: TestClient, upstream: FakeUpstream, tmp_path, monkeypatch):
+        capture = TrafficCapture(directory=str(tmp_path), enabled=True, max_body_bytes=64)
+        monkeypatch.setattr("app.main.traffic_capture", capture)
+        proxy.get("/api/v1/project/list?page=2", headers={"Authorization": "Bearer secret", "X-User-ID": "u-1"})
+        proxy.post("/api/project/create", json={"name": "x", "password": "hunter2"})
+        proxy.post("/api/sources/upload-source", content=b"x" * 100, headers={"Content-Type": "text/plain"})
+        asyncio.run(capture.flush())
+
+        get, create, upload = map(json.loads, (tmp_path / "capture.jsonl").read_text().splitlines())
+        assert (get["path"], get["query"], get["status"]) == ("/api/v1/project/list", "page=2", 200)
+        assert get["headers"]["authorization"] == "[REDACTED]" and get["headers"]["x-user-id"] == "u-1"
+        assert "host" not in get["headers"] and "body" not in get
+        assert json.loads(create["body"]) == {"name": "x", "password": "[REDACTED]"}
+        assert upload["body"] == "x" * 64 and upload["body_truncated"] and upload["body_bytes"] == 100
+
+        # A cut JSON body cannot be redacted, so only its size is kept
+        proxy.post("/api/project/create", json={"password": "hunter2", "notes": "n" * 100})
+        asyncio.run(capture.flush())
+        cut = json.loads((tmp_path / "capture.jsonl").read_text().splitlines()[-1])
+        assert "body" not in cut and cut["body_bytes"] > 64
+
+    def test_ring_buffer_rotates(self, tmp_path):
+        capture = TrafficCapture(directory=str(tmp_path), enabled=True, file_bytes=600, files=2)
+        for n in range(10):
+            capture.submit("GET", f"/api/item/{n}", "", {}, b"", 0, 200, 0.01, f"id-{n}")
+            asyncio.run(capture.flush())
+        assert sorted(p.name for p in tmp_path.glob("capture.jsonl*")) == ["capture.jsonl", "capture.jsonl.1"]
+        assert capture.rotations > 0 and capture.captured == 10
+        assert "/api/item/9" in (tmp_path / "capture.jsonl").read_text()
+
+    def test_full_queue_drops(self):
+        capture = TrafficCapture(enabled=True, max_queue=1)
+        for _ in range(3):
+            capture.submit("GET", "/api/x", "", {}, b"", 0, 200, 0.01, "id")
+        assert capture.stats()["queued"] == 1 and capture.dropped == 2
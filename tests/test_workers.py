@@ -0,0 +1,155 @@
+"""Offline tests for multi-worker coordination.
+
+Run with:  pytest tests/test_workers.py
+Requires:  nothing — worker processes are simulated by several locks,
+           notifiers, registries and ingestors in one process (flock locks
+           conflict across open file descriptions, not just processes).
+"""
+
+import asyncio
+import json
+from pathlib import Path
+from typing import List
+
+from app.ingest import READY, SourceFile, SourceIngestor
+from app.source_registry import SourceRecord, SourceRegistry, owner_key
+from app.workers import ChangeNotifier, FileLock, atomic_write
+
+
+def record(source_id: str, user: str) -> SourceRecord:
+    return SourceRecord(source_id, owner_key(user), source_id, f"https://cdn.example.com/{source_id}.parquet", 1.0)
+
+
+class TestFileLock:
+    def test_only_one_holder(self, tmp_path):
+        first, second = FileLock(tmp_path / "leader.lock"), FileLock(tmp_path / "leader.lock")
+        assert first.acquire(blocking=False, content="1 token\n")
+        assert not second.acquire(blocking=False)
+        assert (tmp_path / "leader.lock").read_text() == "1 token\n"
+        first.release()
+        assert second.acquire(blocking=False)
+        second.release()
+
+    def test_atomic_write_leaves_no_temp_file(self, tmp_path):
+        target = tmp_path / "state" / "sources.json"
+        atomic_write(target, b"one")
+        atomic_write(target, b"two")
+        assert target.read_bytes() == b"two"
+        assert [p.name for p in target.parent.iterdir()] == ["sources.json"]
+
+
+class TestChangeNotifier:
+    def test_peers_notified(self, tmp_path):
+        received: List[str] = []
+
+        async def main():
+            a = ChangeNotifier(tmp_path, received.append, name="a")
+            b = ChangeNotifier(tmp_path, lambda topic: None, name="b")
+            await a.start()
+            await b.start()
+            (tmp_path / "dead.sock").touch()  # left behind by a killed worker
+            await b.refresh()
+            b.notify("sources")
+            await asyncio.sleep(0.05)
+            a.close()
+            b.close()
+
+        asyncio.run(main())
+        assert received == ["sources"]
+        assert not (tmp_path / "dead.sock").exists()
+
+    def test_notify_uses_cached_peers_and_new_workers_announce(self, tmp_path, monkeypatch):
+        received: List[str] = []
+
+        async def main():
+            a = ChangeNotifier(tmp_path, lambda topic: None, name="a")
+            await a.start()
+            assert a.stats()["peers"] == 0
+            # b announces itself on start, so a rescans without waiting for the periodic refresh
+            b = ChangeNotifier(tmp_path, received.append, name="b")
+            await b.start()
+            await asyncio.sleep(0.05)
+            assert a.stats()["peers"] == 1
+
+            def no_scan(*args):
+                raise AssertionError("notify must not scan the state directory")
+
+            monkeypatch.setattr(Path, "glob", no_scan)
+            a.notify("sources")
+            await asyncio.sleep(0.05)
+            a.close()
+            b.close()
+
+        asyncio.run(main())
+        assert received == ["sources"]
+
+
+class TestSharedRegistry:
+    def test_concurrent_writers_do_not_lose_updates(self, tmp_path):
+        path = tmp_path / "sources.json"
+        worker_a, worker_b = SourceRegistry(path), SourceRegistry(path)
+
+        async def main():
+            await worker_a.update(lambda: worker_a.register(record("a1", "alice")))
+            # worker_b has not reloaded since a1 was written
+            await worker_b.update(lambda: worker_b.register(record("b1", "bob")))
+            await worker_a.reload()
+
+        asyncio.run(main())
+        assert worker_b.lookup("alice") and worker_b.lookup("bob")
+        assert worker_a.lookup("bob")
+        assert len(json.loads(path.read_bytes())["sources"]) == 2
+
+
+class TestLeaderElection:
+    def test_one_worker_ingests_others_follow(self, tmp_path):
+        source = tmp_path / "doc.txt"
+        source.write_text("Doc\n\nbody")
+        uploads: List[str] = []
+
+        async def upload(source_file: SourceFile) -> dict:
+            uploads.append(source_file.filename)
+            await asyncio.sleep(0.05)
+            return {"download_url": f"https://cdn.example.com/{source_file.source_id}.parquet"}
+
+        def worker() -> SourceIngestor:
+            return SourceIngestor(
+                SourceRegistry(tmp_path / "sources.json"),
+                upload,
+                manifest_path=tmp_path / "manifest.json",
+                status_path=tmp_path / "ingestion.json",
+            )
+
+        leader, follower = worker(), worker()
+        leader.on_change = follower.poke
+
+        async def main():
+            await asyncio.gather(
+                leader.lead_or_follow([source], FileLock(tmp_path / "leader.lock"), poll=5),
+                follower.lead_or_follow([source], FileLock(tmp_path / "leader.lock"), poll=5),
+            )
+
+        asyncio.run(asyncio.wait_for(main(), 2))
+        assert uploads == ["doc.txt"]
+        assert (leader.role, follower.role) == ("leader", "follower")
+        assert leader.state == follower.state == READY
+
+    def test_follower_takes_over_from_dead_leader(self, tmp_path):
+        # A leader that crashed mid-run left "running" behind and released its lock
+        atomic_write(tmp_path / "ingestion.json", json.dumps({"state": "running", "token": "old"}).encode())
+        (tmp_path / "leader.lock").write_text("123 old\n")
+
+        async def upload(source_file: SourceFile) -> dict:
+            return {"download_url": "https://cdn.example.com/doc.parquet"}
+
+        source = tmp_path / "doc.txt"
+        source.write_text("Doc")
+        ingestor = SourceIngestor(
+            SourceRegistry(tmp_path / "sources.json"),
+            upload,
+            manifest_path=tmp_path / "manifest.json",
+            status_path=tmp_path / "ingestion.json",
+        )
+        asyncio.run(ingestor.lead_or_follow([source], FileLock(tmp_path / "leader.lock"), poll=5))
+        assert ingestor.role == "leader" and ingestor.stats()["uploaded"] == 1
+        assert json.loads((tmp_path / "ingestion.json").read_bytes())["state"] == READY
@@ -0,0 +1,295 @@
+"""Offline tests for the WebSocket relay.
+
+Run with:  pytest tests/test_ws_relay.py
+Requires:  nothing — a local `websockets` server stands in for platform-api's
+           WebSocket endpoints, and the proxy runs in-process via TestClient.
+"""
+
+import asyncio
+import threading
+from typing import Dict, List
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from websockets.asyncio.server import ServerConnection, serve
+
+from app.balancer import UpstreamPool
+from app.main import app
+from app.ws_fanout import TRY_AGAIN_LATER, ChannelHub, Subscriber, fanout
+from app.ws_relay import Closed, upstream_ws_url
+
+
+# ── helpers ──────────────────────────────────────────────────────────────────
+
+
+class StandInWebSocketServer:
+    """platform-api stand-in running its own event loop in a background thread.
+
+    Behaviour is chosen by the last path segment:
+      echo-*   echoes every frame back
+      push-*   sends three status frames, then closes with 1000
+      slow-*   stalls before reading, then acknowledges every frame it got
+      idle-*   never reads; waits for the proxy to close the socket
+    """
+
+    def __init__(self):
+        self.port = 0
+        self.handshakes: List[Dict[str, str]] = []
+        self.paths: List[str] = []
+        self.closed = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._stop: asyncio.Future = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    async def _handler(self, ws: ServerConnection):
+        self.handshakes.append(dict(ws.request.headers))
+        self.paths.append(ws.request.path)
+        kind = ws.request.path.rstrip("/").split("/")[-1].split("-")[0]
+        try:
+            if kind == "echo":
+                async for message in ws:
+                    await ws.send(message)
+            elif kind == "push":
+                for i in range(3):
+                    await ws.send(f"status-{i}")
+                await ws.close(1000, "done")
+            elif kind == "slow":
+                await asyncio.sleep(0.3)
+                count = 0
+                async for message in ws:
+                    count += 1
+                    if message == "last":
+                        await ws.send(f"got {count}")
+            elif kind == "idle":
+                await ws.wait_closed()
+        finally:
+            self.closed.set()
+
+    async def _main(self):
+        self._stop = self._loop.create_future()
+        async with serve(self._handler, "127.0.0.1", 0) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            self._ready.set()
+            await self._stop
+
+    def _run(self):
+        self._loop.run_until_complete(self._main())
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set_result, None)
+        self._thread.join(5)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+@pytest.fixture()
+def ws_upstream(monkeypatch) -> StandInWebSocketServer:
+    server = StandInWebSocketServer()
+    server.start()
+    monkeypatch.setattr("app.main.upstreams", UpstreamPool([server.base_url]))
+    yield server
+    server.stop()
+
+
+@pytest.fixture()
+def proxy() -> TestClient:
+    return TestClient(app)
+
+
+class FakeClientSocket:
+    """Minimal stand-in for a browser socket, driven from the test's own loop."""
+
+    def __init__(self):
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.sent: asyncio.Queue = asyncio.Queue()
+        self.accepted = False
+        self.close_code = None
+
+    async def accept(self):
+        self.accepted = True
+
+    async def receive(self) -> dict:
+        return await self.inbox.get()
+
+    async def send_text(self, data: str):
+        await self.sent.put(data)
+
+    async def send_bytes(self, data: bytes):
+        await self.sent.put(data)
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.close_code = code
+
+    def say(self, text: str):
+        self.inbox.put_nowait({"type": "websocket.receive", "text": text})
+
+    def leave(self):
+        self.inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+    async def next_frame(self):
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+
+# ── 1. Relay ─────────────────────────────────────────────────────────────────
+
+
+class TestWebSocketRelay:
+    @pytest.fixture(autouse=True, params=["fanout", "relay"])
+    def ws_mode(self, request, monkeypatch):
+        """Every relay test runs against both the shared-channel and 1:1 modes."""
+        monkeypatch.setattr("app.main.WS_FANOUT_ENABLED", request.param == "fanout")
+
+    def test_frames_relayed_both_ways(self, proxy: TestClient, ws_upstream):
+        with proxy.websocket_connect("/ws/echo-1") as ws:
+            ws.send_text("hello")
+            assert ws.receive_text() == "hello"
+            ws.send_bytes(b"\x00\x01")
+            assert ws.receive_bytes() == b"\x00\x01"
+
+    def test_custom_headers_sent_upstream(self, proxy: TestClient, ws_upstream):
+        with proxy.websocket_connect("/user/ws/echo-2", headers={"X-User-ID": "u-9"}) as ws:
+            ws.send_text("ping")
+            ws.receive_text()
+        handshake = {k.lower(): v for k, v in ws_upstream.handshakes[0].items()}
+        assert handshake["x-user-id"] == "u-9"
+        assert "x-api-key" in handshake
+        assert "x-domain" in handshake
+        assert "x-forwarded-host" in handshake
+        assert ws_upstream.paths[0] == "/user/ws/echo-2"
+
+    def test_api_prefix_stripped(self, proxy: TestClient, ws_upstream):
+        with proxy.websocket_connect("/api/ws/echo-3?token=t") as ws:
+            ws.send_text("x")
+            ws.receive_text()
+        assert ws_upstream.paths[0] == "/ws/echo-3?token=t"
+
+    def test_upstream_frames_flushed_before_close(self, proxy: TestClient, ws_upstream):
+        with proxy.websocket_connect("/ws/push-1") as ws:
+            assert [ws.receive_text() for _ in range(3)] == ["status-0", "status-1", "status-2"]
+            with pytest.raises(WebSocketDisconnect) as closed:
+                ws.receive_text()
+        assert closed.value.code == 1000
+
+    def test_client_disconnect_closes_upstream(self, proxy: TestClient, ws_upstream):
+        with proxy.websocket_connect("/ws/idle-1") as ws:
+            ws.send_text("one")
+        assert ws_upstream.closed.wait(5)
+
+    def test_upstream_unreachable_rejects_handshake(self, proxy: TestClient, monkeypatch):
+        monkeypatch.setattr("app.main.upstreams", UpstreamPool(["http://127.0.0.1:9"]))
+        with pytest.raises(WebSocketDisconnect):
+            with proxy.websocket_connect("/ws/echo-4"):
+                pass
+
+    def test_backpressure_with_stalled_upstream(self, proxy: TestClient, ws_upstream, monkeypatch):
+        monkeypatch.setattr("app.ws_relay.WS_BUFFER_FRAMES", 2)
+        # Upstream stalls while the client bursts frames: the relay's tiny
+        # bounded buffers fill and push back, and nothing is lost or reordered
+        with proxy.websocket_connect("/ws/slow-1") as ws:
+            for _ in range(49):
+                ws.send_text("x" * 1024)
+            ws.send_text("last")
+            assert ws.receive_text() == "got 50"
+
+
+# ── 2. Fan-out ───────────────────────────────────────────────────────────────
+
+
+class TestFanout:
+    @staticmethod
+    async def join(hub: ChannelHub, client: FakeClientSocket, url: str) -> asyncio.Task:
+        task = asyncio.create_task(fanout(hub, client, url, url, {}))
+        while not client.accepted:
+            await asyncio.sleep(0.01)
+        return task
+
+    def test_subscribers_share_one_upstream(self, ws_upstream):
+        url = upstream_ws_url(ws_upstream.base_url, "/ws/echo-10")
+
+        async def scenario():
+            hub = ChannelHub()
+            a, b = FakeClientSocket(), FakeClientSocket()
+            tasks = [await self.join(hub, a, url), await self.join(hub, b, url)]
+            assert hub.stats()["channels"] == 1
+            assert hub.stats()["subscribers"] == 2
+            a.say("hello")
+            assert await a.next_frame() == "hello"
+            assert await b.next_frame() == "hello"
+            a.leave()
+            b.leave()
+            await asyncio.gather(*tasks)
+            return hub.stats()
+
+        stats = asyncio.run(scenario())
+        assert stats["channels"] == 0
+        assert len(ws_upstream.handshakes) == 1
+
+    def test_last_subscriber_closes_upstream(self, ws_upstream):
+        url = upstream_ws_url(ws_upstream.base_url, "/ws/idle-10")
+
+        async def scenario():
+            hub = ChannelHub()
+            a, b = FakeClientSocket(), FakeClientSocket()
+            first, second = await self.join(hub, a, url), await self.join(hub, b, url)
+            b.leave()
+            await second
+            await asyncio.sleep(0.1)
+            assert not ws_upstream.closed.is_set()
+            a.leave()
+            await first
+
+        asyncio.run(scenario())
+        assert ws_upstream.closed.wait(5)
+
+    def test_upstream_close_reaches_every_subscriber(self, ws_upstream):
+        url = upstream_ws_url(ws_upstream.base_url, "/ws/push-10")
+
+        async def scenario():
+            hub = ChannelHub()
+            a = FakeClientSocket()
+            task = asyncio.create_task(fanout(hub, a, url, url, {}))
+            frames = [await a.next_frame() for _ in range(3)]
+            await task
+            return frames, a.close_code
+
+        frames, code = asyncio.run(scenario())
+        assert frames == ["status-0", "status-1", "status-2"]
+        assert code == 1000
+
+
+class TestSlowConsumerPolicy:
+    @staticmethod
+    def drain(subscriber: Subscriber) -> list:
+        items = []
+        while not subscriber.queue.empty():
+            items.append(subscriber.queue.get_nowait())
+        return items
+
+    def test_drop_oldest(self):
+        sub = Subscriber(websocket=None, buffer_frames=2)
+        for frame in ("1", "2", "3"):
+            assert sub.offer(frame, "drop_oldest")
+        assert self.drain(sub) == ["2", "3"]
+        assert sub.dropped == 1
+
+    def test_drop_newest(self):
+        sub = Subscriber(websocket=None, buffer_frames=2)
+        for frame in ("1", "2", "3"):
+            assert sub.offer(frame, "drop_newest")
+        assert self.drain(sub) == ["1", "2"]
+
+    def test_disconnect(self):
+        sub = Subscriber(websocket=None, buffer_frames=2)
+        assert sub.offer("1", "disconnect")
+        assert sub.offer("2", "disconnect")
+        assert not sub.offer("3", "disconnect")
+        items = self.drain(sub)
+        assert isinstance(items[-1], Closed)
+        assert items[-1].code == TRY_AGAIN_LATER